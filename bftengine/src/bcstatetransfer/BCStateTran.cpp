@@ -216,6 +216,8 @@ BCStateTran::BCStateTran(const Config &config, IAppState *const stateApi, DataSt
           metrics_component_.RegisterCounter("start_collecting_state"),
           metrics_component_.RegisterCounter("on_timer"),
           metrics_component_.RegisterCounter("on_transferring_complete"),
+          metrics_component_.RegisterHistogram("state_transfer_duration_ms"),
+          metrics_component_.RegisterHistogram("block_fetch_duration_us"),
       } {
   Assert(stateApi != nullptr);
   Assert(replicas_.size() >= 3U * config_.fVal + 1U);
@@ -599,6 +601,7 @@ void BCStateTran::startCollectingState() {
   Assert(running_);
   Assert(!isFetching());
   metrics_.start_collecting_state_.Get().Inc();
+  collecting_state_start_time_ = std::chrono::steady_clock::now();
 
   verifyEmptyInfoAboutGettingCheckpointSummary();
   {  // txn scope
@@ -1093,6 +1096,7 @@ bool BCStateTran::onMessage(const CheckpointSummaryMsg *m, uint32_t msgLen, uint
     Assert(!g.txn()->hasCheckpointBeingFetched());
     g.txn()->setCheckpointBeingFetched(newCheckpoint);
     metrics_.checkpoint_being_fetched_.Get().Set(newCheckpoint.checkpointNum);
+    block_fetch_start_time_ = std::chrono::steady_clock::now();
 
     LOG_DEBUG(STLogger,
               "Start fetching checkpoint: "
@@ -1978,6 +1982,13 @@ void BCStateTran::processData() {
       bool b = as_->putBlock(nextRequiredBlock_, buffer_, actualBlockSize);
       Assert(b);
 
+      auto blockStoredTime = std::chrono::steady_clock::now();
+      if (block_fetch_start_time_ != std::chrono::steady_clock::time_point()) {
+        metrics_.block_fetch_duration_us_.Get().Record(
+            std::chrono::duration_cast<std::chrono::microseconds>(blockStoredTime - block_fetch_start_time_).count());
+      }
+      block_fetch_start_time_ = blockStoredTime;
+
       memset(buffer_, 0, actualBlockSize);
       const uint64_t firstRequiredBlock = g.txn()->getFirstRequiredBlock();
 
@@ -2074,6 +2085,13 @@ void BCStateTran::processData() {
       // Completion
       LOG_DEBUG(STLogger, "Calling onTransferringComplete for checkpoint " << cp.checkpointNum);
       metrics_.on_transferring_complete_.Get().Inc();
+      if (collecting_state_start_time_ != std::chrono::steady_clock::time_point()) {
+        auto duration = std::chrono::steady_clock::now() - collecting_state_start_time_;
+        metrics_.state_transfer_duration_ms_.Get().Record(
+            std::chrono::duration_cast<std::chrono::milliseconds>(duration).count());
+        collecting_state_start_time_ = {};
+      }
+      block_fetch_start_time_ = {};
       replicaForStateTransfer_->onTransferringComplete(cp.checkpointNum);
 
       break;
@@ -39,6 +39,7 @@ using std::string;
 using concordMetrics::StatusHandle;
 using concordMetrics::GaugeHandle;
 using concordMetrics::CounterHandle;
+using concordMetrics::HistogramHandle;
 
 namespace bftEngine::SimpleBlockchainStateTransfer::impl {
 
@@ -318,6 +319,10 @@ class BCStateTran : public IStateTransfer {
   void loadMetrics();
   std::chrono::seconds last_metrics_dump_time_;
   std::chrono::seconds metrics_dump_interval_in_sec_;
+  // When the current state transfer started, and when fetching of the next
+  // required block started. Unset while resuming a fetch after a restart.
+  std::chrono::steady_clock::time_point collecting_state_start_time_;
+  std::chrono::steady_clock::time_point block_fetch_start_time_;
   concordMetrics::Component metrics_component_;
   struct Metrics {
     StatusHandle fetching_state_;
@@ -376,6 +381,12 @@ class BCStateTran : public IStateTransfer {
     CounterHandle on_timer_;
 
     CounterHandle on_transferring_complete_;
+
+    // Milliseconds from startCollectingState until the transfer completes
+    HistogramHandle state_transfer_duration_ms_;
+    // Microseconds to fetch each block, from the checkpoint being chosen or
+    // the previous block being stored
+    HistogramHandle block_fetch_duration_us_;
   };
 
   mutable Metrics metrics_;
@@ -30,6 +30,7 @@ class ReplicasInfo;
 using concordMetrics::GaugeHandle;
 using concordMetrics::StatusHandle;
 using concordMetrics::CounterHandle;
+using concordMetrics::HistogramHandle;
 using concordUtil::Timers;
 using bftEngine::ReplicaConfig;
 
@@ -311,6 +311,8 @@ void ReplicaImp::tryToSendPrePrepareMsg(bool batchingLogic) {
 
   Assert(pp->numberOfRequests() > 0);
 
+  traceRequests(pp, "pre_prepare");
+
   if (config_.debugStatisticsEnabled) {
     DebugStatistics::onSendPrePrepareMessage(pp->numberOfRequests(), requestsQueueOfPrimary.size());
   }
@@ -749,6 +751,9 @@ void ReplicaImp::onMessage<FullCommitProofMsg>(FullCommitProofMsg *msg) {
 
       if (msg->senderId() == config_.replicaId) sendToAllOtherReplicas(msg);
 
+      traceRequests(seqNumInfo.getPrePrepareMsg(), "commit");
+      recordCommitLatency(seqNumInfo);
+
       const bool askForMissingInfoAboutCommittedItems =
           (msgSeqNum > lastExecutedSeqNum + config_.concurrencyLevel);  // TODO(GG): check/improve this logic
       executeNextCommittedRequests(askForMissingInfoAboutCommittedItems);
@@ -1070,6 +1075,9 @@ void ReplicaImp::onCommitCombinedSigSucceeded(SeqNum seqNumber,
 
   Assert(seqNumInfo.isCommitted__gg());
 
+  traceRequests(seqNumInfo.getPrePrepareMsg(), "commit");
+  recordCommitLatency(seqNumInfo);
+
   bool askForMissingInfoAboutCommittedItems = (seqNumber > lastExecutedSeqNum + config_.concurrencyLevel);
 
   executeNextCommittedRequests(askForMissingInfoAboutCommittedItems);
@@ -1099,6 +1107,9 @@ void ReplicaImp::onCommitVerifyCombinedSigResult(SeqNum seqNumber, ViewNum v, bo
     ps_->endWriteTran();
   }
 
+  traceRequests(seqNumInfo.getPrePrepareMsg(), "commit");
+  recordCommitLatency(seqNumInfo);
+
   bool askForMissingInfoAboutCommittedItems = (seqNumber > lastExecutedSeqNum + config_.concurrencyLevel);
   executeNextCommittedRequests(askForMissingInfoAboutCommittedItems);
 }
@@ -2732,7 +2743,9 @@ ReplicaImp::ReplicaImp(bool firstTime,
       metric_not_enough_client_requests_event_{metrics_.RegisterCounter("notEnoughClientRequestsEvent")},
       metric_total_finished_consensuses_{metrics_.RegisterCounter("totalOrderedRequests")},
       metric_total_slowPath_{metrics_.RegisterCounter("totalSlowPaths")},
-      metric_total_fastPath_{metrics_.RegisterCounter("totalFastPaths")} {
+      metric_total_fastPath_{metrics_.RegisterCounter("totalFastPaths")},
+      metric_pre_prepare_to_commit_{metrics_.RegisterHistogram("prePrepareToCommitMicros")},
+      metric_request_execution_{metrics_.RegisterHistogram("requestExecutionMicros")} {
   Assert(config_.replicaId < config_.numReplicas);
   // TODO(GG): more asserts on params !!!!!!!!!!!
 
@@ -2922,6 +2935,8 @@ void ReplicaImp::executeReadOnlyRequest(ClientRequestMsg *request) {
   int error = 0;
   uint32_t actualReplyLength = 0;
 
+  concordUtils::SpanWrapper span = startRequestSpan(*request, "bft_execute_read_only");
+
   if (!supportDirectProofs) {
     error = userRequestsHandler->execute(clientId,
                                          lastExecutedSeqNum,
@@ -2943,11 +2958,50 @@ void ReplicaImp::executeReadOnlyRequest(ClientRequestMsg *request) {
     send(&reply, clientId);
   }
 
+  span.finish();
+  if (request->spanContextSize() > 0) {
+    LOG_INFO(GL,
+             "Trace event=execute replica=" << config_.replicaId << " clientId=" << clientId
+                                            << " reqSeqNum=" << request->requestSeqNum() << " seqNum=0");
+  }
+
   if (config_.debugStatisticsEnabled) {
     DebugStatistics::onRequestCompleted(true);
   }
 }
 
+concordUtils::SpanWrapper ReplicaImp::startRequestSpan(const ClientRequestMsg &req, const std::string &operation) {
+  if (req.spanContextSize() == 0) return concordUtils::SpanWrapper{};
+  try {
+    return concordUtils::startChildSpanFromContext(req.spanContext<ClientRequestMsg>(), operation);
+  } catch (const std::exception &e) {
+    // The span context comes from the client, so it must not stop the execution of its request
+    LOG_WARN(GL, "Failed to extract the span context of reqSeqNum=" << req.requestSeqNum() << ": " << e.what());
+    return concordUtils::SpanWrapper{};
+  }
+}
+
+void ReplicaImp::traceRequests(const PrePrepareMsg *pp, const char *event) {
+  if (pp == nullptr) return;
+  RequestsIterator reqIter(pp);
+  char *requestBody = nullptr;
+  while (reqIter.getAndGoToNext(requestBody)) {
+    const ClientRequestMsgHeader *header = (ClientRequestMsgHeader *)requestBody;
+    // Only requests sampled by their client have a span context
+    if (header->spanContextSize == 0) continue;
+    LOG_INFO(GL,
+             "Trace event=" << event << " replica=" << config_.replicaId << " clientId=" << header->idOfClientProxy
+                            << " reqSeqNum=" << header->reqSeqNum << " seqNum=" << pp->seqNumber());
+  }
+}
+
+void ReplicaImp::recordCommitLatency(const SeqNumInfo &seqNumInfo) {
+  const Time firstInfo = seqNumInfo.getTimeOfFisrtRelevantInfoFromPrimary();
+  const Time currTime = getMonotonicTime();
+  if (firstInfo == MinTime || currTime < firstInfo) return;
+  metric_pre_prepare_to_commit_.Get().Record(duration_cast<microseconds>(currTime - firstInfo).count());
+}
+
 void ReplicaImp::executeRequestsInPrePrepareMsg(PrePrepareMsg *ppMsg, bool recoverFromErrorInRequestsExecution) {
   Assert(!isCollectingState() && currentViewIsActive());
   Assert(ppMsg != nullptr);
@@ -3025,6 +3079,9 @@ void ReplicaImp::executeRequestsInPrePrepareMsg(PrePrepareMsg *ppMsg, bool recov
       NodeIdType clientId = req.clientProxyId();
 
       uint32_t actualReplyLength = 0;
+      concordUtils::SpanWrapper span = startRequestSpan(req, "bft_execute");
+      if (req.spanContextSize() > 0) span.setTag("seq_num", std::to_string(lastExecutedSeqNum + 1));
+      const Time executionStart = getMonotonicTime();
       userRequestsHandler->execute(
           clientId,
           lastExecutedSeqNum + 1,
@@ -3034,6 +3091,8 @@ void ReplicaImp::executeRequestsInPrePrepareMsg(PrePrepareMsg *ppMsg, bool recov
           ReplicaConfigSingleton::GetInstance().GetMaxReplyMessageSize() - sizeof(ClientReplyMsgHeader),
           replyBuffer,
           actualReplyLength);
+      metric_request_execution_.Get().Record(
+          duration_cast<microseconds>(getMonotonicTime() - executionStart).count());
 
       Assert(actualReplyLength > 0);  // TODO(GG): TBD - how do we want to support empty replies? (actualReplyLength==0)
 
@@ -3042,6 +3101,7 @@ void ReplicaImp::executeRequestsInPrePrepareMsg(PrePrepareMsg *ppMsg, bool recov
       send(replyMsg, clientId);
       delete replyMsg;
       clientsManager->removePendingRequestOfClient(clientId);
+      span.finish();
     }
   }
 
@@ -3143,6 +3203,7 @@ void ReplicaImp::executeNextCommittedRequests(const bool requestMissingInfo) {
     Assert(prePrepareMsg->viewNumber() == curView);  // TODO(GG): TBD
 
     executeRequestsInPrePrepareMsg(prePrepareMsg);
+    traceRequests(prePrepareMsg, "execute");
     metric_last_executed_seq_num_.Get().Set(lastExecutedSeqNum);
     metric_total_finished_consensuses_.Get().Inc();
     if (seqNumInfo.slowPathStarted()) {
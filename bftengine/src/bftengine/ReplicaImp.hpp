@@ -27,6 +27,7 @@
 #include "CheckpointInfo.hpp"
 #include "SimpleThreadPool.hpp"
 #include "Bitmap.hpp"
+#include "OpenTracing.hpp"
 
 namespace bftEngine::impl {
 
@@ -203,6 +204,11 @@ class ReplicaImp : public InternalReplicaApi, public ReplicaForStateTransfer {
   CounterHandle metric_total_finished_consensuses_;
   CounterHandle metric_total_slowPath_;
   CounterHandle metric_total_fastPath_;
+
+  // Microseconds from the first message of the primary about a sequence number to its commit
+  HistogramHandle metric_pre_prepare_to_commit_;
+  // Microseconds the requests handler takes to execute a request
+  HistogramHandle metric_request_execution_;
   //*****************************************************
  public:
   ReplicaImp(const ReplicaConfig&,
@@ -311,6 +317,15 @@ class ReplicaImp : public InternalReplicaApi, public ReplicaForStateTransfer {
 
   void executeRequestsInPrePrepareMsg(PrePrepareMsg* pp, bool recoverFromErrorInRequestsExecution = false);
 
+  // Start a child span of the span context of a request, if it has one and a tracer is installed
+  concordUtils::SpanWrapper startRequestSpan(const ClientRequestMsg& req, const std::string& operation);
+
+  // Log an event of each request of pp that has a span context, i.e. that was sampled for tracing by its client
+  void traceRequests(const PrePrepareMsg* pp, const char* event);
+
+  // Record the time from the first message of the primary about a committed sequence number until now
+  void recordCommitLatency(const SeqNumInfo& seqNumInfo);
+
   void onSeqNumIsStable(
       SeqNum newStableSeqNum,
       bool hasStateInformation = true,  // true IFF we have checkpoint Or digest in the state transfer
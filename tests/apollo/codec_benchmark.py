@@ -0,0 +1,276 @@
+# Concord
+#
+# Copyright (c) 2020 VMware, Inc. All Rights Reserved.
+#
+# This product is licensed to you under the Apache 2.0 license (the "License").
+# You may not use this product except in compliance with the Apache 2.0 License.
+#
+# This product may include a number of subcomponents with separate copyright
+# notices and license terms. Your use of these subcomponents is subject to the
+# terms and conditions of the subcomponent's license, as noted in the LICENSE
+# file.
+"""
+Microbenchmarks of the wire codecs on the path of every request: bft_msgs
+and the SimpleKVBC protocol, across payload, readset and writeset sizes.
+
+Each case is warmed up, then timed over repeated runs of many calls. The
+median time per call is reported along with its spread (the interquartile
+range), and the memory allocated per call: the number of memory blocks the
+result keeps alive, and the peak bytes allocated during the call.
+
+Run from the tests/apollo directory:
+
+    python3 codec_benchmark.py
+
+Cases that are slower or allocate more than the thresholds stored in
+codec_benchmark_thresholds.json make the exit status 1. Time thresholds are
+ratios to a reference workload of plain Python code. Each timed run of a case
+is paired with a run of the reference right before it, so the ratios hold on
+slower machines, and through changes of load or clock speed during a run. Thresholds of
+new cases can be recorded, with some headroom, with --update-thresholds.
+"""
+import argparse
+import gc
+import json
+import os.path
+import statistics
+import struct
+import sys
+import time
+import tracemalloc
+
+# util.bft adds the pyclient directory to the path
+from util import bft
+from util.skvbc import SimpleKVBCProtocol
+import bft_msgs
+
+THRESHOLDS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               "codec_benchmark_thresholds.json")
+
+REFERENCE_ARGS = (16,)
+
+# The headroom given to the time ratios recorded as thresholds
+THRESHOLD_HEADROOM = 1.5
+
+# A case only exceeds its time threshold by more than this many times the
+# interquartile range of its ratios
+IQR_TOLERANCE = 3
+
+PAYLOAD_SIZES = [64, 1024, 16*1024, 60*1024]
+SET_SIZES = [1, 10, 100]
+BATCH_SIZES = [100, 1000]
+
+
+def key(i):
+    """Return a key of the fixed size SimpleKVBC expects"""
+    return f'{i:0{SimpleKVBCProtocol.KV_LEN}d}'.encode()
+
+
+def read_reply(num_kv_pairs):
+    """Return a SimpleKVBC read reply with num_kv_pairs pairs"""
+    data = bytearray([SimpleKVBCProtocol.READ])
+    data.extend(struct.pack("<Q", num_kv_pairs))
+    for i in range(num_kv_pairs):
+        data.extend(key(i))
+        data.extend(key(i))
+    return bytes(data)
+
+
+def reference(count):
+    """
+    The workload that time thresholds are relative to: plain Python code and
+    struct packing, like the codecs
+    """
+    return b''.join([struct.pack("<Q", i) for i in range(count)])
+
+
+def cases():
+    """Return a list of (name, function, args) to benchmark"""
+    cases = []
+    for size in PAYLOAD_SIZES:
+        msg = b'x' * size
+        cases.append((f'pack_request/payload={size}', bft_msgs.pack_request,
+                      (4, 1, False, 5000, '1', msg)))
+    for size in PAYLOAD_SIZES:
+        reply = bft_msgs.pack_reply(0, 1, b'x' * size)
+        cases.append((f'unpack_reply/payload={size}', bft_msgs.unpack_reply,
+                      (reply,)))
+    for size in BATCH_SIZES:
+        replies = [bft_msgs.pack_reply(i % 4, i, b'x' * 64) for i in range(size)]
+        cases.append((f'unpack_reply_headers/replies={size}',
+                      bft_msgs.unpack_reply_headers, (replies,)))
+    for size in SET_SIZES:
+        writeset = [(key(i), key(i)) for i in range(size)]
+        cases.append((f'write_req/writeset={size}',
+                      SimpleKVBCProtocol.write_req, ([], writeset, 0)))
+        readset = [key(i) for i in range(size)]
+        cases.append((f'write_req/readset={size},writeset=1',
+                      SimpleKVBCProtocol.write_req, (readset, writeset[:1], 0)))
+    for size in SET_SIZES:
+        readset = [key(i) for i in range(size)]
+        cases.append((f'read_req/readset={size}', SimpleKVBCProtocol.read_req,
+                      (readset,)))
+    for size in SET_SIZES:
+        cases.append((f'parse_read_reply/pairs={size}',
+                      SimpleKVBCProtocol.parse_read_reply,
+                      (read_reply(size)[1:],)))
+    return cases
+
+
+def time_per_call(fn, args, loops):
+    start = time.perf_counter()
+    for _ in range(loops):
+        fn(*args)
+    return (time.perf_counter() - start) / loops
+
+
+def calibrate(fn, args, min_time):
+    """Return the number of loops that takes at least min_time seconds"""
+    loops = 1
+    while True:
+        if time_per_call(fn, args, loops) * loops >= min_time:
+            return loops
+        loops *= 2
+
+
+def allocations(fn, args):
+    """
+    Return the number of memory blocks kept alive by the result of a call, and
+    the peak number of bytes allocated during the call.
+    """
+    gc.collect()
+    before = sys.getallocatedblocks()
+    result = fn(*args)
+    blocks = sys.getallocatedblocks() - before
+    del result
+
+    tracemalloc.start()
+    try:
+        fn(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return max(0, blocks), peak
+
+
+def iqr(values):
+    """Return the interquartile range of a list of values"""
+    if len(values) < 2:
+        return 0
+    quartiles = statistics.quantiles(values, n=4)
+    return quartiles[2] - quartiles[0]
+
+
+def run_case(fn, args, warmup, repeat, min_time, reference_loops):
+    """
+    Benchmark a single case and return its measurements as a dict. Each timed
+    run is preceded by a run of the reference, `reference_loops` calls long.
+    """
+    for _ in range(warmup):
+        fn(*args)
+    loops = calibrate(fn, args, min_time)
+    times = []
+    ratios = []
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            reference_time = time_per_call(reference, REFERENCE_ARGS,
+                                           reference_loops)
+            times.append(time_per_call(fn, args, loops))
+            ratios.append(times[-1] / reference_time)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    blocks, peak_bytes = allocations(fn, args)
+    return {'median_ns': statistics.median(times) * 1e9,
+            'iqr_ns': iqr(times) * 1e9,
+            'min_ns': min(times) * 1e9,
+            'median_ratio': statistics.median(ratios),
+            'ratio_iqr': iqr(ratios),
+            'loops': loops,
+            'repeat': repeat,
+            'blocks_per_call': blocks,
+            'peak_bytes_per_call': peak_bytes}
+
+
+def check(results, thresholds, time_scale):
+    """Return a list of descriptions of the exceeded thresholds"""
+    failures = []
+    for name, result in results.items():
+        threshold = thresholds.get(name)
+        if threshold is None:
+            continue
+        limit = threshold['median_ratio'] * time_scale
+        if result['median_ratio'] > limit + IQR_TOLERANCE * result['ratio_iqr']:
+            failures.append(f"{name}: median {result['median_ratio']:.3f} "
+                            f"times the reference > {limit:.3f}")
+        if result['blocks_per_call'] > threshold['blocks_per_call']:
+            failures.append(f"{name}: {result['blocks_per_call']} blocks > "
+                            f"{threshold['blocks_per_call']}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--filter', default='',
+                        help='only run cases whose name contains this string')
+    parser.add_argument('--warmup', type=int, default=1000,
+                        help='calls before timing each case')
+    parser.add_argument('--repeat', type=int, default=15,
+                        help='timed runs of each case')
+    parser.add_argument('--min-time', type=float, default=.02,
+                        help='minimum seconds of each timed run')
+    parser.add_argument('--thresholds', default=THRESHOLDS_FILE)
+    parser.add_argument('--time-scale', type=float, default=1.0,
+                        help='multiply the stored time ratios')
+    parser.add_argument('--update-thresholds', action='store_true',
+                        help='record the thresholds of cases without one')
+    parser.add_argument('--output', help='write the results as JSON to a file')
+    args = parser.parse_args()
+
+    for _ in range(args.warmup):
+        reference(*REFERENCE_ARGS)
+    reference_loops = calibrate(reference, REFERENCE_ARGS, args.min_time)
+
+    results = dict()
+    print(f"{'case':40} {'median':>10} {'iqr':>9} {'ratio':>7} {'blocks':>6} "
+          f"{'peak':>8}")
+    for name, fn, fn_args in cases():
+        if args.filter not in name:
+            continue
+        result = run_case(fn, fn_args, args.warmup, args.repeat, args.min_time,
+                          reference_loops)
+        results[name] = result
+        print(f"{name:40} {result['median_ns']:8.0f}ns {result['iqr_ns']:7.0f}ns "
+              f"{result['median_ratio']:7.3f} {result['blocks_per_call']:6} "
+              f"{result['peak_bytes_per_call']:7}B")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    thresholds = dict()
+    if os.path.exists(args.thresholds):
+        with open(args.thresholds) as f:
+            thresholds = json.load(f)
+
+    if args.update_thresholds:
+        for name, result in results.items():
+            ratio = result['median_ratio'] * THRESHOLD_HEADROOM
+            thresholds.setdefault(name, {
+                'median_ratio': round(ratio, 3),
+                'blocks_per_call': result['blocks_per_call']})
+        with open(args.thresholds, 'w') as f:
+            json.dump(thresholds, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    failures = check(results, thresholds, args.time_scale)
+    for failure in failures:
+        print(f'THRESHOLD EXCEEDED {failure}')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
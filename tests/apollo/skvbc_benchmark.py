@@ -0,0 +1,156 @@
+# Concord
+#
+# Copyright (c) 2020 VMware, Inc. All Rights Reserved.
+#
+# This product is licensed to you under the Apache 2.0 license (the "License").
+# You may not use this product except in compliance with the Apache 2.0 License.
+#
+# This product may include a number of subcomponents with separate copyright
+# notices and license terms. Your use of these subcomponents is subject to the
+# terms and conditions of the subcomponent's license, as noted in the LICENSE
+# file.
+"""
+Run a closed-loop SimpleKVBC throughput benchmark for each of the interesting
+BFT configurations, sweeping the number of clients and the read/write mix.
+
+Each result records throughput, latency percentiles, retries and timeouts,
+and how many sequence numbers were committed on the fast and slow paths
+(`slowPathCount`). Run from the tests/apollo directory, like the tests:
+
+    python3 skvbc_benchmark.py --output results.json
+
+Compare the results with a stored baseline. The exit status is 1 if any
+throughput or p99 latency regressed by more than the tolerance:
+
+    python3 skvbc_benchmark.py --compare baseline.json results.json
+
+Or run and compare in one go:
+
+    python3 skvbc_benchmark.py --output results.json --baseline baseline.json
+"""
+import argparse
+import json
+import os.path
+import sys
+
+import trio
+
+from util import bft
+from util import benchmark
+
+
+def start_replica_cmd(builddir, replica_id):
+    """
+    Return a command that starts an skvbc replica when passed to
+    subprocess.Popen.
+
+    Note each arguments is an element in a list.
+    """
+    statusTimerMilli = "500"
+    path = os.path.join(builddir, "tests", "simpleKVBC", "TesterReplica", "skvbc_replica")
+    return [path,
+            "-k", bft.KEY_FILE_PREFIX,
+            "-i", str(replica_id),
+            "-s", statusTimerMilli,
+            "-p" if os.environ.get('BUILD_ROCKSDB_STORAGE', "").lower()
+                    in set(["true", "on"])
+                 else "",
+            "-t", os.environ.get('STORAGE_TYPE', 'v1direct')]
+
+
+def run(args):
+    results = []
+
+    @bft.with_bft_network(start_replica_cmd,
+                          selected_configs=lambda n, f, c: n in args.n,
+                          num_clients=max(args.clients))
+    async def run_config(bft_network):
+        bft_network.start_all_replicas()
+        bench = benchmark.ClosedLoopBenchmark(bft_network)
+        # Warm up the clients and the replicas
+        await bench.run(1, 1, args.warmup)
+        for num_clients in args.clients:
+            for write_weight in args.write_weights:
+                result = await bench.run(num_clients, write_weight,
+                                         args.duration)
+                results.append(result)
+                print(format_result(result))
+
+    trio.run(run_config)
+    return results
+
+
+def format_result(result):
+    latency = result['latency']
+    millis = ' '.join(f"{p}={latency[p] * 1000:.1f}ms"
+                      if latency[p] is not None else f"{p}=-"
+                      for p in ('p50', 'p90', 'p99'))
+    return (f"n={result['n']} f={result['f']} c={result['c']} "
+            f"clients={result['clients']} writes={result['write_weight']:g}: "
+            f"{result['throughput']:.1f} req/s {millis} "
+            f"slow={result['slow_path_count']} fast={result['fast_path_count']} "
+            f"retries={result['retries']} timeouts={result['timeouts']}")
+
+
+def compare(results, baseline, tolerance):
+    """Print any regressions and return true if there are none"""
+    regressions = benchmark.compare_results(results, baseline, tolerance)
+    for r in regressions:
+        print(f"REGRESSION n={r['n']} f={r['f']} c={r['c']} "
+              f"clients={r['clients']} writes={r['write_weight']:g}: "
+              f"{r['metric']} {r['baseline']:.4g} -> {r['current']:.4g}")
+    if not regressions:
+        print(f'No regressions beyond {tolerance:.0%}')
+    return not regressions
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n', default='4,6,7',
+                        help='comma separated cluster sizes, among the '
+                             'interesting configs')
+    parser.add_argument('--clients', default='1,4,16',
+                        help='comma separated numbers of clients')
+    parser.add_argument('--write-weights', default='1,0.5',
+                        help='comma separated fractions of writes')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds to run each combination')
+    parser.add_argument('--warmup', type=float, default=2,
+                        help='seconds to warm up each configuration')
+    parser.add_argument('--output', help='write the results as JSON to a file')
+    parser.add_argument('--baseline',
+                        help='compare the results with a baseline JSON file')
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'RESULTS'),
+                        help='only compare two results files')
+    parser.add_argument('--tolerance', type=float,
+                        default=benchmark.REGRESSION_TOLERANCE,
+                        help='allowed fractional regression')
+    args = parser.parse_args()
+
+    if args.compare:
+        baseline, results = (load(path) for path in args.compare)
+        sys.exit(0 if compare(results, baseline, args.tolerance) else 1)
+
+    args.n = [int(n) for n in args.n.split(',')]
+    args.clients = [int(c) for c in args.clients.split(',')]
+    args.write_weights = [float(w) for w in args.write_weights.split(',')]
+    # The network changes into a temporary directory
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = load(args.baseline) if args.baseline else None
+
+    results = run(args)
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if baseline is not None:
+        sys.exit(0 if compare(results, baseline, args.tolerance) else 1)
+
+
+if __name__ == '__main__':
+    main()
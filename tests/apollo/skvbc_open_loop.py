@@ -0,0 +1,116 @@
+# Concord
+#
+# Copyright (c) 2020 VMware, Inc. All Rights Reserved.
+#
+# This product is licensed to you under the Apache 2.0 license (the "License").
+# You may not use this product except in compliance with the Apache 2.0 License.
+#
+# This product may include a number of subcomponents with separate copyright
+# notices and license terms. Your use of these subcomponents is subject to the
+# terms and conditions of the subcomponent's license, as noted in the LICENSE
+# file.
+"""
+Run an open-loop SimpleKVBC load against a fresh cluster at a series of
+rates, and report throughput, latency percentiles and the saturation knee.
+
+Latencies are measured from the intended send time of each request, so they
+include any time spent waiting for a free client once the cluster can't keep
+up. Run from the tests/apollo directory, like the tests:
+
+    python3 skvbc_open_loop.py --f 1 --c 0 --rates 50,100,200,400 --duration 10
+"""
+import argparse
+import json
+import os.path
+
+import trio
+
+from util import bft
+from util import load_generator
+
+
+def start_replica_cmd(builddir, replica_id):
+    """
+    Return a command that starts an skvbc replica when passed to
+    subprocess.Popen.
+
+    Note each arguments is an element in a list.
+    """
+    statusTimerMilli = "500"
+    path = os.path.join(builddir, "tests", "simpleKVBC", "TesterReplica", "skvbc_replica")
+    return [path,
+            "-k", bft.KEY_FILE_PREFIX,
+            "-i", str(replica_id),
+            "-s", statusTimerMilli,
+            "-p" if os.environ.get('BUILD_ROCKSDB_STORAGE', "").lower()
+                    in set(["true", "on"])
+                 else "",
+            "-t", os.environ.get('STORAGE_TYPE', 'v1direct')]
+
+
+async def run(args, output):
+    config = bft.TestConfig(n=3*args.f + 2*args.c + 1,
+                            f=args.f,
+                            c=args.c,
+                            num_clients=args.num_clients,
+                            key_file_prefix=bft.KEY_FILE_PREFIX,
+                            start_replica_cmd=start_replica_cmd,
+                            stop_replica_cmd=None,
+                            num_ro_replicas=0)
+    with bft.BftTestNetwork.new(config) as bft_network:
+        bft_network.start_all_replicas()
+        generator = load_generator.OpenLoopLoadGenerator(
+            bft_network, write_weight=args.write_weight)
+        # Warm up the clients and the replicas
+        await generator.run(min(args.rates), args.warmup, args.schedule)
+        knee, results = await generator.find_knee(
+            args.rates, args.duration, args.schedule)
+
+    print(f'n={config.n} f={config.f} c={config.c} '
+          f'clients={config.num_clients} schedule={args.schedule}')
+    print(f"{'rate':>8} {'tput':>8} {'p50':>8} {'p90':>8} {'p99':>8} "
+          f"{'p99.9':>8} {'timeouts':>8} {'backlog':>8}")
+    for result in results:
+        latency = result.latency.to_dict()
+        millis = [f"{latency[p] * 1000:8.1f}" if latency[p] is not None
+                  else f"{'-':>8}" for p in ('p50', 'p90', 'p99', 'p999')]
+        print(f"{result.rate:8g} {result.throughput:8.1f} {' '.join(millis)} "
+              f"{result.timeouts:8} {result.max_backlog:8}")
+    print(f'Saturation knee: {knee} requests/sec')
+
+    report = {'n': config.n, 'f': config.f, 'c': config.c,
+              'num_clients': config.num_clients,
+              'write_weight': args.write_weight,
+              'knee': knee,
+              'results': [result.to_dict() for result in results]}
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--f', type=int, default=1)
+    parser.add_argument('--c', type=int, default=0)
+    parser.add_argument('--num-clients', type=int, default=30)
+    parser.add_argument('--rates', default='25,50,100,200,400,800',
+                        help='comma separated requests/sec to offer')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds to offer each rate')
+    parser.add_argument('--warmup', type=float, default=2,
+                        help='seconds to warm up at the lowest rate')
+    parser.add_argument('--schedule', default=load_generator.FIXED,
+                        choices=[load_generator.FIXED, load_generator.POISSON])
+    parser.add_argument('--write-weight', type=float, default=.70,
+                        help='fraction of requests that are writes')
+    parser.add_argument('--output', help='write the results as JSON to a file')
+    args = parser.parse_args()
+    args.rates = [float(rate) for rate in args.rates.split(',')]
+    # The network changes into a temporary directory
+    output = os.path.abspath(args.output) if args.output else None
+    trio.run(run, args, output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+# Concord
+#
+# Copyright (c) 2020 VMware, Inc. All Rights Reserved.
+#
+# This product is licensed to you under the Apache 2.0 license (the "License").
+# You may not use this product except in compliance with the Apache 2.0 License.
+#
+# This product may include a number of subcomponents with separate copyright
+# notices and license terms. Your use of these subcomponents is subject to the
+# terms and conditions of the subcomponent's license, as noted in the LICENSE
+# file.
+
+import os
+import tempfile
+import time
+import unittest
+
+from util import tracing
+
+class TestReadReplicaEvents(unittest.TestCase):
+    """Test reading the trace events of replica logs"""
+
+    def setUp(self):
+        self.tz = os.environ.get('TZ')
+
+    def tearDown(self):
+        if self.tz is None:
+            os.environ.pop('TZ', None)
+        else:
+            os.environ['TZ'] = self.tz
+        time.tzset()
+
+    def test_times_are_utc(self):
+        """
+        Replica log times are in UTC, whatever the time zone of the host
+        """
+        os.environ['TZ'] = 'America/New_York'
+        time.tzset()
+        with tempfile.NamedTemporaryFile('w', suffix='.log') as log:
+            log.write('|01-02-2020 03:04:05.678|1|INFO |concord.bft|traceRequests|'
+                      'Trace event=commit replica=2 clientId=5 reqSeqNum=7 seqNum=3\n')
+            log.flush()
+            events = tracing.read_replica_events([log.name])
+        # 2020-01-02 03:04:05.678 UTC
+        self.assertAlmostEqual(1577934245.678, events[(5, 7)]['commit'][2])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+# Concord
+#
+# Copyright (c) 2020 VMware, Inc. All Rights Reserved.
+#
+# This product is licensed to you under the Apache 2.0 license (the "License").
+# You may not use this product except in compliance with the Apache 2.0 License.
+#
+# This product may include a number of subcomponents with separate copyright
+# notices and license terms. Your use of these subcomponents is subject to the
+# terms and conditions of the subcomponent's license, as noted in the LICENSE
+# file.
+
+import random
+
+import trio
+
+# util.bft adds the pyclient directory to the path
+from util import bft
+from util import skvbc as kvbc
+import bft_telemetry
+
+# By default, a result regresses if its throughput drops, or its p99 latency
+# grows, by more than this fraction of the baseline
+REGRESSION_TOLERANCE = 0.10
+
+
+def result_key(result):
+    """Return the parameters that identify a benchmark result"""
+    return (result['n'], result['f'], result['c'],
+            result['clients'], result['write_weight'])
+
+
+class ClosedLoopBenchmark:
+    """
+    Measure the throughput of a cluster with a closed-loop SimpleKVBC load:
+    each client sends its next request as soon as its previous one completes.
+    """
+
+    def __init__(self, bft_network, rng=None):
+        self.bft_network = bft_network
+        self.protocol = kvbc.SimpleKVBCProtocol(bft_network)
+        self.rng = rng if rng is not None else random.Random()
+
+    async def run(self, num_clients, write_weight, duration):
+        """
+        Run `num_clients` clients for `duration` seconds, of which a fraction
+        `write_weight` of requests are writes, and return the result as a
+        dict.
+        """
+        config = self.bft_network.config
+        clients = list(self.bft_network.clients.values())[:num_clients]
+        assert len(clients) == num_clients, \
+            f'Only {len(clients)} clients are available'
+
+        latency = bft_telemetry.LatencyHistogram()
+        stats = {'requests': 0, 'writes': 0, 'retries': 0, 'timeouts': 0}
+        slow_before, executed_before = await self._consensus_counters()
+
+        start = trio.current_time()
+        deadline = start + duration
+        async with trio.open_nursery() as nursery:
+            for client in clients:
+                nursery.start_soon(self._client_loop, client, write_weight,
+                                   deadline, latency, stats)
+        elapsed = trio.current_time() - start
+
+        slow_after, executed_after = await self._consensus_counters()
+        slow_paths = slow_after - slow_before
+        executed = executed_after - executed_before
+        return {'n': config.n,
+                'f': config.f,
+                'c': config.c,
+                'clients': num_clients,
+                'write_weight': write_weight,
+                'duration': elapsed,
+                'requests': stats['requests'],
+                'writes': stats['writes'],
+                'throughput': stats['requests'] / elapsed,
+                'latency': latency.to_dict(),
+                'retries': stats['retries'],
+                'timeouts': stats['timeouts'],
+                'executed_seq_nums': executed,
+                'slow_path_count': slow_paths,
+                'fast_path_count': max(0, executed - slow_paths)}
+
+    async def _client_loop(self, client, write_weight, deadline, latency, stats):
+        while trio.current_time() < deadline:
+            is_write = self.rng.random() < write_weight
+            if is_write:
+                msg = self.protocol.write_req(
+                    [], [(self.protocol.random_key(),
+                          self.protocol.random_value())], 0)
+            else:
+                msg = self.protocol.read_req([self.protocol.random_key()])
+            start = trio.current_time()
+            try:
+                if is_write:
+                    await client.write(msg)
+                else:
+                    await client.read(msg)
+            except trio.TooSlowError:
+                stats['timeouts'] += 1
+                continue
+            finally:
+                stats['retries'] += client.retries
+            latency.record(trio.current_time() - start)
+            stats['requests'] += 1
+            if is_write:
+                stats['writes'] += 1
+
+    async def _consensus_counters(self):
+        """
+        Return the slowPathCount and lastExecutedSeqNum of the first replica,
+        read from the same snapshot
+        """
+        metrics = (('replica', 'Counters', 'slowPathCount'),
+                   ('replica', 'Gauges', 'lastExecutedSeqNum'))
+        with trio.fail_after(bft.METRICS_TIMEOUT_SEC):
+            # Wait until the metrics are available
+            snapshot = await self.bft_network.watcher.wait_for(
+                0, lambda s: all(metric in s for metric in metrics))
+        return snapshot.get_many(*metrics)
+
+
+def compare_results(results, baseline, tolerance=REGRESSION_TOLERANCE):
+    """
+    Compare benchmark results with baseline results of the same parameters.
+    Return a list of regressions, each a dict with the result parameters, the
+    metric that regressed and its baseline and current values.
+
+    Results without a baseline, and baselines without a result, are ignored.
+    """
+    baseline = {result_key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        base = baseline.get(result_key(result))
+        if base is None:
+            continue
+        checks = [('throughput', base['throughput'], result['throughput'],
+                   result['throughput'] < base['throughput'] * (1 - tolerance)),
+                  ('p99', base['latency']['p99'], result['latency']['p99'],
+                   base['latency']['p99'] is not None
+                   and result['latency']['p99'] is not None
+                   and result['latency']['p99'] > base['latency']['p99'] * (1 + tolerance))]
+        for metric, before, after, regressed in checks:
+            if regressed:
+                regressions.append({
+                    'n': result['n'], 'f': result['f'], 'c': result['c'],
+                    'clients': result['clients'],
+                    'write_weight': result['write_weight'],
+                    'metric': metric,
+                    'baseline': before,
+                    'current': after})
+    return regressions
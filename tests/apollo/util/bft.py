@@ -31,7 +31,10 @@ sys.path.append(os.path.abspath("../../util/pyclient"))
 import bft_config
 import bft_client
 import bft_metrics_client
+import bft_telemetry
 from util import bft_metrics
+from util import metrics_recorder
+from util import metrics_watcher
 from util.bft_test_exceptions import AlreadyRunningError, AlreadyStoppedError
 
 
@@ -123,13 +126,22 @@ def with_bft_network(start_replica_cmd, selected_configs=None, num_clients=None,
                               f'with n={config.n}, f={config.f}, c={config.c}, '
                               f'num_clients={config.num_clients}, '
                               f'num_ro_replicas={config.num_ro_replicas}')
-                        await async_fn(*args, **kwargs, bft_network=bft_network)
+                        if os.environ.get(METRICS_SERIES_DIR_ENV):
+                            series_file = f'{async_fn.__name__}-n{config.n}-f{config.f}-c{config.c}-metrics.json'
+                            async with bft_network.record_metrics(series_file):
+                                await async_fn(*args, **kwargs, bft_network=bft_network)
+                        else:
+                            await async_fn(*args, **kwargs, bft_network=bft_network)
         return wrapper
 
     return decorator
 
 MAX_MSG_SIZE = 64*1024 # 64k
 REQ_TIMEOUT_MILLI = 5000
+# Tests record the metrics series of their replicas into this directory only
+# if it is set in the environment. Series recorded explicitly are written to
+# the test directory otherwise.
+METRICS_SERIES_DIR_ENV = 'APOLLO_METRICS_DIR'
 RETRY_TIMEOUT_MILLI = 250
 METRICS_TIMEOUT_SEC = 5
 
@@ -171,6 +183,8 @@ class BftTestNetwork:
         self.replicas = replicas
         self.clients = clients
         self.metrics = metrics
+        # The primary as learned by any of the clients
+        self.primary_cache = bft_client.PrimaryCache()
 
     @classmethod
     def new(cls, config):
@@ -242,15 +256,50 @@ class BftTestNetwork:
         subprocess.run(args, check=True)
 
     def _create_clients(self):
+        # Multiplexed clients behave like UdpClients, but also allow many
+        # concurrent requests over one socket inside their async context
         for client_id in range(self.config.n + self.config.num_ro_replicas,
                                self.config.num_clients+self.config.n + self.config.num_ro_replicas):
             config = self._bft_config(client_id)
-            self.clients[client_id] = bft_client.UdpClient(config, self.replicas)
+            self.clients[client_id] = bft_client.MultiplexedUdpClient(
+                config, self.replicas, self.primary_cache)
 
     async def new_client(self):
         client_id = max(self.clients.keys()) + 1
         config = self._bft_config(client_id)
-        client = bft_client.UdpClient(config, self.replicas)
+        client = bft_client.UdpClient(config, self.replicas, self.primary_cache)
+        self.clients[client_id] = client
+        return client
+
+    async def new_multiplexed_client(self):
+        """
+        Create a client that allows many concurrent requests over a single
+        socket. Requests overlap only inside its async context:
+
+            async with await bft_network.new_multiplexed_client() as client:
+                ...
+        """
+        client_id = max(self.clients.keys()) + 1
+        config = self._bft_config(client_id)
+        client = bft_client.MultiplexedUdpClient(
+            config, self.replicas, self.primary_cache)
+        self.clients[client_id] = client
+        return client
+
+    async def new_tcp_client(self, certs_dir=None):
+        """
+        Create a client that talks to the replicas over TCP, or TLS if
+        `certs_dir` is given. It requires replicas built with
+        BUILD_COMM_TCP_PLAIN or BUILD_COMM_TCP_TLS, and can only be used in
+        its async context:
+
+            async with await bft_network.new_tcp_client() as client:
+                ...
+        """
+        client_id = max(self.clients.keys()) + 1
+        config = self._bft_config(client_id)
+        client = bft_client.TcpClient(
+            config, self.replicas, self.primary_cache, certs_dir)
         self.clients[client_id] = client
         return client
 
@@ -267,6 +316,31 @@ class BftTestNetwork:
         for r in self.replicas:
             metric_clients[r.id] = bft_metrics_client.MetricsClient(r)
         self.metrics = bft_metrics.BftMetrics(metric_clients)
+        self.watcher = metrics_watcher.MetricsWatcher(self.metrics)
+
+    def record_metrics(self, filename, interval=metrics_recorder.SAMPLE_INTERVAL):
+        """
+        Return a MetricsRecorder of the live replicas, to be used as an async
+        context manager, that writes the series to `filename` on exit. The
+        file is in the directory named by $APOLLO_METRICS_DIR if it is set,
+        since the test directory is removed with the network.
+        """
+        directory = os.environ.get(METRICS_SERIES_DIR_ENV, self.testdir)
+        return metrics_recorder.MetricsRecorder(
+            self.metrics, self.get_live_replicas, interval,
+            path=os.path.join(directory, filename))
+
+    def client_telemetry(self):
+        """Return the telemetry of all clients merged into one"""
+        telemetry = bft_telemetry.ClientTelemetry()
+        for client in self.clients.values():
+            telemetry.merge(client.telemetry)
+        return telemetry
+
+    def dump_client_telemetry(self, path):
+        """Write the merged telemetry of all clients to a JSON file"""
+        with open(path, 'w') as f:
+            f.write(self.client_telemetry().to_json())
 
     def random_client(self):
         return random.choice(list(self.clients.values()))
@@ -334,6 +408,8 @@ class BftTestNetwork:
             self.procs[replica_id] = subprocess.Popen(
                                         self.start_replica_cmd(replica_id),
                                         close_fds=True)
+        # Metrics of a previous run of the replica are stale
+        self.metrics.invalidate(replica_id)
 
     def _start_external_replica(self, replica_id):
         subprocess.run(
@@ -360,6 +436,7 @@ class BftTestNetwork:
             p.wait()
 
         del self.procs[replica_id]
+        self.metrics.invalidate(replica_id)
 
     def _stop_external_replica(self, replica_id):
         subprocess.run(
@@ -433,66 +510,34 @@ class BftTestNetwork:
         """
         Wait for the last agreed view to match the "expected" predicate
         """
-        last_agreed_view = None
+        key = ['replica', 'Gauges', 'lastAgreedView']
         with trio.fail_after(seconds=30):
-            while True:
-                try:
-                    with trio.move_on_after(seconds=1):
-                        key = ['replica', 'Gauges', 'lastAgreedView']
-                        view = await self.metrics.get(replica_id, *key)
-                        if expected(view):
-                            last_agreed_view = view
-                            break
-                except KeyError:
-                    # metrics not yet available, continue looping
-                    continue
-        return last_agreed_view
+            return await self._wait_for_metric(replica_id, key, expected)
 
     async def _wait_for_active_view(self, view):
         """
         Wait for a view to become active on enough (n-f) replicas
         """
-        with trio.fail_after(seconds=30):
-            while True:
-                nb_replicas_in_view = await self._count_replicas_in_view(view)
-
-                # wait for n-f = 2f+2c+1 replicas to be in the expected view
-                if nb_replicas_in_view >= 2 * self.config.f + 2 * self.config.c + 1:
-                    break
-        return nb_replicas_in_view
-
-    async def _count_replicas_in_view(self, view):
-        """
-        Count the number of replicas that have activated a given view
-        """
+        key = ('replica', 'Gauges', 'currentActiveView')
+        # n-f = 2f+2c+1 replicas
+        quorum = 2 * self.config.f + 2 * self.config.c + 1
         nb_replicas_in_view = 0
 
-        async def count_if_replica_in_view(r, expected_view):
-            """
-            A closure that allows concurrent counting of replicas
-            that have activated a given view.
-            """
+        async def wait_for_replica_in_view(r, cancel_scope):
             nonlocal nb_replicas_in_view
+            await self.watcher.wait_for(r, lambda s: s.get(*key) == view)
+            nb_replicas_in_view += 1
+            if nb_replicas_in_view >= quorum:
+                cancel_scope.cancel()
 
-            key = ['replica', 'Gauges', 'currentActiveView']
-
-            with trio.move_on_after(seconds=5):
-                while True:
-                    with trio.move_on_after(seconds=1):
-                        try:
-                            replica_view = await self.metrics.get(r, *key)
-                            if replica_view == expected_view:
-                                nb_replicas_in_view += 1
-                        except KeyError:
-                            # metrics not yet available, continue looping
-                            continue
-                        else:
-                            break
-
-        async with trio.open_nursery() as nursery:
-            for r in self.get_live_replicas():
-                nursery.start_soon(
-                    count_if_replica_in_view, r, view)
+        with trio.fail_after(seconds=30):
+            async with trio.open_nursery() as nursery:
+                for r in self.get_live_replicas():
+                    nursery.start_soon(wait_for_replica_in_view, r,
+                                       nursery.cancel_scope)
+        if nb_replicas_in_view < quorum:
+            # Too few replicas are alive to form a quorum in the view
+            raise trio.TooSlowError
         return nb_replicas_in_view
 
     def force_quorum_including_replica(self, replica_id, primary=0):
@@ -520,13 +565,12 @@ class BftTestNetwork:
 
         Returns the current source replica for state transfer.
         """
+        state = ('bc_state_transfer', 'Statuses', 'fetching_state')
         with trio.fail_after(10): # seconds
-            while True:
-                with trio.move_on_after(.5): # seconds
-                    is_fetching = await self.is_fetching(replica_id)
-                    source_replica_id = await self.source_replica(replica_id)
-                    if is_fetching:
-                        return source_replica_id
+            snapshot = await self.watcher.wait_for(
+                replica_id, lambda s: s.get(*state) != "NotFetching")
+        return snapshot.get('bc_state_transfer', 'Gauges',
+                            'current_source_replica')
 
     async def is_fetching(self, replica_id):
         """Return whether the current replica is fetching state"""
@@ -543,8 +587,8 @@ class BftTestNetwork:
 
     async def wait_for_state_transfer_to_start(self):
         """
-        Retry checking every .5 seconds until state transfer starts at least one
-        node. Stop trying, and fail the test after 30 seconds.
+        Wait until state transfer starts on at least one node. Fail the test
+        after 30 seconds.
         """
         with trio.fail_after(30): # seconds
             async with trio.open_nursery() as nursery:
@@ -558,15 +602,9 @@ class BftTestNetwork:
         Check metrics to see if state transfer started. If so cancel the
         concurrent coroutines in the request scope.
         """
-        while True:
-            with trio.move_on_after(.5): # seconds
-                try:
-                    key = ['replica', 'Counters', 'receivedStateTransferMsgs']
-                    n = await self.metrics.get(replica.id, *key)
-                    if n > 0:
-                        cancel_scope.cancel()
-                except KeyError:
-                    continue # metrics not yet available, continue looping
+        key = ('replica', 'Counters', 'receivedStateTransferMsgs')
+        await self.watcher.wait_for(replica.id, lambda s: s.get(*key) > 0)
+        cancel_scope.cancel()
 
     async def wait_for_state_transfer_to_stop(
             self,
@@ -580,38 +618,13 @@ class BftTestNetwork:
             else:
                 key = ['replica', 'Gauges', 'lastExecutedSeqNum']
             expected_seq_num = await self.metrics.get(up_to_date_node, *key)
-            last_n = -1
-            while True:
-                with trio.move_on_after(.5): # seconds
-                    metrics = await self.metrics.get_all(stale_node)
-                    try:
-                        n = self.metrics.get_local(metrics, *key)
-                    except KeyError:
-                        # ignore - the metric will eventually become available
-                        pass
-                    else:
-                        # Debugging
-                        if n != last_n:
-                            last_n = n
-                            checkpoint = ['bc_state_transfer',
-                                    'Gauges', 'last_stored_checkpoint']
-                            on_transferring_complete = ['bc_state_transfer',
-                                    'Counters', 'on_transferring_complete']
-                            print("wait_for_st_to_stop: expected_seq_num={} "
-                                  "last_stored_checkpoint={} "
-                                  "on_transferring_complete_count={}".format(
-                                        n,
-                                        self.metrics.get_local(metrics, *checkpoint),
-                                        self.metrics.get_local(metrics,
-                                            *on_transferring_complete)))
-                        # Exit condition
-                        if n >= expected_seq_num:
-                           return
+            await self.watcher.wait_for(
+                stale_node, lambda s: s.get(*key) >= expected_seq_num)
 
     async def wait_for_replicas_to_checkpoint(self, replica_ids, checkpoint_num):
         """
         Wait for every replica in `replicas` to take a checkpoint.
-        Check every .5 seconds and give fail after 30 seconds.
+        Fail after 30 seconds.
         """
         with trio.fail_after(30): # seconds
             async with trio.open_nursery() as nursery:
@@ -626,56 +639,42 @@ class BftTestNetwork:
         """
         key = ['bc_state_transfer', 'Gauges', 'last_stored_checkpoint']
         with trio.fail_after(30):
-            while True:
-                with trio.move_on_after(.5): # seconds
-                    last_stored_checkpoint = await self.metrics.get(replica_id, *key)
-                    if expected_checkpoint_num is None \
-                            or last_stored_checkpoint == expected_checkpoint_num:
-                        return last_stored_checkpoint
+            return await self._wait_for_metric(
+                replica_id, key,
+                lambda checkpoint: expected_checkpoint_num is None
+                                   or checkpoint == expected_checkpoint_num)
+
+    async def _wait_for_metric(self, replica_id, key, expected):
+        """
+        Wait for a metric of a replica to match the "expected" predicate, and
+        return its value
+        """
+        snapshot = await self.watcher.wait_for(
+            replica_id, lambda s: expected(s.get(*key)))
+        return snapshot.get(*key)
 
     async def wait_for_slow_path_to_be_prevalent(
             self, as_of_seq_num=1, nb_slow_paths_so_far=0, replica_id=0):
         with trio.fail_after(seconds=5):
-            while True:
-                with trio.move_on_after(seconds=.5):
-                    try:
-                        await self.assert_slow_path_prevalent(
-                            as_of_seq_num, nb_slow_paths_so_far, replica_id)
-                    except (KeyError, AssertionError):
-                        # continue polling
-                        continue
-                    else:
-                        # slow path prevalent - done.
-                        break
+            await self.watcher.wait_for(
+                replica_id,
+                lambda s: self._is_slow_path_prevalent(
+                    s, as_of_seq_num, nb_slow_paths_so_far))
 
     async def wait_for_fast_path_to_be_prevalent(
             self, nb_slow_paths_so_far=0, replica_id=0):
         with trio.fail_after(seconds=5):
-            while True:
-                with trio.move_on_after(seconds=.5):
-                    try:
-                        await self.assert_fast_path_prevalent(
-                            nb_slow_paths_so_far, replica_id)
-                    except (KeyError, AssertionError):
-                        # continue polling
-                        continue
-                    else:
-                        # fast path prevalent - done.
-                        break
+            await self.watcher.wait_for(
+                replica_id,
+                lambda s: self._is_fast_path_prevalent(
+                    s, nb_slow_paths_so_far))
 
     async def wait_for_last_executed_seq_num(self, replica_id=0, expected=0):
+        key = ('replica', 'Gauges', 'lastExecutedSeqNum')
         with trio.fail_after(seconds=30):
-            while True:
-                with trio.move_on_after(seconds=.5):
-                    try:
-                        key = ['replica', 'Gauges', 'lastExecutedSeqNum']
-                        last_executed_seq_num = await self.metrics.get(replica_id, *key)
-                    except KeyError:
-                        continue
-                    else:
-                        # success!
-                        if last_executed_seq_num >= expected:
-                            return last_executed_seq_num
+            snapshot = await self.watcher.wait_for(
+                replica_id, lambda s: s.get(*key) >= expected)
+        return snapshot.get(*key)
 
     async def assert_state_transfer_not_started_all_up_nodes(self, up_replica_ids):
         with trio.fail_after(METRICS_TIMEOUT_SEC):
@@ -691,29 +690,36 @@ class BftTestNetwork:
         Asserts there is at most 1 sequence processed on the slow path,
         given the "nb_slow_paths_so_far".
         """
-        metric_key = ['replica', 'Counters', 'slowPathCount']
-        total_nb_slow_paths = await self.metrics.get(replica_id, *metric_key)
-        assert total_nb_slow_paths >= nb_slow_paths_so_far
-
-        assert total_nb_slow_paths - nb_slow_paths_so_far <= 1, \
+        snapshot = await self.metrics.snapshot(
+            replica_id, (('replica', 'Counters', 'slowPathCount'),))
+        assert self._is_fast_path_prevalent(snapshot, nb_slow_paths_so_far), \
             f'Fast path is not prevalent for n={self.config.n}, f={self.config.f}, c={self.config.c}.'
 
+    @staticmethod
+    def _is_fast_path_prevalent(snapshot, nb_slow_paths_so_far):
+        total_nb_slow_paths = snapshot.get('replica', 'Counters', 'slowPathCount')
+        return nb_slow_paths_so_far <= total_nb_slow_paths <= nb_slow_paths_so_far + 1
+
     async def assert_slow_path_prevalent(
             self, as_of_seq_num=1, nb_slow_paths_so_far=0, replica_id=0):
         """
         Asserts all executed sequences after "as_of_seq_num" have been processed on the slow path,
         given the "nb_slow_paths_so_far".
         """
-        metric_key = ['replica', 'Gauges', 'lastExecutedSeqNum']
-        total_nb_executed_sequences = await self.metrics.get(replica_id, *metric_key)
-
-        metric_key = ['replica', 'Counters', 'slowPathCount']
-        total_nb_slow_paths = await self.metrics.get(replica_id, *metric_key)
-        assert total_nb_slow_paths >= nb_slow_paths_so_far
-
-        assert total_nb_slow_paths - nb_slow_paths_so_far >= total_nb_executed_sequences - as_of_seq_num, \
+        snapshot = await self.metrics.snapshot(
+            replica_id, (('replica', 'Gauges', 'lastExecutedSeqNum'),
+                         ('replica', 'Counters', 'slowPathCount')))
+        assert self._is_slow_path_prevalent(snapshot, as_of_seq_num, nb_slow_paths_so_far), \
             f'Slow path is not prevalent for n={self.config.n}, f={self.config.f}, c={self.config.c}.'
 
+    @staticmethod
+    def _is_slow_path_prevalent(snapshot, as_of_seq_num, nb_slow_paths_so_far):
+        total_nb_executed_sequences, total_nb_slow_paths = snapshot.get_many(
+            ['replica', 'Gauges', 'lastExecutedSeqNum'],
+            ['replica', 'Counters', 'slowPathCount'])
+        return total_nb_slow_paths >= nb_slow_paths_so_far and \
+            total_nb_slow_paths - nb_slow_paths_so_far >= total_nb_executed_sequences - as_of_seq_num
+
     async def _assert_state_transfer_not_started(self, replica):
         key = ['replica', 'Counters', 'receivedStateTransferMsgs']
         n = await self.metrics.get(replica.id, *key)
@@ -742,13 +748,8 @@ class BftTestNetwork:
         """
         Returns the total number of requests processed on the slow commit path
         """
+        metric_key = ('replica', 'Counters', 'slowPathCount')
         with trio.fail_after(seconds=5):
-            while True:
-                with trio.move_on_after(seconds=.5):
-                    try:
-                        metric_key = ['replica', 'Counters', 'slowPathCount']
-                        nb_slow_path = await self.metrics.get(0, *metric_key)
-                        return nb_slow_path
-                    except KeyError:
-                        # metrics not yet available, continue looping
-                        pass
+            snapshot = await self.watcher.wait_for(
+                0, lambda s: metric_key in s)
+        return snapshot.get(*metric_key)
@@ -12,12 +12,180 @@
 
 # Add the pyclient directory to $PYTHONPATH
 
+import trio
+
+from bft_metrics_client import histogram_bucket_bounds, histogram_percentile
+
+# Readers of a replica's metrics share a snapshot that is younger than this
+# many seconds, rather than fetching a new one
+SNAPSHOT_TTL = 0.1
+
+class Histogram:
+    """
+    The distribution of a histogram metric, decoded from its value in a
+    metrics dump.
+
+    Percentiles are estimated from the bucket of the value at that rank, so
+    they are within 1/2**bft_metrics_client.HISTOGRAM_SUB_BUCKET_BITS of the
+    exact value.
+    Subtracting a previous Histogram of the same metric gives the
+    distribution of the values recorded in between.
+    """
+
+    def __init__(self, value):
+        self.count = value['count']
+        self.sum = value['sum']
+        self.min = value['min']
+        self.max = value['max']
+        # Counts of the non-empty buckets by index
+        self.buckets = {index: count for index, count in value['buckets']
+                        if count}
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else 0
+
+    def percentile(self, p):
+        """
+        Return an estimate of the value below which p percent of the recorded
+        values fall, or None if nothing was recorded
+        """
+        return histogram_percentile(self.buckets, p, self.min, self.max)
+
+    def __sub__(self, previous):
+        if self.count < previous.count:
+            # The replica restarted, so every value is new
+            return self
+        buckets = [[index, count - previous.buckets.get(index, 0)]
+                   for index, count in self.buckets.items()]
+        buckets = [bucket for bucket in buckets if bucket[1] > 0]
+        if buckets:
+            # The exact extremes of the interval aren't known
+            low, _ = histogram_bucket_bounds(min(buckets)[0])
+            _, high = histogram_bucket_bounds(max(buckets)[0])
+            min_, max_ = max(low, self.min), min(high, self.max)
+        else:
+            min_ = max_ = 0
+        return Histogram({'count': self.count - previous.count,
+                          'sum': self.sum - previous.sum,
+                          'min': min_, 'max': max_, 'buckets': buckets})
+
+
+class MetricsSnapshot:
+    """
+    The metrics of a replica at one point in time, as dumped by its
+    Aggregator, indexed by (component, type, key) when it's created.
+
+    `time` is the trio clock time at which the dump was requested. It's
+    used to compute rates between snapshots.
+    """
+
+    def __init__(self, metrics, time=None):
+        # The parsed JSON dump, as returned by MetricsClient.get
+        self.metrics = metrics
+        self.time = trio.current_time() if time is None else time
+        self._index = dict()
+        for component in metrics['Components']:
+            name = component['Name']
+            for type_, values in component.items():
+                if type_ == 'Name':
+                    continue
+                for key, value in values.items():
+                    self._index[(name, type_, key)] = value
+
+    def __contains__(self, metric):
+        return tuple(metric) in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def get(self, component_name, type_, key):
+        """
+        Return the value of a metric. Raise KeyError if the replica doesn't
+        have it.
+        """
+        return self._index[(component_name, type_, key)]
+
+    def get_many(self, *metrics):
+        """
+        Return the values of several metrics, given as (component, type, key)
+        sequences, in order. Raise KeyError if any is missing.
+        """
+        index = self._index
+        return [index[tuple(metric)] for metric in metrics]
+
+    def histogram(self, component_name, key):
+        """Return the Histogram of a histogram metric"""
+        return Histogram(self.get(component_name, 'Histograms', key))
+
+    def items(self, type_=None):
+        """Return ((component, type, key), value) pairs, of a type if given"""
+        return [(metric, value) for metric, value in self._index.items()
+                if type_ is None or metric[1] == type_]
+
+    def deltas(self, previous):
+        """
+        Return the increase of each counter since a previous snapshot, keyed
+        by (component, 'Counters', key). A counter that is smaller than
+        before was reset by a restart, so its increase is its current value.
+        Counters that are new since the previous snapshot are left out.
+        """
+        deltas = dict()
+        for metric, value in self.items('Counters'):
+            before = previous._index.get(metric)
+            if before is None:
+                continue
+            deltas[metric] = value - before if value >= before else value
+        return deltas
+
+    def rates(self, previous):
+        """
+        Return the increase per second of each counter since a previous
+        snapshot, keyed like `deltas`.
+        """
+        interval = self.time - previous.time
+        if interval <= 0:
+            raise ValueError("snapshots must be taken at different times")
+        return {metric: delta / interval
+                for metric, delta in self.deltas(previous).items()}
+
+
+class _Fetch:
+    """A fetch of a replica's metrics that concurrent readers wait for"""
+
+    def __init__(self):
+        self.done = trio.Event()
+        # None if the fetch failed or was cancelled
+        self.snapshot = None
+
+
 class BftMetrics:
-    """ A wrapper class that helps to access individual metrics """
+    """
+    A wrapper class that helps to access individual metrics
+
+    Metrics are read from MetricsSnapshots of a replica. `get` and `get_many`
+    ask the replica for the keys they read only, and `snapshot` and `get_all`
+    for all its metrics. A snapshot is shared by all readers of the same keys
+    for `ttl` seconds from when it was requested, and concurrent readers of a
+    replica without a fresh snapshot wait for a single fetch, so many waiters
+    polling the same replica cost one request to its MetricsServer and one
+    parse of the reply per ttl. A fresh snapshot of all the metrics serves
+    every reader. A ttl of 0 still coalesces concurrent fetches.
+    """
 
-    def __init__(self, clients):
+    def __init__(self, clients, ttl=SNAPSHOT_TTL):
         # clients is a dictionary of MetricsClient by replica_id
         self.clients = clients
+        self.ttl = ttl
+        # The latest MetricsSnapshot of each replica and query, where a query
+        # is a tuple of (component, type, key) or None for all the metrics
+        self._snapshots = dict()
+        # The in-flight _Fetch of each replica and query
+        self._fetches = dict()
+        # A MetricsClient can only wait for one reply at a time
+        self._locks = {replica_id: trio.Lock() for replica_id in clients}
+        # The number of requests sent to all replicas
+        self.fetches = 0
 
     def __enter__(self):
         """context manager method for 'with' statements"""
@@ -33,15 +201,86 @@ class BftMetrics:
         Return the value of a key of given type for the given component at
         the given replica.
         """
-        metrics = await self.clients[replica_id].get()
-        return self.get_local(metrics, component_name, type_, key)
+        metric = (component_name, type_, key)
+        snapshot = await self.snapshot(replica_id, (metric,))
+        return snapshot.get(*metric)
+
+    async def get_histogram(self, replica_id, component_name, key):
+        """
+        Return the Histogram of a histogram metric of the given component at
+        the given replica.
+        """
+        value = await self.get(replica_id, component_name, 'Histograms', key)
+        return Histogram(value)
+
+    async def get_many(self, replica_id, *metrics):
+        """
+        Return the values of several (component, type, key) metrics of a
+        replica, read from the same snapshot.
+        """
+        query = tuple(tuple(metric) for metric in metrics)
+        snapshot = await self.snapshot(replica_id, query)
+        return snapshot.get_many(*metrics)
 
     async def get_all(self, replica_id):
         """Return all the metrics from a given replica"""
-        return await self.clients[replica_id].get()
+        snapshot = await self.snapshot(replica_id)
+        return snapshot.metrics
+
+    async def snapshot(self, replica_id, query=None):
+        """
+        Return a MetricsSnapshot of a replica requested less than `ttl`
+        seconds ago, fetching one if there is none. The snapshot has all the
+        metrics, or at least those of a query of (component, type, key)
+        tuples.
+        """
+        while True:
+            for cached_query in (None, query):
+                cached = self._snapshots.get((replica_id, cached_query))
+                if cached is not None \
+                        and trio.current_time() - cached.time < self.ttl:
+                    return cached
+            fetch = self._fetches.get((replica_id, query))
+            if fetch is None:
+                return await self._fetch(replica_id, query)
+            await fetch.done.wait()
+            if fetch.snapshot is not None:
+                return fetch.snapshot
+            # The reader that started the fetch was cancelled, so try again
+
+    async def _fetch(self, replica_id, query):
+        fetch = _Fetch()
+        self._fetches[(replica_id, query)] = fetch
+        try:
+            async with self._locks[replica_id]:
+                requested = trio.current_time()
+                self.fetches += 1
+                metrics = await self.clients[replica_id].get(query)
+            fetch.snapshot = MetricsSnapshot(metrics, requested)
+            self._snapshots[(replica_id, query)] = fetch.snapshot
+            return fetch.snapshot
+        finally:
+            del self._fetches[(replica_id, query)]
+            fetch.done.set()
+
+    def invalidate(self, replica_id=None):
+        """
+        Drop the snapshots of a replica, or of all replicas, so that the next
+        read fetches a new one.
+        """
+        if replica_id is None:
+            self._snapshots.clear()
+        else:
+            for key in [key for key in self._snapshots if key[0] == replica_id]:
+                del self._snapshots[key]
 
     def get_local(self, metrics, component_name, type_, key):
-        """Extract a metric from a set of metrics"""
+        """
+        Extract a metric from a MetricsSnapshot, or from a set of metrics as
+        returned by get_all
+        """
+        if isinstance(metrics, MetricsSnapshot):
+            return metrics.get(component_name, type_, key)
         for component in metrics['Components']:
             if component['Name'] == component_name:
                 return component[type_][key]
@@ -0,0 +1,210 @@
+# Concord
+#
+# Copyright (c) 2020 VMware, Inc. All Rights Reserved.
+#
+# This product is licensed to you under the Apache 2.0 license (the "License").
+# You may not use this product except in compliance with the Apache 2.0 License.
+#
+# This product may include a number of subcomponents with separate copyright
+# notices and license terms. Your use of these subcomponents is subject to the
+# terms and conditions of the subcomponent's license, as noted in the LICENSE
+# file.
+
+import random
+
+import trio
+
+# util.bft adds the pyclient directory to the path
+from util import bft
+from util import skvbc as kvbc
+import bft_telemetry
+
+# Arrival schedules
+FIXED = 'fixed'
+POISSON = 'poisson'
+
+# A rate is past the saturation knee if any request times out or doesn't
+# complete, if the throughput is less than KNEE_THROUGHPUT_RATIO of the rate
+# the schedule actually offered, or if its p99 latency exceeds
+# KNEE_LATENCY_FACTOR times the p99 latency at the lowest rate.
+KNEE_THROUGHPUT_RATIO = 0.95
+KNEE_LATENCY_FACTOR = 5
+
+
+def arrival_times(rate, duration, schedule=FIXED, rng=random):
+    """
+    Yield the intended send times, in seconds from the start of a run, of
+    requests arriving at `rate` per second for `duration` seconds.
+
+    A FIXED schedule spaces requests evenly. A POISSON schedule draws
+    exponentially distributed gaps with the same mean.
+    """
+    if schedule == FIXED:
+        for i in range(int(rate * duration)):
+            yield i / rate
+    elif schedule == POISSON:
+        t = rng.expovariate(rate)
+        while t < duration:
+            yield t
+            t += rng.expovariate(rate)
+    else:
+        raise ValueError(f'Unknown arrival schedule: {schedule}')
+
+
+class OpenLoopResult:
+    """The outcome of running an open-loop load at a single rate"""
+
+    def __init__(self, rate, duration, schedule):
+        self.rate = rate
+        self.duration = duration
+        self.schedule = schedule
+        self.sent = 0
+        self.completed = 0
+        self.timeouts = 0
+        # Requests that were still queued or in flight when the run ended
+        self.incomplete = 0
+        # Time from the start of the run until the later of the end of the
+        # schedule and the completion of the last request
+        self.elapsed = None
+        self.last_completion = None
+        # Latencies measured from the intended send time, which include the
+        # time spent waiting for a free client
+        self.latency = bft_telemetry.LatencyHistogram()
+        # Latencies measured from the actual send time
+        self.service_time = bft_telemetry.LatencyHistogram()
+        # The largest number of requests waiting for a free client
+        self.max_backlog = 0
+
+    @property
+    def offered_rate(self):
+        """Requests per second issued by the schedule"""
+        return self.sent / self.duration
+
+    @property
+    def throughput(self):
+        """Completed requests per second"""
+        if not self.elapsed:
+            return 0
+        return self.completed / self.elapsed
+
+    def to_dict(self):
+        return {'rate': self.rate,
+                'duration': self.duration,
+                'schedule': self.schedule,
+                'sent': self.sent,
+                'offered_rate': self.offered_rate,
+                'completed': self.completed,
+                'timeouts': self.timeouts,
+                'incomplete': self.incomplete,
+                'throughput': self.throughput,
+                'max_backlog': self.max_backlog,
+                'latency': self.latency.to_dict(),
+                'service_time': self.service_time.to_dict()}
+
+
+class OpenLoopLoadGenerator:
+    """
+    Issue SimpleKVBC requests on an arrival schedule that doesn't depend on
+    replies, unlike the closed-loop workloads of SkvbcTracker.
+
+    Each request is assigned an intended send time by the schedule. At that
+    time it takes a free client from the pool, waiting if all clients are
+    busy, since each UdpClient has a single outstanding request. Latency is
+    measured from the intended send time, so queueing delay under overload is
+    reported rather than hidden (coordinated omission).
+    """
+
+    def __init__(self, bft_network, write_weight=.70, clients=None, rng=None):
+        self.bft_network = bft_network
+        self.protocol = kvbc.SimpleKVBCProtocol(bft_network)
+        self.write_weight = write_weight
+        self.clients = list(clients if clients is not None
+                            else bft_network.clients.values())
+        self.rng = rng if rng is not None else random.Random()
+        self._backlog = 0
+
+    async def run(self, rate, duration, schedule=FIXED, drain_timeout=None):
+        """
+        Offer `rate` requests per second for `duration` seconds and return an
+        OpenLoopResult.
+
+        Once the schedule ends, outstanding requests get `drain_timeout`
+        seconds to complete, by default the request timeout of the clients.
+        Requests that don't complete by then are counted as incomplete.
+        """
+        if drain_timeout is None:
+            drain_timeout = bft.REQ_TIMEOUT_MILLI/1000
+        result = OpenLoopResult(rate, duration, schedule)
+        free_clients, next_client = trio.open_memory_channel(len(self.clients))
+        for client in self.clients:
+            free_clients.send_nowait(client)
+        self._backlog = 0
+
+        start = trio.current_time()
+        async with trio.open_nursery() as nursery:
+            for offset in arrival_times(rate, duration, schedule, self.rng):
+                intended = start + offset
+                await trio.sleep_until(intended)
+                result.sent += 1
+                nursery.start_soon(self._request, intended, start, result,
+                                   free_clients, next_client)
+            with trio.move_on_after(drain_timeout):
+                while result.completed + result.timeouts < result.sent:
+                    await trio.sleep(.01)
+            nursery.cancel_scope.cancel()
+        result.incomplete = result.sent - result.completed - result.timeouts
+        result.elapsed = max(duration, result.last_completion or 0)
+        return result
+
+    async def find_knee(self, rates, duration, schedule=FIXED,
+                        throughput_ratio=KNEE_THROUGHPUT_RATIO,
+                        latency_factor=KNEE_LATENCY_FACTOR):
+        """
+        Run the load at each rate in increasing order, until the cluster
+        saturates. Return the highest rate that didn't saturate, or None if
+        the lowest one did, and the OpenLoopResult of every rate that was run.
+        """
+        results = []
+        knee = None
+        baseline_p99 = None
+        for rate in sorted(rates):
+            result = await self.run(rate, duration, schedule)
+            results.append(result)
+            p99 = result.latency.percentile(99)
+            if baseline_p99 is None:
+                baseline_p99 = p99
+            if p99 is None \
+                    or result.incomplete > 0 or result.timeouts > 0 \
+                    or result.throughput < throughput_ratio * result.offered_rate \
+                    or p99 > latency_factor * baseline_p99:
+                break
+            knee = rate
+        return knee, results
+
+    async def _request(self, intended, start, result, free_clients, next_client):
+        self._backlog += 1
+        result.max_backlog = max(result.max_backlog, self._backlog)
+        client = await next_client.receive()
+        self._backlog -= 1
+        try:
+            sent = trio.current_time()
+            try:
+                if self.rng.random() < self.write_weight:
+                    await client.write(self._write_req())
+                else:
+                    await client.read(self.protocol.read_req(
+                        [self.protocol.random_key()]))
+            except trio.TooSlowError:
+                result.timeouts += 1
+                return
+            done = trio.current_time()
+            result.latency.record(done - intended)
+            result.service_time.record(done - sent)
+            result.completed += 1
+            result.last_completion = done - start
+        finally:
+            free_clients.send_nowait(client)
+
+    def _write_req(self):
+        return self.protocol.write_req(
+            [], [(self.protocol.random_key(), self.protocol.random_value())], 0)
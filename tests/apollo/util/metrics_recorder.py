@@ -0,0 +1,200 @@
+# Concord
+#
+# Copyright (c) 2020 VMware, Inc. All Rights Reserved.
+#
+# This product is licensed to you under the Apache 2.0 license (the "License").
+# You may not use this product except in compliance with the Apache 2.0 License.
+#
+# This product may include a number of subcomponents with separate copyright
+# notices and license terms. Your use of these subcomponents is subject to the
+# terms and conditions of the subcomponent's license, as noted in the LICENSE
+# file.
+
+from array import array
+import json
+import math
+import time
+
+import trio
+
+# util.bft adds the pyclient directory to the path
+import bft_metrics_client
+
+# How often the metrics of every replica are sampled, in seconds
+SAMPLE_INTERVAL = 1.0
+
+# The types of metrics that are recorded. Statuses aren't numeric, and
+# histograms are better read directly at the end of a run.
+RECORDED_TYPES = ('Gauges', 'Counters')
+
+MISSING = math.nan
+
+
+class _ReplicaSeries:
+    """
+    The samples of one replica, stored by column: a timestamp array, and a
+    value array of the same length for every metric. Values of a metric that
+    was missing from a sample, e.g. before its component was registered, are
+    NaN.
+    """
+
+    def __init__(self):
+        self.times = array('d')
+        # An array('d') by (component, type, key)
+        self.columns = dict()
+
+    def add(self, time, snapshot):
+        num_samples = len(self.times)
+        self.times.append(time)
+        columns = self.columns
+        for metric, value in snapshot.items():
+            if metric[1] not in RECORDED_TYPES:
+                continue
+            column = columns.get(metric)
+            if column is None:
+                column = array('d', [MISSING]) * num_samples
+                columns[metric] = column
+            column.append(value)
+        for column in columns.values():
+            if len(column) == num_samples:
+                column.append(MISSING)
+
+    def rates(self, metric):
+        """
+        Return the increase per second of a counter between consecutive
+        samples, one less than the number of samples. A counter that is
+        smaller than before was reset by a restart, so its increase is its
+        current value.
+        """
+        times = self.times
+        values = self.columns[metric]
+        rates = array('d')
+        for i in range(1, len(times)):
+            before, value = values[i - 1], values[i]
+            if math.isnan(before) or math.isnan(value):
+                rates.append(MISSING)
+                continue
+            delta = value - before if value >= before else value
+            rates.append(delta / (times[i] - times[i - 1]))
+        return rates
+
+
+def _to_json_list(values):
+    return [None if math.isnan(value) else value for value in values]
+
+
+class MetricsRecorder:
+    """
+    Sample the metrics of every live replica every `interval` seconds in the
+    background, so that throughput, views and checkpoints can be charted
+    over a run and compared between runs.
+
+    `replica_ids` is a function that returns the ids of the replicas to
+    sample, since replicas are started and stopped during a test. Samples are
+    read with BftMetrics.snapshot, so they share fetches with the test
+    itself. A replica that doesn't reply within the interval is skipped for
+    that sample.
+
+    Use it as an async context manager. If `path` is given, the series are
+    written there as JSON on exit.
+    """
+
+    def __init__(self, metrics, replica_ids, interval=SAMPLE_INTERVAL,
+                 path=None):
+        self.metrics = metrics
+        self.replica_ids = replica_ids
+        self.interval = interval
+        self.path = path
+        # A _ReplicaSeries by replica id
+        self.replicas = dict()
+        # The trio clock and wall clock times of the start of recording.
+        # Sample times are in seconds since the start.
+        self.start = None
+        self.wall_start = None
+        self._nursery_manager = None
+
+    async def __aenter__(self):
+        self._nursery_manager = trio.open_nursery()
+        nursery = await self._nursery_manager.__aenter__()
+        self._nursery = nursery
+        nursery.start_soon(self.run)
+        return self
+
+    async def __aexit__(self, *args):
+        self._nursery.cancel_scope.cancel()
+        try:
+            return await self._nursery_manager.__aexit__(*args)
+        finally:
+            if self.path is not None:
+                self.dump(self.path)
+
+    async def run(self):
+        """Sample every replica until cancelled"""
+        self.start = trio.current_time()
+        self.wall_start = time.time()
+        while True:
+            deadline = trio.current_time() + self.interval
+            async with trio.open_nursery() as nursery:
+                for replica_id in self.replica_ids():
+                    nursery.start_soon(self._sample, replica_id, deadline)
+            await trio.sleep_until(deadline)
+
+    async def _sample(self, replica_id, deadline):
+        with trio.move_on_at(deadline):
+            try:
+                snapshot = await self.metrics.snapshot(replica_id)
+            except bft_metrics_client.MetricsError:
+                return
+            series = self.replicas.setdefault(replica_id, _ReplicaSeries())
+            sample_time = snapshot.time - self.start
+            # The test may have shared a snapshot that is older than the
+            # start, or that was already recorded
+            if sample_time < 0 or \
+                    (series.times and sample_time <= series.times[-1]):
+                return
+            series.add(sample_time, snapshot)
+
+    def series(self, replica_id, component_name, type_, key):
+        """
+        Return the sample times of a replica and the values of one of its
+        metrics at those times, as arrays
+        """
+        series = self.replicas[replica_id]
+        return series.times, series.columns[(component_name, type_, key)]
+
+    def rates(self, replica_id, component_name, key):
+        """
+        Return the times of a replica's samples after the first, and the rate
+        of a counter in the interval before each, as arrays
+        """
+        series = self.replicas[replica_id]
+        rates = series.rates((component_name, 'Counters', key))
+        return series.times[1:], rates
+
+    def to_dict(self):
+        """
+        Return the series in a JSON-compatible dict. Each replica has its
+        sample times, and the values of each gauge and counter and the rates
+        of each counter by component. Missing values are None.
+        """
+        replicas = dict()
+        for replica_id, series in self.replicas.items():
+            components = dict()
+            for metric, values in series.columns.items():
+                component_name, type_, key = metric
+                component = components.setdefault(
+                    component_name, {type_: dict() for type_ in RECORDED_TYPES})
+                component[type_][key] = _to_json_list(values)
+                if type_ == 'Counters':
+                    component.setdefault('Rates', dict())[key] = \
+                        _to_json_list(series.rates(metric))
+            replicas[str(replica_id)] = {'time': list(series.times),
+                                         'components': components}
+        return {'start': self.wall_start,
+                'interval': self.interval,
+                'replicas': replicas}
+
+    def dump(self, path):
+        """Write the series to a JSON file"""
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f)
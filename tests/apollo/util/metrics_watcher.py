@@ -0,0 +1,209 @@
+# Concord
+#
+# Copyright (c) 2020 VMware, Inc. All Rights Reserved.
+#
+# This product is licensed to you under the Apache 2.0 license (the "License").
+# You may not use this product except in compliance with the Apache 2.0 License.
+#
+# This product may include a number of subcomponents with separate copyright
+# notices and license terms. Your use of these subcomponents is subject to the
+# terms and conditions of the subcomponent's license, as noted in the LICENSE
+# file.
+
+import trio
+
+# A replica is polled at most every MIN_INTERVAL seconds, while the metrics
+# its conditions read are changing, and at least every MAX_INTERVAL seconds.
+MIN_INTERVAL = 0.25
+MAX_INTERVAL = 0.8
+
+# A poll of a replica that takes longer than this many seconds is abandoned,
+# e.g. while the replica is down
+POLL_TIMEOUT = 1.0
+
+
+def _value(snapshot, metric):
+    return snapshot.get(*metric) if metric in snapshot else None
+
+
+class _RecordingSnapshot:
+    """
+    A MetricsSnapshot that remembers the metrics read from it, so that the
+    watcher can tell whether the inputs of a condition changed
+    """
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.time = snapshot.time
+        self.read = set()
+
+    def __contains__(self, metric):
+        self.read.add(tuple(metric))
+        return metric in self.snapshot
+
+    def get(self, component_name, type_, key):
+        self.read.add((component_name, type_, key))
+        return self.snapshot.get(component_name, type_, key)
+
+    def get_many(self, *metrics):
+        self.read.update(tuple(metric) for metric in metrics)
+        return self.snapshot.get_many(*metrics)
+
+    def histogram(self, component_name, key):
+        self.read.add((component_name, 'Histograms', key))
+        return self.snapshot.histogram(component_name, key)
+
+
+class _Condition:
+    def __init__(self, predicate):
+        self.predicate = predicate
+        self.done = trio.Event()
+        # The snapshot that satisfied the predicate, or the exception it
+        # raised
+        self.snapshot = None
+        self.error = None
+        # The metrics the predicate read the last time it was evaluated, or
+        # None if it wasn't evaluated yet
+        self.read = None
+
+    def evaluate(self, snapshot):
+        recording = _RecordingSnapshot(snapshot)
+        try:
+            satisfied = self.predicate(recording)
+        except KeyError:
+            # The metrics aren't available yet
+            satisfied = False
+        except Exception as e:
+            self.error = e
+            satisfied = True
+        self.read = recording.read
+        if satisfied:
+            self.snapshot = snapshot
+            self.done.set()
+        return satisfied
+
+
+class _ReplicaWatch:
+    """The conditions registered for one replica and the state of its poller"""
+
+    def __init__(self):
+        self.conditions = []
+        self.polling = False
+        self.interval = MIN_INTERVAL
+        # The snapshot of the last poll
+        self.snapshot = None
+        # Set when a condition is added, to poll right away
+        self.added = trio.Event()
+        # Set and replaced after every poll, and when the poller leaves
+        self.polled = trio.Event()
+
+
+class MetricsWatcher:
+    """
+    Wait for conditions over the metrics snapshots of replicas.
+
+    All the conditions of a replica are evaluated by a single polling loop,
+    which reads one BftMetrics snapshot per poll, no matter how many tasks
+    wait. The snapshot is queried for only the metrics that the conditions
+    read. The loop is run by one of the waiting tasks, and is taken over by
+    another when that task's condition is met or it's cancelled, so no
+    background task is needed.
+
+    The polling interval adapts: it drops to MIN_INTERVAL while the metrics
+    that the conditions read change between polls, and when a condition is
+    added, and doubles up to MAX_INTERVAL while they don't.
+    """
+
+    def __init__(self, metrics):
+        # A BftMetrics
+        self.metrics = metrics
+        # A _ReplicaWatch by replica id
+        self._watches = dict()
+        # The number of snapshots read by all polling loops
+        self.polls = 0
+
+    async def wait_for(self, replica_id, predicate):
+        """
+        Wait until a predicate over a MetricsSnapshot of a replica is true,
+        and return that snapshot. A KeyError from the predicate means the
+        metrics it reads aren't available yet. Any other exception is raised
+        here.
+
+        There is no explicit timeout here. Users should call `with
+        trio.fail_after` as necessary.
+        """
+        watch = self._watches.setdefault(replica_id, _ReplicaWatch())
+        condition = _Condition(predicate)
+        watch.conditions.append(condition)
+        watch.interval = MIN_INTERVAL
+        watch.added.set()
+        try:
+            while not condition.done.is_set():
+                if not watch.polling:
+                    await self._poll(replica_id, watch, condition)
+                else:
+                    await watch.polled.wait()
+        finally:
+            watch.conditions.remove(condition)
+        if condition.error is not None:
+            raise condition.error
+        return condition.snapshot
+
+    async def _poll(self, replica_id, watch, condition):
+        """Poll a replica until a condition is met"""
+        watch.polling = True
+        try:
+            while not condition.done.is_set():
+                watch.added = trio.Event()
+                snapshot = None
+                with trio.move_on_after(POLL_TIMEOUT):
+                    snapshot = await self.metrics.snapshot(
+                        replica_id, self._query(watch))
+                    self.polls += 1
+                if snapshot is not None:
+                    self._evaluate(watch, snapshot)
+                    polled, watch.polled = watch.polled, trio.Event()
+                    polled.set()
+                if condition.done.is_set():
+                    break
+                with trio.move_on_after(watch.interval):
+                    await watch.added.wait()
+        finally:
+            watch.polling = False
+            watch.polled.set()
+            watch.polled = trio.Event()
+
+    @staticmethod
+    def _query(watch):
+        """
+        Return the query of the metrics read by the conditions of a replica,
+        or None to read all the metrics until every condition was evaluated.
+
+        A predicate that reads other metrics than it did before sees them
+        missing, and gets them from the next poll.
+        """
+        metrics = set()
+        for condition in watch.conditions:
+            if condition.done.is_set():
+                continue
+            if condition.read is None:
+                return None
+            metrics.update(condition.read)
+        return tuple(sorted(metrics)) or None
+
+    def _evaluate(self, watch, snapshot):
+        previous = watch.snapshot
+        changed = False
+        for condition in list(watch.conditions):
+            if condition.done.is_set():
+                continue
+            if condition.evaluate(snapshot) or previous is None:
+                continue
+            if any(_value(previous, metric) != _value(snapshot, metric)
+                   for metric in condition.read):
+                changed = True
+        watch.snapshot = snapshot
+        if changed:
+            watch.interval = MIN_INTERVAL
+        else:
+            watch.interval = min(2 * watch.interval, MAX_INTERVAL)
@@ -208,17 +208,14 @@ class SimpleKVBCProtocol:
 
         The nodes are then stopped and restarted to ensure the checkpoint data
         was persisted.
-
-        TODO: Make filling concurrent to speed up tests
         """
         client = SkvbcClient(self.bft_network.random_client())
         checkpoint_before = await self.bft_network.wait_for_checkpoint(
             replica_id=random.choice(initial_nodes))
         # Write enough data to checkpoint and create a need for state transfer
-        for i in range (1 + checkpoint_num * 150):
-            key = self.random_key()
-            val = self.random_value()
-            reply = await client.write([], [(key, val)])
+        writesets = [[(self.random_key(), self.random_value())]
+                     for _ in range(1 + checkpoint_num * 150)]
+        async for _, reply in client.write_many(writesets):
             assert reply.success
         await self.network_wait_for_checkpoint(
             initial_nodes, checkpoint_before + checkpoint_num, verify_checkpoint_persistency)
@@ -340,3 +337,14 @@ class SkvbcClient:
         """Create an skvbc read message and send it via the bft client."""
         req = SimpleKVBCProtocol.read_req(readset, block_id)
         return SimpleKVBCProtocol.parse_reply(await self.client.read(req))
+
+    async def write_many(self, writesets, block_id=0):
+        """
+        Send a batch of unconditional skvbc writes via the bft client and yield
+        a (seq_num, WriteReply) pair for each of them as they complete.
+        """
+        reqs = [SimpleKVBCProtocol.write_req([], writeset, block_id)
+                for writeset in writesets]
+        async for batch_reply in self.client.write_many(reqs):
+            yield (batch_reply.seq_num,
+                   SimpleKVBCProtocol.parse_reply(batch_reply.reply))
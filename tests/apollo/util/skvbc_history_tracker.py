@@ -932,6 +932,28 @@ class SkvbcTracker:
             self.status.record_client_timeout(client_id)
             return
 
+    async def write_and_track_known_kvs(self, kvs, client):
+        """
+        Send a batch of tracked writes, one per kv list in `kvs`, without
+        waiting for each reply before sending the next write.
+        """
+        read_version = self.read_block_id()
+        readset = self.readset(0, 0)
+        msgs = [self.skvbc.write_req(readset, kv, read_version) for kv in kvs]
+        seq_nums = [client.req_seq_num.next() for _ in msgs]
+        client_id = client.client_id
+        for seq_num, kv in zip(seq_nums, kvs):
+            self.send_write(
+                client_id, seq_num, readset, dict(kv), read_version)
+        try:
+            async for batch_reply in client.write_many(msgs, seq_nums):
+                self.status.record_client_reply(client_id)
+                reply = self.skvbc.parse_reply(batch_reply.reply)
+                self.handle_write_reply(client_id, batch_reply.seq_num, reply)
+        except trio.TooSlowError:
+            self.status.record_client_timeout(client_id)
+            return
+
     async def read_and_track_known_kv(self, key, client):
         msg = self.skvbc.read_req([key])
         seq_num = client.req_seq_num.next()
@@ -964,11 +986,9 @@ class SkvbcTracker:
         # there.
         client1 = self.bft_network.random_client()
         # Write enough data to checkpoint and create a need for state transfer
-        for i in range(1 + checkpoints_num * 150):
-            key = self.skvbc.random_key()
-            val = self.skvbc.random_value()
-            kv = [(key, val)]
-            await self.write_and_track_known_kv(kv, client1)
+        kvs = [[(self.skvbc.random_key(), self.skvbc.random_value())]
+               for _ in range(1 + checkpoints_num * 150)]
+        await self.write_and_track_known_kvs(kvs, client1)
 
         await self.skvbc.network_wait_for_checkpoint(initial_nodes, checkpoints_num, persistency_enabled)
 
@@ -1074,6 +1094,11 @@ class PassThroughSkvbcTracker:
         return self.skvbc.parse_reply(await client.write(
             self.skvbc.write_req([], kv, 0)))
 
+    async def write_and_track_known_kvs(self, kvs, client):
+        msgs = [self.skvbc.write_req([], kv, 0) for kv in kvs]
+        async for _ in client.write_many(msgs):
+            pass
+
     async def read_and_track_known_kv(self, key, client):
         msg = self.skvbc.read_req([key])
         try:
@@ -1098,11 +1123,9 @@ class PassThroughSkvbcTracker:
         # there.
         client1 = self.bft_network.random_client()
         # Write enough data to checkpoint and create a need for state transfer
-        for i in range(1 + checkpoints_num * 150):
-            key = self.skvbc.random_key()
-            val = self.skvbc.random_value()
-            kv = [(key, val)]
-            await self.write_and_track_known_kv(kv, client1)
+        kvs = [[(self.skvbc.random_key(), self.skvbc.random_value())]
+               for _ in range(1 + checkpoints_num * 150)]
+        await self.write_and_track_known_kvs(kvs, client1)
 
         await self.skvbc.network_wait_for_checkpoint(initial_nodes, checkpoints_num, persistency_enabled)
 
@@ -0,0 +1,160 @@
+# Concord
+#
+# Copyright (c) 2020 VMware, Inc. All Rights Reserved.
+#
+# This product is licensed to you under the Apache 2.0 license (the "License").
+# You may not use this product except in compliance with the Apache 2.0 License.
+#
+# This product may include a number of subcomponents with separate copyright
+# notices and license terms. Your use of these subcomponents is subject to the
+# terms and conditions of the subcomponent's license, as noted in the LICENSE
+# file.
+
+import glob
+import os.path
+import re
+from collections import defaultdict
+from datetime import datetime, timezone
+
+# util.bft adds the pyclient directory to the path
+from util import bft
+import bft_telemetry
+import bft_tracing
+
+# A replica log line of an event of a traced request, as written by
+# ReplicaImp::traceRequests with the layout of the log4cplus.properties of
+# BftTestNetwork. Read only requests are logged with seqNum=0. The log4cplus
+# %d layout writes times in UTC.
+TRACE_EVENT_RE = re.compile(
+    r'\|(?P<time>\d\d-\d\d-\d{4} \d\d:\d\d:\d\d\.\d+)\|.*'
+    r'Trace event=(?P<event>\w+) replica=(?P<replica>\d+) '
+    r'clientId=(?P<client_id>\d+) reqSeqNum=(?P<req_seq_num>\d+) '
+    r'seqNum=(?P<seq_num>\d+)')
+LOG_TIME_FMT = '%m-%d-%Y %H:%M:%S.%f'
+
+# The points in time of a traced request, in order
+EVENTS = ['send', 'pre_prepare', 'commit', 'execute', 'reply']
+
+
+def read_replica_events(log_paths):
+    """
+    Return the times of the events of traced requests logged by replicas, as
+    a dict keyed by (client_id, req_seq_num) of dicts keyed by event of dicts
+    of replica id to the time of the event, in seconds since the epoch.
+    """
+    events = defaultdict(lambda: defaultdict(dict))
+    for path in log_paths:
+        with open(path, errors='replace') as f:
+            for line in f:
+                match = TRACE_EVENT_RE.search(line)
+                if match is None:
+                    continue
+                t = datetime.strptime(match['time'], LOG_TIME_FMT) \
+                    .replace(tzinfo=timezone.utc).timestamp()
+                key = (int(match['client_id']), int(match['req_seq_num']))
+                events[key][match['event']].setdefault(int(match['replica']), t)
+    return events
+
+
+class RequestTracing:
+    """
+    Trace a sample of the requests of the clients of a BftTestNetwork, and
+    break down the latency of each traced request by phase:
+
+        send -> pre_prepare -> commit -> execute -> reply
+
+    Send and reply are the start and end of the client's span. Pre-prepare is
+    when the primary sent the request in a PrePrepareMsg. Commit and execute
+    are when a quorum (2F+C+1) of replicas had committed and executed its
+    sequence number. Replica times come from their logs, so they have a
+    millisecond resolution.
+    """
+
+    def __init__(self, bft_network, sample_rate=1.0, spans_path=None,
+                 rng=None):
+        self.bft_network = bft_network
+        if spans_path is None:
+            spans_path = os.path.join(bft_network.testdir, 'spans.jsonl')
+        self.spans_path = spans_path
+        self.collector = bft_tracing.FileCollector(spans_path)
+        self.tracer = bft_tracing.Tracer(self.collector, sample_rate, rng)
+        config = bft_network.config
+        self.quorum = 2*config.f + config.c + 1
+        for client in bft_network.clients.values():
+            client.tracer = self.tracer
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Stop tracing the requests of the clients"""
+        for client in self.bft_network.clients.values():
+            if client.tracer is self.tracer:
+                client.tracer = None
+        self.collector.close()
+
+    def breakdown(self, log_paths=None):
+        """
+        Return a dict per traced request with the time of each of its EVENTS,
+        None if it didn't happen, the duration in seconds between consecutive
+        events, and the times at which each replica reached each event.
+
+        By default, replica events are read from the concord.log files of the
+        test directory.
+        """
+        if log_paths is None:
+            log_paths = glob.glob(os.path.join(self.bft_network.testdir,
+                                               'concord.log*'))
+        replica_events = read_replica_events(log_paths)
+        requests = []
+        for span in bft_tracing.read_spans(self.spans_path):
+            tags = span['tags']
+            key = (tags['client_id'], tags['req_seq_num'])
+            by_replica = replica_events.get(key, {})
+            times = {'send': span['start'],
+                     'pre_prepare': self._first(by_replica.get('pre_prepare')),
+                     'commit': self._quorum(by_replica.get('commit')),
+                     'execute': self._quorum(by_replica.get('execute')),
+                     'reply': span['end']}
+            durations = dict()
+            known = [event for event in EVENTS if times[event] is not None]
+            for before, after in zip(known, known[1:]):
+                durations[f'{before}_to_{after}'] = times[after] - times[before]
+            durations['total'] = times['reply'] - times['send']
+            requests.append({'trace_id': span['trace_id'],
+                             'client_id': key[0],
+                             'req_seq_num': key[1],
+                             'type': tags.get('type'),
+                             'retries': tags.get('retries'),
+                             'error': tags.get('error'),
+                             'times': times,
+                             'durations': durations,
+                             'replicas': {event: dict(replicas) for event, replicas
+                                          in by_replica.items()}})
+        return requests
+
+    @staticmethod
+    def summarize(requests):
+        """
+        Return the latency percentiles of each duration of a breakdown, as
+        dicts keyed by duration name.
+        """
+        histograms = defaultdict(bft_telemetry.LatencyHistogram)
+        for request in requests:
+            for name, seconds in request['durations'].items():
+                histograms[name].record(seconds)
+        return {name: histogram.to_dict()
+                for name, histogram in histograms.items()}
+
+    @staticmethod
+    def _first(times):
+        return min(times.values()) if times else None
+
+    def _quorum(self, times):
+        """Return the time by which a quorum of replicas reached an event"""
+        if not times or len(times) < self.quorum:
+            return None
+        return sorted(times.values())[self.quorum - 1]
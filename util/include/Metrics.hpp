@@ -15,11 +15,16 @@
 #define CONCORD_BFT_METRICS_HPP
 
 #include <stdint.h>
+#include <algorithm>
 #include <map>
 #include <vector>
 #include <mutex>
 #include <memory>
 #include <list>
+#include <optional>
+#include <random>
+#include <string>
+#include <tuple>
 #include <variant>
 
 namespace concordMetrics {
@@ -30,6 +35,7 @@ class Values;
 class Gauge;
 class Status;
 class Counter;
+class Histogram;
 typedef struct metric_ Metric;
 
 // An aggregator maintains metrics for multiple components. Components
@@ -42,9 +48,15 @@ typedef struct metric_ Metric;
 // responsible for reporting system metrics should read it from the aggregator.
 class Aggregator {
  public:
+  // Values encoded as in ToJson, keyed by component name, value type
+  // ("Gauges", "Statuses", "Counters" or "Histograms") and value name.
+  typedef std::tuple<std::string, std::string, std::string> ValueKey;
+  typedef std::map<ValueKey, std::string> JsonValues;
+
   Gauge GetGauge(const std::string& component_name, const std::string& val_name);
   Status GetStatus(const std::string& component_name, const std::string& val_name);
   Counter GetCounter(const std::string& component_name, const std::string& val_name);
+  Histogram GetHistogram(const std::string& component_name, const std::string& val_name);
 
   std::list<Metric> CollectGauges();
   std::list<Metric> CollectCounters();
@@ -53,6 +65,38 @@ class Aggregator {
   // Generate a JSON formatted string
   std::string ToJson();
 
+  // Return every value encoded as in ToJson. Comparing the results of two
+  // calls tells which values changed in between.
+  JsonValues ToJsonValues();
+
+  // Return a single value encoded as in ToJson, or nullopt if it doesn't
+  // exist.
+  std::optional<std::string> GetJsonValue(const ValueKey& key);
+
+  // Generate a compact binary encoding of all the values, or only of the given
+  // keys if there are any. A key with an empty type and name selects all the
+  // values of its component, and keys that don't exist are left out. Names are
+  // only included if they changed since known_names_version, so that clients
+  // can keep them, for each set of keys, and get values only. Unlike JSON,
+  // this isn't limited to the size of a single datagram, since replies are
+  // fragmented.
+  //
+  // All integers are little endian. Strings are a uint16 length followed by
+  // the bytes. The encoding is:
+  //
+  //   uint64 names version
+  //   uint8 1 if names follow, 0 otherwise
+  //   names, if included:
+  //     uint32 number of components
+  //     for each component: its name, then the uint32 number of gauges, the
+  //     gauge names, and likewise for statuses, counters and histograms
+  //   values, of each component in the order of the names:
+  //     gauges and counters as uint64, statuses as strings
+  //     histograms as the uint64 count, sum, min and max, then the uint32
+  //     number of non-empty buckets, and the uint16 index and uint64 count of
+  //     each
+  std::string ToBinary(uint64_t known_names_version, const std::vector<ValueKey>& keys = {});
+
  private:
   void RegisterComponent(Component& component);
   void UpdateValues(const std::string& name, Values&& values);
@@ -60,6 +104,10 @@ class Aggregator {
   std::map<std::string, Component> components_;
   std::mutex lock_;
 
+  // Changes whenever a component is registered. The high 32 bits are random,
+  // so that names cached by a client don't match after a restart.
+  uint64_t names_version_{static_cast<uint64_t>(std::random_device{}()) << 32};
+
   friend class Component;
 };
 
@@ -103,6 +151,64 @@ class Counter {
   uint64_t val_;
 };
 
+// A Histogram records the distribution of a value, such as a latency. Values
+// are counted in log-linear buckets: values below 2 * kSubBuckets have a bucket
+// each, and every power of two above that is split into kSubBuckets buckets of
+// equal width, so a bucket's bounds are within 1/kSubBuckets of any value in
+// it. Buckets are only allocated up to the largest value recorded.
+class Histogram {
+ public:
+  static constexpr int kSubBucketBits = 4;
+  static constexpr uint64_t kSubBuckets = uint64_t(1) << kSubBucketBits;
+  // Larger values are recorded as kMaxValue
+  static constexpr uint64_t kMaxValue = (uint64_t(1) << 40) - 1;
+
+  Histogram() = default;
+
+  void Record(uint64_t val) {
+    val = std::min(val, kMaxValue);
+    auto bucket = BucketIndex(val);
+    if (bucket >= buckets_.size()) {
+      buckets_.resize(bucket + 1);
+    }
+    buckets_[bucket]++;
+    if (count_ == 0 || val < min_) {
+      min_ = val;
+    }
+    max_ = std::max(max_, val);
+    count_++;
+    sum_ += val;
+  }
+
+  uint64_t Count() const { return count_; }
+  uint64_t Sum() const { return sum_; }
+  // Min and Max are 0 if nothing was recorded
+  uint64_t Min() const { return min_; }
+  uint64_t Max() const { return max_; }
+  // Counts by bucket index
+  const std::vector<uint64_t>& Buckets() const { return buckets_; }
+
+  static size_t BucketIndex(uint64_t val) {
+    int msb = val == 0 ? 0 : 63 - __builtin_clzll(val);
+    int shift = std::max(0, msb - kSubBucketBits);
+    return shift * kSubBuckets + (val >> shift);
+  }
+
+  // The smallest and largest value counted in a bucket
+  static std::pair<uint64_t, uint64_t> BucketBounds(size_t bucket) {
+    size_t shift = bucket < 2 * kSubBuckets ? 0 : bucket / kSubBuckets - 1;
+    uint64_t low = (bucket - shift * kSubBuckets) << shift;
+    return {low, low + (uint64_t(1) << shift) - 1};
+  }
+
+ private:
+  uint64_t count_ = 0;
+  uint64_t sum_ = 0;
+  uint64_t min_ = 0;
+  uint64_t max_ = 0;
+  std::vector<uint64_t> buckets_;
+};
+
 // A generic struct that may represent a counter or a gauge
 // the motivation is to eliminate that need to know the exact
 // metric name before getting it from the aggregator
@@ -117,6 +223,7 @@ class Values {
   std::vector<Gauge> gauges_;
   std::vector<Status> statuses_;
   std::vector<Counter> counters_;
+  std::vector<Histogram> histograms_;
 
   friend class Component;
   friend class Aggregator;
@@ -131,6 +238,7 @@ class Names {
   std::vector<std::string> gauge_names_;
   std::vector<std::string> status_names_;
   std::vector<std::string> counter_names_;
+  std::vector<std::string> histogram_names_;
 
   friend class Component;
   friend class Aggregator;
@@ -170,6 +278,7 @@ class Component {
   Handle<Status> RegisterStatus(const std::string& name, const std::string& val);
   Handle<Counter> RegisterCounter(const std::string& name, const uint64_t val);
   Handle<Counter> RegisterCounter(const std::string& name) { return RegisterCounter(name, 0); }
+  Handle<Histogram> RegisterHistogram(const std::string& name);
   std::list<Metric> CollectGauges();
   std::list<Metric> CollectCounters();
   std::list<Metric> CollectStatuses();
@@ -218,6 +327,7 @@ class Component {
 typedef concordMetrics::Component::Handle<concordMetrics::Gauge> GaugeHandle;
 typedef concordMetrics::Component::Handle<concordMetrics::Status> StatusHandle;
 typedef concordMetrics::Component::Handle<concordMetrics::Counter> CounterHandle;
+typedef concordMetrics::Component::Handle<concordMetrics::Histogram> HistogramHandle;
 
 }  // namespace concordMetrics
 
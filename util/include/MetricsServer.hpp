@@ -12,8 +12,11 @@
 // LICENSE file.
 
 #include <stdint.h>
+#include <chrono>
 #include <memory>
+#include <optional>
 #include <thread>
+#include <vector>
 #include <sys/socket.h>
 #include <arpa/inet.h>
 #include <netinet/in.h>
@@ -31,9 +34,14 @@ namespace concordMetrics {
 const uint8_t kRequest = 0;
 const uint8_t kReply = 1;
 const uint8_t kError = 2;
+const uint8_t kSubscribe = 3;
+const uint8_t kUnsubscribe = 4;
+const uint8_t kUpdate = 5;
+const uint8_t kBinaryRequest = 6;
+const uint8_t kBinaryReply = 7;
 
 #pragma pack(push, 1)
-// All requests are solely Headers with msg_type_ set to kRequest. Replies are
+// Get requests are solely Headers with msg_type_ set to kRequest. Replies are
 // JSON strings preceded by a Header with msg_type set to kReply or kError.
 // Since we are using UDP, the entire message will always be included, so no
 // need to worry about framing. We can always change the protocol if we decide
@@ -42,9 +50,53 @@ struct Header {
   uint8_t msg_type_;
   uint64_t seq_num_;
 };
+
+// Instead of polling with requests, a client can subscribe to updates that the
+// server pushes to the address the subscription came from. A subscribe request
+// is a Header with msg_type_ set to kSubscribe, followed by a SubscribeRequest
+// and the values to watch as newline separated "component\ttype\tname" lines,
+// where type is "Gauges", "Statuses" or "Counters".
+//
+// Updates are pushed every interval_ms_ if any value changed, and as soon as a
+// watched value changes. Each update is a Header with msg_type_ set to kUpdate
+// and seq_num_ set to the number of updates sent before on the subscription,
+// followed by JSON in the format of Aggregator::ToJson with only the values
+// that changed since the previous update, and a "Full" member which is true if
+// it has all the values instead. The first update of a subscription is full.
+//
+// A subscription expires after lease_ms_, unless the client renews it by
+// subscribing again. Setting full_ asks for a full update, e.g. after an
+// update was lost. A Header with msg_type_ set to kUnsubscribe ends it. If an
+// update doesn't fit in a datagram, the server sends a kError instead and ends
+// the subscription.
+struct SubscribeRequest {
+  uint32_t interval_ms_;
+  uint32_t lease_ms_;
+  uint8_t full_;
+};
+
+// A binary request is a Header with msg_type_ set to kBinaryRequest, followed
+// by the names version of the last reply the client decoded for the same
+// query, or 0. The query optionally follows, as newline separated lines of
+// either a component name, or "component\ttype\tname" to select only some
+// values. The reply is the output of Aggregator::ToBinary for the query, which
+// can be larger than a datagram, split into fragments. Each fragment is a Header with msg_type_ set to
+// kBinaryReply and the seq_num_ of the request, followed by a FragmentHeader
+// and up to kMaxFragmentSize bytes of the reply.
+struct BinaryRequest {
+  uint64_t names_version_;
+};
+
+struct FragmentHeader {
+  uint16_t fragment_;
+  uint16_t num_fragments_;
+};
 #pragma pack(pop)
 
-// A UDP server that returns aggregated metrics
+// Leave room below the UDP payload limit of 65507 bytes
+const size_t kMaxFragmentSize = 60 * 1024;
+
+// A UDP server that returns aggregated metrics, or pushes them to subscribers
 class Server {
  public:
   Server(uint16_t listenPort)
@@ -70,9 +122,32 @@ class Server {
   int sock_;
   uint8_t buf_[MAX_MSG_SIZE];
 
+  struct Subscriber {
+    sockaddr_in addr_;
+    socklen_t addrlen_;
+    std::chrono::milliseconds interval_;
+    std::chrono::steady_clock::time_point next_update_;
+    std::chrono::steady_clock::time_point expires_;
+    std::vector<Aggregator::ValueKey> watched_;
+    // The watched values when they were last checked
+    std::vector<std::optional<std::string>> watched_values_;
+    // The values as of the last update
+    Aggregator::JsonValues sent_;
+    uint64_t seq_num_;
+    bool full_;
+  };
+  std::vector<Subscriber> subscribers_;
+
   void RecvLoop();
   void sendReply(std::string data, sockaddr_in* cliaddr, socklen_t addrlen);
-  void sendError(sockaddr_in* cliaddr, socklen_t addrlen);
+  void sendError(sockaddr_in* cliaddr, socklen_t addrlen, const char* msg = "Invalid Request");
+  void sendBinaryReply(size_t len, sockaddr_in* cliaddr, socklen_t addrlen);
+  // Parse newline separated keys from buf_, and components if allowed
+  bool parseKeys(size_t offset, size_t len, bool components, std::vector<Aggregator::ValueKey>& keys);
+  void subscribe(size_t len, sockaddr_in* cliaddr, socklen_t addrlen);
+  void unsubscribe(sockaddr_in* cliaddr);
+  std::chrono::milliseconds pushUpdates();
+  void sendUpdate(Subscriber& subscriber, const Aggregator::JsonValues& values);
 };
 
 }  // namespace concordMetrics
@@ -0,0 +1,301 @@
+# Concord
+#
+# Copyright (c) 2020 VMware, Inc. All Rights Reserved.
+#
+# This product is licensed to you under the Apache 2.0 license (the "License").
+# You may not use this product except in compliance with the Apache 2.0 License.
+#
+# This product may include a number of subcomponents with separate copyright
+# notices and license terms. Your use of these subcomponents is subject to the
+# terms and conditions of the subcomponent's license, as noted in the LICENSE
+# file.
+
+# This code requires python 3.5 or later
+"""
+Compare the requests per second, and per second of client CPU time, of the
+client backends: trio, asyncio and uvloop over UDP, and trio over TCP and TLS.
+
+By default the client talks to a cluster of fake replicas, run in a separate
+process so that only the client's CPU time is measured. The fake replicas
+answer every request immediately: the first replica answers on behalf of all
+replicas, so that writes sent only to the primary reach a quorum, and the
+others answer the requests they receive themselves.
+
+    python3 bench_transports.py --backend all --duration 5 --concurrency 32
+
+Use --payload-size to compare large requests over UDP and TCP. The tls
+backend requires --certs-dir, a folder created by
+scripts/linux/create_tls_certs.sh with certificates for the client id.
+
+To benchmark against a running cluster, pass --no-fake-replicas. Replica i is
+then expected at 127.0.0.1:3710+2*i, as in the Apollo tests.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import selectors
+import os.path
+import socket
+import ssl
+import struct
+import time
+
+import trio
+
+import bft_client
+import bft_msgs
+import bft_transport
+from bft_config import Config, Replica
+
+UDP_BACKENDS = ['trio', 'asyncio', 'uvloop']
+TCP_BACKENDS = ['tcp', 'tls']
+BACKENDS = UDP_BACKENDS + TCP_BACKENDS
+
+def replicas(n):
+    return [Replica(i, "127.0.0.1", bft_client.BASE_PORT + 2*i, 4710 + 2*i)
+            for i in range(n)]
+
+def fake_replicas(replicas, ready):
+    """Answer every request until killed"""
+    socks = []
+    selector = selectors.DefaultSelector()
+    for r in replicas:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((r.ip, r.port))
+        sock.setblocking(False)
+        socks.append(sock)
+        selector.register(sock, selectors.EVENT_READ, r.id)
+    ready.set()
+    while True:
+        for key, _ in selector.select():
+            sock = key.fileobj
+            while True:
+                try:
+                    data, sender = sock.recvfrom(64*1024)
+                except BlockingIOError:
+                    break
+                header, _, msg, _ = bft_msgs.unpack_request(data)
+                reply = bft_msgs.pack_reply(0, header.req_seq_num, msg)
+                for replier in (socks if key.data == 0 else [sock]):
+                    replier.sendto(reply, sender)
+
+def fake_tcp_replicas(replicas, ready, certs_dir, client_id):
+    """Answer every request over TCP, or TLS if certs_dir is set, until killed"""
+    trio.run(_serve_tcp, replicas, ready, certs_dir, client_id)
+
+async def _serve_tcp(replicas, ready, certs_dir, client_id):
+    tls = certs_dir is not None
+    # The connection of the client to each replica
+    streams = dict()
+    locks = {r.id: trio.Lock() for r in replicas}
+
+    async def answer(replica_id, stream):
+        connection = bft_transport._TcpConnection()
+        connection.stream = stream
+        while True:
+            header = await connection.receive_exactly(bft_transport.TCP_LENGTH_SIZE)
+            if header is None:
+                return
+            length, = struct.unpack(bft_transport.TCP_LENGTH_FMT, header)
+            msg = await connection.receive_exactly(length)
+            streams[replica_id] = stream
+            if not tls:
+                msg_type, = struct.unpack_from(bft_transport.TCP_MSG_TYPE_FMT, msg)
+                if msg_type == bft_transport.TCP_HELLO_MSG_TYPE:
+                    continue
+                msg = msg[bft_transport.TCP_MSG_TYPE_SIZE:]
+            header, _, request, _ = bft_msgs.unpack_request(msg)
+            reply = bft_transport.pack_tcp_msg(
+                bft_msgs.pack_reply(0, header.req_seq_num, request), tls)
+            for i in (list(streams) if replica_id == 0 else [replica_id]):
+                async with locks[i]:
+                    try:
+                        await streams[i].send_all(reply)
+                    except (trio.BrokenResourceError, trio.ClosedResourceError):
+                        # A connection that the client already closed
+                        pass
+
+    async def serve(replica_id, stream):
+        try:
+            await answer(replica_id, stream)
+        except trio.BrokenResourceError:
+            pass
+
+    async with trio.open_nursery() as nursery:
+        for r in replicas:
+            handler = lambda stream, replica_id=r.id: serve(replica_id, stream)
+            if tls:
+                context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+                server_dir = os.path.join(certs_dir, str(r.id), "server")
+                context.load_cert_chain(os.path.join(server_dir, "server.cert"),
+                                        os.path.join(server_dir, "pk.pem"))
+                context.verify_mode = ssl.CERT_REQUIRED
+                context.load_verify_locations(os.path.join(
+                    certs_dir, str(client_id), "client", "client.cert"))
+                await nursery.start(trio.serve_ssl_over_tcp, handler, r.port,
+                                    context)
+            else:
+                await nursery.start(trio.serve_tcp, handler, r.port)
+        ready.set()
+
+class Measurement:
+    def __init__(self):
+        self.requests = 0
+        self.timeouts = 0
+
+    def report(self, backend, wall, cpu, client):
+        return {'backend': backend,
+                'requests': self.requests,
+                'timeouts': self.timeouts,
+                'wall_sec': wall,
+                'cpu_sec': cpu,
+                'requests_per_sec': self.requests / wall,
+                'requests_per_cpu_sec': self.requests / cpu if cpu else None,
+                'retries': client.retries}
+
+def run_trio(config, replicas, args, backend='trio'):
+    measurement = Measurement()
+    msg = b'x' * args.payload_size
+
+    async def worker(client, deadline):
+        while time.monotonic() < deadline:
+            try:
+                await client.sendSync(msg, args.read_only)
+                measurement.requests += 1
+            except trio.TooSlowError:
+                measurement.timeouts += 1
+
+    async def main():
+        if backend == 'trio':
+            client = bft_client.MultiplexedUdpClient(config, replicas)
+        else:
+            certs_dir = args.certs_dir if backend == 'tls' else None
+            client = bft_client.TcpClient(config, replicas, certs_dir=certs_dir)
+        async with client:
+            deadline = time.monotonic() + args.duration
+            async with trio.open_nursery() as nursery:
+                for _ in range(args.concurrency):
+                    nursery.start_soon(worker, client, deadline)
+        return client
+
+    return measure(backend, measurement, lambda: trio.run(main))
+
+def run_asyncio(config, replicas, args, backend):
+    measurement = Measurement()
+    msg = b'x' * args.payload_size
+
+    async def worker(client, deadline):
+        while time.monotonic() < deadline:
+            try:
+                await client.sendSync(msg, args.read_only)
+                measurement.requests += 1
+            except asyncio.TimeoutError:
+                measurement.timeouts += 1
+
+    async def main():
+        async with bft_client.AsyncioUdpClient(config, replicas) as client:
+            deadline = time.monotonic() + args.duration
+            # One task per worker, none per request
+            await asyncio.gather(*(worker(client, deadline)
+                                   for _ in range(args.concurrency)))
+        return client
+
+    if backend == 'uvloop':
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    try:
+        return measure(backend, measurement, lambda: asyncio.run(main()))
+    finally:
+        asyncio.set_event_loop_policy(None)
+
+def measure(backend, measurement, run):
+    wall_start = time.monotonic()
+    cpu_start = time.process_time()
+    client = run()
+    cpu = time.process_time() - cpu_start
+    wall = time.monotonic() - wall_start
+    return measurement.report(backend, wall, cpu, client)
+
+def uvloop_available():
+    try:
+        import uvloop
+        return True
+    except ImportError:
+        return False
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backend', choices=BACKENDS + ['all'], default='all')
+    parser.add_argument('--duration', type=float, default=5,
+                        help='seconds to run each backend')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='number of requests in flight')
+    parser.add_argument('--f', type=int, default=1)
+    parser.add_argument('--c', type=int, default=0)
+    parser.add_argument('--client-id', type=int, default=20)
+    parser.add_argument('--payload-size', type=int, default=64,
+                        help='size in bytes of each request')
+    parser.add_argument('--certs-dir', help='TLS certificates for the tls backend')
+    parser.add_argument('--read-only', action='store_true',
+                        help='send reads instead of writes')
+    parser.add_argument('--no-fake-replicas', action='store_true',
+                        help='benchmark against a running cluster')
+    parser.add_argument('--output', help='write the results as JSON to a file')
+    args = parser.parse_args()
+
+    n = 3*args.f + 2*args.c + 1
+    cluster = replicas(n)
+    backends = list(BACKENDS) if args.backend == 'all' else [args.backend]
+    if 'uvloop' in backends and not uvloop_available():
+        if args.backend == 'uvloop':
+            parser.error('uvloop is not installed')
+        print('uvloop is not installed, skipping it')
+        backends.remove('uvloop')
+    if 'tls' in backends and args.certs_dir is None:
+        if args.backend == 'tls':
+            parser.error('the tls backend requires --certs-dir')
+        print('--certs-dir is not set, skipping tls')
+        backends.remove('tls')
+
+    results = []
+    for backend in backends:
+        server = None
+        if not args.no_fake_replicas:
+            ready = multiprocessing.Event()
+            if backend in TCP_BACKENDS:
+                certs_dir = args.certs_dir if backend == 'tls' else None
+                server = multiprocessing.Process(
+                    target=fake_tcp_replicas,
+                    args=(cluster, ready, certs_dir, args.client_id), daemon=True)
+            else:
+                server = multiprocessing.Process(
+                    target=fake_replicas, args=(cluster, ready), daemon=True)
+            server.start()
+            ready.wait()
+        try:
+            # Only UDP limits messages to a datagram
+            max_msg_size = 64*1024 if backend in UDP_BACKENDS \
+                else max(64*1024, 2*args.payload_size)
+            config = Config(args.client_id, args.f, args.c, max_msg_size,
+                            5000, 250, False, None)
+            if backend in UDP_BACKENDS[1:]:
+                result = run_asyncio(config, cluster, args, backend)
+            else:
+                result = run_trio(config, cluster, args, backend)
+        finally:
+            if server is not None:
+                server.kill()
+                server.join()
+        results.append(result)
+        print(f"{backend:8} {result['requests_per_sec']:10.0f} req/s"
+              f" {result['requests_per_cpu_sec']:10.0f} req/cpu-s"
+              f" timeouts={result['timeouts']} retries={result['retries']}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -11,16 +11,40 @@
 # file.
 
 # This code requires python 3.5 or later
+import asyncio
+import hashlib
 import struct
 import trio
 import time
+from abc import ABC, abstractmethod
+from collections import namedtuple, Counter, deque
 
 import bft_msgs
 from bft_config import Config, Replica
+from bft_telemetry import ClientTelemetry
+from bft_tracing import pack_span_context
+from bft_transport import TrioUdpTransport, TrioTcpTransport, AsyncioUdpTransport
 
 # All test communication expects ports to start from 3710
 BASE_PORT = 3710
 
+# Request types, used to keep separate round trip time estimates
+READ = 'read'
+WRITE = 'write'
+PRE_PROCESS = 'pre_process'
+
+# The lower bound of adaptive retry timeouts
+MIN_RETRY_TIMEOUT_MILLI = 10
+
+# Hedged writes use a percentile of the latencies of the last HEDGE_WINDOW
+# writes, once at least HEDGE_MIN_SAMPLES of them have been observed
+HEDGE_WINDOW = 100
+HEDGE_MIN_SAMPLES = 10
+
+# A reply to one request of a batch, along with the time in seconds from when
+# the request was first sent until its quorum of replies was reached
+BatchReply = namedtuple('BatchReply', ['seq_num', 'reply', 'latency'])
+
 class ReqSeqNum:
     def __init__(self):
         self.time_since_epoch_milli = int(time.time()*1000)
@@ -53,29 +77,295 @@ class ReqSeqNum:
         return r
 
 
-class UdpClient:
-    def __enter__(self):
-        """context manager method for 'with' statements"""
-        return self
+def request_type(read_only, pre_process):
+    """Return the request type used for round trip time estimates"""
+    if read_only:
+        return READ
+    return PRE_PROCESS if pre_process else WRITE
 
-    def __exit__(self, *args):
-        """context manager method for 'with' statements"""
-        self.sock.close()
 
-    def __init__(self, config, replicas):
+class RttEstimator:
+    """
+    A smoothed round trip time and variance estimator, as used for TCP
+    retransmission timers (RFC 6298). All times are in seconds.
+    """
+    ALPHA = 1/8
+    BETA = 1/4
+    K = 4
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.samples = 0
+
+    def add_sample(self, rtt):
+        """Update the estimates with a new round trip time measurement"""
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + \
+                self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+        self.samples += 1
+
+    def rto(self):
+        """
+        Return the retransmission timeout derived from the estimates, or None
+        if there are no samples yet.
+        """
+        if self.srtt is None:
+            return None
+        return self.srtt + self.K * self.rttvar
+
+    def state(self):
+        """Return the estimator state as a dict"""
+        return {'srtt': self.srtt,
+                'rttvar': self.rttvar,
+                'rto': self.rto(),
+                'samples': self.samples}
+
+
+class BufferPool:
+    """
+    A pool of preallocated receive buffers, so that receiving a datagram
+    doesn't allocate a new `max_msg_size` bytes object.
+    """
+
+    def __init__(self, size, count=4):
+        self.size = size
+        self.free = [bytearray(size) for _ in range(count)]
+
+    def acquire(self):
+        """Return a free buffer, allocating a new one if none is left"""
+        if self.free:
+            return self.free.pop()
+        return bytearray(self.size)
+
+    def release(self, buf):
+        """Return a buffer to the pool"""
+        self.free.append(buf)
+
+
+class PrimaryCache:
+    """
+    The primary replica as known by a group of clients.
+
+    Clients that share a cache learn the primary from each other's reply
+    headers, so a new client doesn't broadcast its first write and only one
+    client needs to relearn the primary after a view change. Any client that
+    retries a request invalidates the cache.
+    """
+
+    def __init__(self):
+        self.primary = None
+        self.updates = 0
+        self.invalidations = 0
+
+    def update(self, primary):
+        if primary != self.primary:
+            self.primary = primary
+            self.updates += 1
+
+    def invalidate(self):
+        if self.primary is not None:
+            self.primary = None
+            self.invalidations += 1
+
+
+class QuorumAccumulator:
+    """
+    Incrementally accumulate the replies to a single request until `quorum`
+    of them match.
+
+    Each reply is keyed by its header and a digest of its payload, so every
+    received datagram is hashed exactly once and the quorum is detected as
+    soon as the threshold is reached. A sender that replies again replaces
+    its previous reply.
+
+    Payloads may be memoryviews of reused receive buffers. They are not
+    retained, and only the payload that completes the quorum is copied.
+    """
+
+    def __init__(self, quorum, num_replicas):
+        self.quorum = quorum
+        self.num_replicas = num_replicas
+        # The reply key of each sender
+        self.senders = dict()
+        # The number of senders of each reply key
+        self.counts = Counter()
+        # (sender, time.monotonic()) of the first reply of each sender
+        self.arrivals = []
+        self.header = None
+        self.reply = None
+        self.key = None
+
+    def __len__(self):
+        return len(self.senders)
+
+    def add(self, sender, header, reply):
+        """
+        Add the reply of a sender and return true if there is a quorum of
+        matching replies.
+
+        Side Effects:
+            Set self.header and self.reply to the matching reply once the
+            quorum is reached
+        """
+        if self.reply is not None:
+            return True
+
+        key = (header, hashlib.sha256(reply).digest())
+        previous = self.senders.get(sender)
+        if previous == key:
+            return False
+        if previous is not None:
+            self.counts[previous] -= 1
+        else:
+            self.arrivals.append((sender, time.monotonic()))
+        self.senders[sender] = key
+        self.counts[key] += 1
+
+        if self.counts[key] >= self.quorum:
+            self.key = key
+            self.header = header
+            self.reply = bytes(reply)
+            return True
+        return False
+
+    def is_quorum_impossible(self):
+        """
+        Return true if a quorum can no longer be reached, even if all
+        replicas that have not replied yet send matching replies.
+        """
+        if self.reply is not None:
+            return False
+        remaining = self.num_replicas - len(self.senders)
+        largest = max(self.counts.values(), default=0)
+        return largest + remaining < self.quorum
+
+    def divergent_senders(self):
+        """Return the senders whose replies differ from the quorum reply"""
+        if self.key is None:
+            return []
+        return [sender for sender, key in self.senders.items()
+                if key != self.key]
+
+
+class BaseClient(ABC):
+    """
+    The state and policies of a BFT client that don't depend on how datagrams
+    are sent and received: sequence numbers, the known primary, retry timeouts,
+    hedging, reply statistics, and the scheduling of overlapping requests.
+
+    Subclasses implement `sendSync` on top of a transport, and the abstract
+    methods over the clock, events and sends of their event loop. They set
+    TIMEOUT_ERROR to the exception their event loop raises on timeouts.
+    """
+
+    def __init__(self, config, replicas, primary_cache=None):
         self.config = config
         self.replicas = replicas
-        self.sock = trio.socket.socket(trio.socket.AF_INET,
-                                       trio.socket.SOCK_DGRAM)
         self.req_seq_num = ReqSeqNum()
         self.client_id = config.id
-        self.replies = dict()
-        self.primary = None
-        self.reply = None
+        # The primary is only known to this client unless a cache is shared
+        self.primary_cache = primary_cache if primary_cache is not None \
+            else PrimaryCache()
         self.retries = 0
         self.msgs_sent = 0
         self.reply_quorum = 2*config.f + config.c + 1
-        self.sock_bound = False
+        self.num_replicas = 3*config.f + 2*config.c + 1
+        self.replica_ids = {(r.ip, r.port): r.id for r in replicas}
+        # The number of replies of each replica that did not match the quorum
+        self.divergent_replies = Counter()
+        # RttEstimators keyed by (replica_id, request type)
+        self.rtt_estimators = dict()
+        # Latencies in seconds of recent writes that completed without retries
+        self.write_latencies = deque(maxlen=HEDGE_WINDOW)
+        self.hedges = 0
+        self.telemetry = ClientTelemetry()
+        # A bft_tracing.Tracer that starts a span for each sampled request
+        self.tracer = None
+        # The outstanding PendingRequests keyed by req_seq_num, of clients
+        # that allow overlapping requests
+        self.pending = dict()
+
+    @property
+    def primary(self):
+        """The primary replica if known, or None"""
+        return self.primary_cache.primary
+
+    @primary.setter
+    def primary(self, primary):
+        if primary is None:
+            self.primary_cache.invalidate()
+        else:
+            self.primary_cache.update(primary)
+
+    @abstractmethod
+    def _now(self):
+        """Return the current time in seconds of the client's event loop"""
+
+    @abstractmethod
+    def _new_event(self):
+        """
+        Return a new event of the client's event loop, with `set` and
+        `is_set` methods
+        """
+
+    @abstractmethod
+    async def _wait_until(self, event, deadline):
+        """Wait until an event is set, or until the deadline"""
+
+    @abstractmethod
+    async def _sleep_until(self, deadline):
+        """Sleep until the deadline"""
+
+    @abstractmethod
+    async def send_to_primary(self, request):
+        """Send a serialized request to the primary"""
+
+    @abstractmethod
+    async def send_all(self, request):
+        """Send a serialized request to all replicas"""
+
+    def _local_address(self):
+        # Each port is a function of its client_id
+        return ("127.0.0.1", BASE_PORT + 2*self.client_id)
+
+    def _pack_request(self, msg, read_only, seq_num, cid, pre_process):
+        """
+        Return the sequence number, the serialized request and its span, which
+        is None unless the request is traced.
+        """
+        if seq_num is None:
+            seq_num = self.req_seq_num.next()
+
+        if cid is None:
+            cid = str(seq_num)
+        span = self._start_span(seq_num, cid, read_only, pre_process)
+        span_context = b'' if span is None else pack_span_context(span.context)
+        data = bft_msgs.pack_request(
+                    self.client_id, seq_num, read_only, self.config.req_timeout_milli, cid, msg, pre_process,
+                    span_context)
+        return seq_num, data, span
+
+    def _start_span(self, seq_num, cid, read_only, pre_process):
+        if self.tracer is None:
+            return None
+        return self.tracer.start_span('client_request', tags={
+            'client_id': self.client_id,
+            'req_seq_num': seq_num,
+            'cid': cid,
+            'type': request_type(read_only, pre_process)})
+
+    def _finish_span(self, span, retries, error=None):
+        if span is None:
+            return
+        span.set_tag('retries', retries)
+        if error is not None:
+            span.set_tag('error', error)
+        span.finish()
 
     async def write(self, msg, seq_num=None, cid=None, pre_process=False):
         """ A wrapper around sendSync for requests that mutate state """
@@ -85,6 +375,396 @@ class UdpClient:
         """ A wrapper around sendSync for requests that do not mutate state """
         return await self.sendSync(msg, True, seq_num, cid)
 
+    def retry_timeout(self, req_type, retries):
+        """
+        Return the retry timeout in seconds of a request of the given type
+        that has been retried `retries` times.
+
+        This is `config.retry_timeout_milli` unless `config.adaptive_retry` is
+        set. In that case, the timeout is derived from the round trip time
+        estimates of the replicas that must reply: the primary, if a write is
+        sent only to the primary, or otherwise the 2F+C+1 fastest replicas.
+        Replicas without estimates yet use `config.retry_timeout_milli`. The
+        timeout doubles on each retry, up to `config.req_timeout_milli`.
+        """
+        initial = self.config.retry_timeout_milli/1000
+        if not self.config.adaptive_retry:
+            return initial
+        if req_type != READ and self.primary is not None:
+            timeout = self._rto(self.primary.id, req_type, initial)
+        else:
+            rtos = sorted(self._rto(r.id, req_type, initial)
+                          for r in self.replicas if r.id < self.num_replicas)
+            timeout = rtos[min(self.reply_quorum, len(rtos)) - 1]
+        timeout = max(timeout, MIN_RETRY_TIMEOUT_MILLI/1000) * 2**retries
+        return min(timeout, self.config.req_timeout_milli/1000)
+
+    def _rto(self, replica_id, req_type, default):
+        estimator = self.rtt_estimators.get((replica_id, req_type))
+        if estimator is None or estimator.rto() is None:
+            return default
+        return estimator.rto()
+
+    def _record_rtt(self, sender, req_type, sent_at):
+        """
+        Add a round trip time sample for the replica at the sender address.
+
+        Following Karn's algorithm, callers must not sample requests that were
+        sent more than once, since their replies are ambiguous.
+        """
+        replica_id = self.replica_ids.get(sender)
+        if replica_id is None:
+            return
+        key = (replica_id, req_type)
+        if key not in self.rtt_estimators:
+            self.rtt_estimators[key] = RttEstimator()
+        self.rtt_estimators[key].add_sample(self._now() - sent_at)
+
+    def rtt_state(self):
+        """
+        Return the state of all round trip time estimators as a dict keyed by
+        replica id and then by request type.
+        """
+        state = dict()
+        for (replica_id, req_type), estimator in self.rtt_estimators.items():
+            state.setdefault(replica_id, dict())[req_type] = estimator.state()
+        return state
+
+    def _new_accumulator(self):
+        return QuorumAccumulator(self.reply_quorum, self.num_replicas)
+
+    def _on_quorum(self, replies):
+        """
+        Learn the primary from a completed quorum and count the replicas that
+        sent divergent replies.
+        """
+        self.primary = self.replicas[replies.header.primary_id]
+        for sender in replies.divergent_senders():
+            replica_id = self.replica_ids.get(sender)
+            if replica_id is not None:
+                self.divergent_replies[replica_id] += 1
+        self.telemetry.record_replies(
+            [(self.replica_ids[sender], arrived_at)
+             for sender, arrived_at in replies.arrivals
+             if sender in self.replica_ids])
+
+    def hedge_delay(self):
+        """
+        Return the time in seconds after which a write sent to the primary is
+        also sent to all replicas, or None if writes are not hedged.
+        """
+        if self.config.hedge_percentile is None or \
+                len(self.write_latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        latencies = sorted(self.write_latencies)
+        index = int(self.config.hedge_percentile / 100 * (len(latencies) - 1))
+        return latencies[index]
+
+    async def _send_request(self, req):
+        """Send to the primary if it is known, otherwise send to all replicas"""
+        req.sends += 1
+        req.sent_at = self._now()
+        if req.first_sent_at is None:
+            req.first_sent_at = req.sent_at
+        req.to_primary = not req.read_only and self.primary is not None
+        if req.to_primary:
+            await self.send_to_primary(req.data)
+        else:
+            await self.send_all(req.data)
+
+    async def _send_pending(self, msg, read_only, seq_num, cid, pre_process):
+        """
+        Send a client request that may overlap with others and wait for a
+        quorum (2F+C+1) of replies, which the subclass hands to
+        `_dispatch_reply` as they arrive.
+
+        The retry and hedging strategies are the same as TrioClient.sendSync,
+        but they are applied to each request independently. The exception is
+        writes: a write is first sent once all the older writes complete, and
+        only the oldest outstanding write is retried, since replicas drop any
+        write older than the last one they executed for the client.
+
+        If `config.req_timeout_milli` elapses then TIMEOUT_ERROR is raised.
+        """
+        seq_num, data, span = self._pack_request(msg, read_only, seq_num, cid, pre_process)
+        req = PendingRequest(seq_num, request_type(read_only, pre_process),
+                             data, self._new_accumulator(), span,
+                             self._new_event)
+        self.pending[seq_num] = req
+        deadline = self._now() + self.config.req_timeout_milli/1000
+        try:
+            while req.reply is None:
+                now = self._now()
+                if now >= deadline:
+                    self.telemetry.record_timeout(req.req_type)
+                    self._finish_span(span, req.retries, 'timeout')
+                    raise self.TIMEOUT_ERROR
+                retry_at = min(deadline, now + self.retry_timeout(req.req_type, req.retries))
+                if req.sends == 0 and not self._can_send(req):
+                    # Queued behind older writes, until they complete
+                    await self._wait_until(req.ready, retry_at)
+                    continue
+                if req.sends == 0:
+                    await self._send_request(req)
+                await self._wait_for_reply(req, retry_at)
+                if req.reply is None:
+                    # Back off even if the quorum became impossible early
+                    await self._sleep_until(retry_at)
+                if req.reply is None and self._can_send(req) and \
+                        self._now() < deadline:
+                    req.reset_on_retry(self._new_accumulator())
+                    self.primary = None
+                    self.retries += 1
+                    await self._send_request(req)
+            latency = self._now() - req.first_sent_at
+            self.telemetry.record_request(req.req_type, latency, req.retries)
+            self._finish_span(span, req.retries)
+            if not read_only and req.retries == 0:
+                self.write_latencies.append(latency)
+            return req.reply
+        finally:
+            del self.pending[seq_num]
+            # A write that timed out or was cancelled no longer holds back
+            # the writes queued behind it
+            self._wake_oldest_write()
+
+    async def _wait_for_reply(self, req, deadline):
+        """
+        Wait until a quorum of replies to the last send of a request is
+        reached or can no longer be reached, or until the deadline. Hedge a
+        request that was only sent to the primary.
+        """
+        hedge_delay = self.hedge_delay()
+        if req.to_primary and hedge_delay is not None and \
+                req.sent_at + hedge_delay < deadline:
+            await self._wait_until(req.done, req.sent_at + hedge_delay)
+            if not req.done.is_set():
+                self.hedges += 1
+                # Replies may now answer either send
+                req.sends += 1
+                await self.send_all(req.data)
+        await self._wait_until(req.done, deadline)
+
+    def _can_send(self, req):
+        """
+        Return true if a request may be sent now: it's a read, or the
+        outstanding write with the lowest req_seq_num
+        """
+        return req.read_only or req.seq_num == self._oldest_write()
+
+    def _oldest_write(self):
+        """Return the lowest req_seq_num of the outstanding writes, if any"""
+        return min((seq_num for seq_num, req in self.pending.items()
+                    if req.reply is None and not req.read_only), default=None)
+
+    def _wake_oldest_write(self):
+        """Let the oldest outstanding write be sent, if there is one"""
+        oldest = self._oldest_write()
+        if oldest is not None:
+            self.pending[oldest].ready.set()
+
+    def _dispatch_reply(self, sender, header, reply):
+        """
+        Add a reply to the quorum of its outstanding request. Once the
+        request completes, wake up the write queued behind it, if any.
+        """
+        req = self.pending.get(header.req_seq_num)
+        if req is None or req.reply is not None:
+            # A late reply for a completed request
+            return
+        if req.sends == 1:
+            self._record_rtt(sender, req.req_type, req.sent_at)
+        if req.add_reply(sender, header, reply):
+            self._on_quorum(req.replies)
+            self._wake_oldest_write()
+
+
+class TrioClient(BaseClient):
+    """
+    A client that sends one request, or one batch of requests, at a time over
+    a trio transport. Subclasses create the transport in `_new_transport`.
+    """
+
+    TIMEOUT_ERROR = trio.TooSlowError
+
+    def __enter__(self):
+        """context manager method for 'with' statements"""
+        return self
+
+    def __exit__(self, *args):
+        """context manager method for 'with' statements"""
+        self.transport.close()
+
+    def __init__(self, config, replicas, primary_cache=None):
+        super().__init__(config, replicas, primary_cache)
+        self.transport = self._new_transport()
+        self.reply = None
+        self.replies = self._new_accumulator()
+        self.sock_bound = False
+        self.buffers = BufferPool(config.max_msg_size)
+        self.req_type = None
+        self.sent_at = None
+        # The number of times the current request was sent, including hedges
+        self.sends = 0
+
+    def _now(self):
+        return trio.current_time()
+
+    def _new_event(self):
+        return trio.Event()
+
+    async def _wait_until(self, event, deadline):
+        with trio.move_on_at(deadline):
+            await event.wait()
+
+    async def _sleep_until(self, deadline):
+        await trio.sleep_until(deadline)
+
+    @abstractmethod
+    def _new_transport(self):
+        """Return a transport with the interface of TrioUdpTransport"""
+
+    def write_many(self, msgs, seq_nums=None, pre_process=False):
+        """ A wrapper around send_many for requests that mutate state """
+        return self.send_many(msgs, False, seq_nums, pre_process)
+
+    def read_many(self, msgs, seq_nums=None):
+        """ A wrapper around send_many for requests that do not mutate state """
+        return self.send_many(msgs, True, seq_nums)
+
+    async def send_many(self, msgs, read_only, seq_nums=None, pre_process=False):
+        """
+        Send a batch of client requests and yield a BatchReply for each of
+        them as soon as it has a quorum (2F+C+1) of matching replies.
+        Replies are yielded in the order their quorums form:
+
+            async for batch_reply in client.write_many(msgs):
+                ...
+
+        A sequence number is allocated up front for every message, unless
+        `seq_nums` is given. The cid of each request is its sequence number.
+
+        Retry Strategy:
+            Replicas admit a single pending write per client, so only the
+            write with the lowest sequence number is outstanding, and the
+            next one is sent as soon as it completes. Reads are independent
+            and are all sent at once. After `config.retry_timeout_milli`
+            without any progress, the outstanding write, or all outstanding
+            reads, are resent to all replicas. If `config.req_timeout_milli`
+            elapses since any request was first sent before it completes then
+            a trio.TooSlowError is raised.
+        """
+        if not self.sock_bound:
+            await self.bind()
+
+        msgs = list(msgs)
+        if seq_nums is None:
+            seq_nums = [self.req_seq_num.next() for _ in msgs]
+
+        batch = dict()
+        for seq_num, msg in zip(seq_nums, msgs):
+            _, data, span = self._pack_request(msg, read_only, seq_num, None,
+                                               pre_process)
+            batch[seq_num] = PendingRequest(
+                seq_num, request_type(read_only, pre_process), data,
+                self._new_accumulator(), span)
+
+        self._add_batch(batch)
+        try:
+            if read_only:
+                for req in batch.values():
+                    await self._send_request(req)
+            else:
+                await self._send_next_in_batch(batch)
+            retry_at = self._next_retry_time(batch)
+            while batch:
+                completed = []
+                with trio.move_on_at(retry_at):
+                    completed = await self._recv_many(batch)
+                if completed:
+                    # Yield outside of the cancel scope
+                    for req in completed:
+                        del batch[req.seq_num]
+                        latency = trio.current_time() - req.first_sent_at
+                        self.telemetry.record_request(
+                            req.req_type, latency, req.retries)
+                        self._finish_span(req.span, req.retries)
+                        yield BatchReply(req.seq_num, req.reply, latency)
+                    if batch:
+                        await self._send_next_in_batch(batch)
+                        retry_at = self._next_retry_time(batch)
+                elif trio.current_time() >= self._batch_deadline(batch):
+                    for req in batch.values():
+                        self.telemetry.record_timeout(req.req_type)
+                        self._finish_span(req.span, req.retries, 'timeout')
+                    raise trio.TooSlowError
+                elif trio.current_time() >= retry_at:
+                    self.primary = None
+                    self.retries += 1
+                    # Reads are independent of each other and are all resent.
+                    # Writes are only resent one at a time to keep them in
+                    # sequence number order.
+                    resend = list(batch.values()) if read_only \
+                        else [batch[min(batch)]]
+                    for req in resend:
+                        req.reset_on_retry(self._new_accumulator())
+                        await self._send_request(req)
+                    retry_at = self._next_retry_time(batch)
+        finally:
+            self._remove_batch(seq_nums)
+
+    def _batch_deadline(self, batch):
+        """
+        Return the earliest time at which a request of the batch that was
+        sent times out
+        """
+        return min(req.first_sent_at for req in batch.values()
+                   if req.first_sent_at is not None) \
+            + self.config.req_timeout_milli/1000
+
+    def _next_retry_time(self, batch):
+        """Return the time of the next retry, capped by the batch deadline"""
+        oldest = batch[min(batch)]
+        timeout = self.retry_timeout(oldest.req_type, oldest.retries)
+        return min(self._batch_deadline(batch), trio.current_time() + timeout)
+
+    def _add_batch(self, batch):
+        """Hook called before the requests of a batch are sent"""
+        pass
+
+    def _remove_batch(self, seq_nums):
+        """Hook called once a batch completes or fails"""
+        pass
+
+    async def _recv_many(self, batch):
+        """
+        Receive a single reply for any request in the batch and return a list
+        of the requests that it completed.
+        """
+        buf = self.buffers.acquire()
+        try:
+            sender, header, reply = await self._recv_reply(buf)
+            req = batch.get(header.req_seq_num)
+            if req is None or req.reply is not None:
+                return []
+            if req.sends == 1:
+                self._record_rtt(sender, req.req_type, req.sent_at)
+            if req.add_reply(sender, header, reply):
+                self._on_quorum(req.replies)
+                return [req]
+            return []
+        finally:
+            self.buffers.release(buf)
+
+    async def _send_next_in_batch(self, batch):
+        """
+        Send the outstanding write with the lowest sequence number, once the
+        writes before it completed
+        """
+        oldest = batch[min(batch)]
+        if not oldest.read_only and oldest.sends == 0:
+            await self._send_request(oldest)
+
     async def sendSync(self, msg, read_only, seq_num=None, cid=None, pre_process=False):
         """
         Send a client request and wait for a quorum (2F+C+1) of replies.
@@ -104,42 +784,53 @@ class UdpClient:
             `config.req_timeout_milli` elapses. If `config.req_timeout_milli`
             elapses then a trio.TooSlowError is raised.
 
+            If `config.hedge_percentile` is set, a write sent only to the
+            primary is also sent to all replicas once it takes longer than
+            that percentile of recent write latencies. Replies received before
+            and after the hedge all count towards the quorum.
+
          Note that this method also binds the socket to an appropriate port if
          not already bound.
         """
         if not self.sock_bound:
             await self.bind()
 
-        if seq_num is None:
-            seq_num = self.req_seq_num.next()
+        _, data, span = self._pack_request(msg, read_only, seq_num, cid, pre_process)
 
-        if cid is None:
-            cid = str(seq_num)
-        data = bft_msgs.pack_request(
-                    self.client_id, seq_num, read_only, self.config.req_timeout_milli, cid, msg, pre_process)
-
-        # Raise a trio.TooSlowError exception if a quorum of replies
-        with trio.fail_after(self.config.req_timeout_milli/1000):
-            self.reset_on_new_request()
-            self.retries = 0
-            return await self.send_loop(data, read_only)
+        self.req_type = request_type(read_only, pre_process)
+        start = trio.current_time()
+        try:
+            # Raise a trio.TooSlowError exception if a quorum of replies
+            with trio.fail_after(self.config.req_timeout_milli/1000):
+                self.reset_on_new_request()
+                self.retries = 0
+                reply = await self.send_loop(data, read_only)
+        except trio.TooSlowError:
+            self.telemetry.record_timeout(self.req_type)
+            self._finish_span(span, self.retries, 'timeout')
+            raise
+        self._finish_span(span, self.retries)
+        latency = trio.current_time() - start
+        self.telemetry.record_request(self.req_type, latency, self.retries)
+        if not read_only and self.retries == 0:
+            self.write_latencies.append(latency)
+        return reply
 
     def reset_on_retry(self):
         """Reset any state that must be reset during retries"""
-        self.replies = dict()
+        self.replies = self._new_accumulator()
         self.primary = None
         self.retries += 1
 
     def reset_on_new_request(self):
         """Reset any state that must be reset during new requests"""
-        self.replies = dict()
+        self.replies = self._new_accumulator()
         self.reply = None
         self.retries = 0
+        self.sends = 0
 
     async def bind(self):
-        # Each port is a function of its client_id
-        port = BASE_PORT + 2*self.client_id
-        await self.sock.bind(("127.0.0.1", port))
+        await self.transport.bind(self._local_address())
         self.sock_bound = True
 
     async def send_loop(self, data, read_only):
@@ -150,17 +841,35 @@ class UdpClient:
         including this one.
         """
         while self.reply is None:
-            with trio.move_on_after(self.config.retry_timeout_milli/1000):
+            retry_at = trio.current_time() + self.retry_timeout(self.req_type, self.retries)
+            with trio.move_on_at(retry_at):
                 async with trio.open_nursery() as nursery:
+                    self.sent_at = trio.current_time()
+                    self.sends += 1
                     if read_only or self.primary is None:
                         await self.send_all(data)
                     else:
                         await self.send_to_primary(data)
+                        hedge_delay = self.hedge_delay()
+                        if hedge_delay is not None:
+                            nursery.start_soon(self._hedge, data, hedge_delay)
                     nursery.start_soon(self.recv, nursery.cancel_scope)
             if self.reply is None:
+                # An attempt whose quorum became impossible ends early, but
+                # it's still only retried after the retry timeout, so that
+                # conflicting replies don't make the client spin
+                await trio.sleep_until(retry_at)
                 self.reset_on_retry()
         return self.reply
 
+    async def _hedge(self, request, delay):
+        """Send a request to all replicas after a delay"""
+        await trio.sleep(delay)
+        self.hedges += 1
+        # Replies may now answer either send
+        self.sends += 1
+        await self.send_all(request)
+
     async def send_to_primary(self, request):
         """Send a serialized request to the primary"""
         async with trio.open_nursery() as nursery:
@@ -175,23 +884,41 @@ class UdpClient:
                                                           replica.port))
     async def sendto(self, request, ip_port):
         """Send a request over a udp socket"""
-        await self.sock.sendto(request, ip_port)
+        await self.transport.sendto(request, ip_port)
         self.msgs_sent += 1
 
+    async def _recv_reply(self, buf):
+        """
+        Receive a reply into buf and return the sender, the reply header and a
+        memoryview of the payload. The payload is only valid until buf is
+        reused.
+        """
+        nbytes, sender = await self.transport.recvfrom_into(buf)
+        header, reply = bft_msgs.unpack_reply(memoryview(buf)[:nbytes])
+        return sender, header, reply
+
     async def recv(self, cancel_scope):
         """
-        Receive reply messages until a quorum is achieved or the enclosing
+        Receive reply messages until a quorum is achieved or can no longer be
+        achieved, and then cancel the attempt, or until the enclosing
         cancel_scope times out.
         """
-        while True:
-            data, sender = await self.sock.recvfrom(self.config.max_msg_size)
-            header, reply = bft_msgs.unpack_reply(data)
-            if self.valid_reply(header):
-                self.replies[sender] = (header, reply)
-            if self.has_quorum():
-                # This cancel will propagate upward and gracefully terminate all
-                # coroutines. self.reply will get set in self.has_quorum()
-                cancel_scope.cancel()
+        buf = self.buffers.acquire()
+        try:
+            while True:
+                sender, header, reply = await self._recv_reply(buf)
+                if self.valid_reply(header):
+                    if self.sends == 1:
+                        self._record_rtt(sender, self.req_type, self.sent_at)
+                    self.replies.add(sender, header, reply)
+                if self.has_quorum() or self.replies.is_quorum_impossible():
+                    # This cancel will propagate upward and gracefully terminate
+                    # all coroutines of the attempt, including a pending hedge.
+                    # self.reply will get set in self.has_quorum()
+                    cancel_scope.cancel()
+                    return
+        finally:
+            self.buffers.release(buf)
 
     def valid_reply(self, header):
         """Return true if the sequence number is correct"""
@@ -205,20 +932,353 @@ class UdpClient:
             Set self.reply to the reply with the quorum
             Set self.primary to the primary in the quorum of reply headers
         """
+        if self.replies.reply is None:
+            return False
+        if self.reply is None:
+            self.reply = self.replies.reply
+            self._on_quorum(self.replies)
+        return True
+
+class PendingRequest:
+    """
+    The state of a single outstanding request of a TrioClient batch, a
+    MultiplexedClient or an AsyncioUdpClient. Its events are created by
+    `new_event`, so that they belong to the event loop of the client.
+    """
+
+    def __init__(self, seq_num, req_type, data, replies, span=None,
+                 new_event=trio.Event):
+        self.seq_num = seq_num
+        self.req_type = req_type
+        self.read_only = req_type == READ
+        self.data = data
+        self.replies = replies
+        self.span = span
+        self.reply = None
+        self.primary_id = None
+        self.retries = 0
+        self.sends = 0
+        self.first_sent_at = None
+        self.sent_at = None
+        # Whether the last send was only to the primary
+        self.to_primary = False
+        self.new_event = new_event
+        # Set when the older writes a write is queued behind complete
+        self.ready = new_event()
+        # Set when the current attempt reaches a quorum or can't anymore
+        self.done = new_event()
+        self.waiter = None
+
+    def reset_on_retry(self, replies):
+        """Reset any state that must be reset during retries"""
+        self.replies = replies
+        self.retries += 1
+        self.done = self.new_event()
+
+    def add_reply(self, sender, header, reply):
+        """
+        Record a reply from sender and return true if it completes a quorum of
+        matching replies. Wake up the waiting request if the quorum is reached
+        or can no longer be reached.
 
-        if len(self.replies) < self.reply_quorum:
+        Side Effects:
+            Set self.reply and self.primary_id when the quorum is reached.
+        """
+        if not self.replies.add(sender, header, reply):
+            if self.replies.is_quorum_impossible():
+                self.done.set()
             return False
+        self.reply = self.replies.reply
+        self.primary_id = self.replies.header.primary_id
+        self.done.set()
+        if self.waiter is not None:
+            self.waiter.set()
+        return True
 
-        # a reply mapped to a count of each specific reply
-        # We must have a quorum of identical replies
-        reply_counts = dict()
-        for reply in self.replies.values():
-            count = reply_counts.get(reply, 0)
-            reply_counts[reply] = count + 1
-
-        for reply, counts in reply_counts.items():
-            if counts >= self.reply_quorum:
-                self.reply = reply[1]
-                self.primary = self.replicas[reply[0].primary_id]
-                return True
-        return False
+
+class UdpClient(TrioClient):
+    """
+    A client that sends one request at a time over a trio UDP transport.
+    """
+
+    def _new_transport(self):
+        return TrioUdpTransport()
+
+
+class MultiplexedClient(TrioClient):
+    """
+    A TrioClient that allows many `sendSync` calls to be in flight at once.
+
+    A single long-lived receive task owns the transport and dispatches each
+    reply by its req_seq_num into the quorum tracker of the matching
+    outstanding request. The receive task lives as long as the async context.
+
+    Replicas currently admit a single pending write per client, and drop any
+    write older than the last one they executed for it. Therefore writes are
+    sent in req_seq_num order: a write waits until the older writes complete,
+    and is sent as soon as the receive task completes them. Only the oldest
+    outstanding write is ever retried, so a newer write never overtakes an
+    older one.
+
+    Unlike UdpClient, `retries` is never reset and counts the retries of all
+    requests.
+    """
+
+    def __init__(self, config, replicas, primary_cache=None):
+        super().__init__(config, replicas, primary_cache)
+        self.receiving = False
+        self._nursery_manager = None
+        self._nursery = None
+
+    async def __aenter__(self):
+        """Bind the transport and start the receive task"""
+        if not self.sock_bound:
+            await self.bind()
+        self._nursery_manager = trio.open_nursery()
+        self._nursery = await self._nursery_manager.__aenter__()
+        await self._nursery.start(self._recv_loop)
+        return self
+
+    async def __aexit__(self, *args):
+        """Stop the receive task and close the transport"""
+        self._nursery.cancel_scope.cancel()
+        try:
+            return await self._nursery_manager.__aexit__(*args)
+        finally:
+            self._nursery_manager = None
+            self._nursery = None
+            self.transport.close()
+
+    async def sendSync(self, msg, read_only, seq_num=None, cid=None, pre_process=False):
+        """
+        Send a client request and wait for a quorum (2F+C+1) of replies.
+
+        Inside the async context, any number of calls may overlap, as
+        scheduled by BaseClient._send_pending. Outside of it, the request is
+        sent as by TrioClient.sendSync.
+        """
+        if not self.receiving:
+            return await super().sendSync(msg, read_only, seq_num, cid, pre_process)
+        return await self._send_pending(msg, read_only, seq_num, cid, pre_process)
+
+    def _add_batch(self, batch):
+        """Make the requests of a batch visible to the receive task"""
+        self.pending.update(batch)
+
+    def _remove_batch(self, seq_nums):
+        for seq_num in seq_nums:
+            self.pending.pop(seq_num, None)
+
+    async def _recv_many(self, batch):
+        """
+        Wait for the receive task to complete any request in the batch and
+        return a list of the completed requests.
+        """
+        if not self.receiving:
+            return await super()._recv_many(batch)
+        waiter = trio.Event()
+        for req in batch.values():
+            req.waiter = waiter
+        completed = [req for req in batch.values() if req.reply is not None]
+        if not completed:
+            await waiter.wait()
+            completed = [req for req in batch.values() if req.reply is not None]
+        return completed
+
+    async def _recv_loop(self, task_status=trio.TASK_STATUS_IGNORED):
+        """
+        Receive replies for all outstanding requests until the transport is
+        closed or the task is cancelled.
+        """
+        self.receiving = True
+        task_status.started()
+        buf = self.buffers.acquire()
+        try:
+            while True:
+                sender, header, reply = await self._recv_reply(buf)
+                self._dispatch_reply(sender, header, reply)
+        except trio.ClosedResourceError:
+            pass
+        finally:
+            self.buffers.release(buf)
+            self.receiving = False
+
+
+class MultiplexedUdpClient(MultiplexedClient):
+    """
+    A MultiplexedClient over a trio UDP transport:
+
+        async with MultiplexedUdpClient(config, replicas) as client:
+            async with trio.open_nursery() as nursery:
+                for msg in msgs:
+                    nursery.start_soon(client.write, msg)
+
+    Outside of the async context the client behaves exactly like a UdpClient,
+    with a single request outstanding at a time.
+    """
+
+    def _new_transport(self):
+        return TrioUdpTransport()
+
+
+class TcpClient(MultiplexedClient):
+    """
+    A MultiplexedClient that talks to the replicas over one persistent TCP
+    connection per replica, as PlainTcpCommunication replicas expect. If
+    `certs_dir` is given, the connections use TLS as TlsTCPCommunication
+    replicas expect, with the certificates created by
+    scripts/linux/create_tls_certs.sh. The certificates must include one for
+    this client's id.
+
+    All outstanding requests share the connections. Requests and replies are
+    only limited by `config.max_msg_size`, which must not exceed the buffer
+    size of the replicas, rather than by the size of a UDP datagram.
+
+    The connections and the receive task live as long as the async context,
+    which is required to send requests:
+
+        async with TcpClient(config, replicas) as client:
+            reply = await client.write(msg)
+    """
+
+    def __init__(self, config, replicas, primary_cache=None, certs_dir=None):
+        self.certs_dir = certs_dir
+        super().__init__(config, replicas, primary_cache)
+
+    def _new_transport(self):
+        return TrioTcpTransport(self.config.id, self.replicas, self.certs_dir)
+
+    async def __aenter__(self):
+        """Start the connection reader tasks and the receive task"""
+        await self.transport.__aenter__()
+        try:
+            return await super().__aenter__()
+        except BaseException:
+            await self.transport.__aexit__(None, None, None)
+            raise
+
+    async def __aexit__(self, *args):
+        """Stop the receive task and close all connections"""
+        try:
+            return await super().__aexit__(*args)
+        finally:
+            await self.transport.__aexit__(*args)
+
+    def _check_connected(self):
+        if self._nursery is None:
+            raise RuntimeError(
+                "TcpClient requests must be sent inside its async context")
+
+    async def sendSync(self, msg, read_only, seq_num=None, cid=None, pre_process=False):
+        self._check_connected()
+        return await super().sendSync(msg, read_only, seq_num, cid, pre_process)
+
+    async def send_many(self, msgs, read_only, seq_nums=None, pre_process=False):
+        self._check_connected()
+        async for batch_reply in super().send_many(msgs, read_only, seq_nums,
+                                                   pre_process):
+            yield batch_reply
+
+class _AsyncioEvent:
+    """
+    An event over a future of an asyncio event loop, so that waiting for it
+    with a timeout doesn't wrap it in a task
+    """
+
+    def __init__(self, loop):
+        self.future = loop.create_future()
+
+    def set(self):
+        if not self.future.done():
+            self.future.set_result(None)
+
+    def is_set(self):
+        return self.future.done()
+
+
+class AsyncioUdpClient(BaseClient):
+    """
+    A client for asyncio applications, with the quorum, retry and hedging
+    semantics of MultiplexedUdpClient. It runs on any asyncio event loop,
+    including uvloop.
+
+    Replies are dispatched by req_seq_num from the datagram callback of the
+    transport straight into the events of the matching request. No task is
+    spawned per request or per reply: each `sendSync` waits, and hedges, in
+    its caller's task.
+
+        async with AsyncioUdpClient(config, replicas) as client:
+            reply = await client.write(msg)
+
+    As with MultiplexedUdpClient, writes are sent and retried in req_seq_num
+    order, and `retries` counts the retries of all requests. Timeouts raise
+    asyncio.TimeoutError.
+    """
+
+    TIMEOUT_ERROR = asyncio.TimeoutError
+
+    def __init__(self, config, replicas, primary_cache=None):
+        super().__init__(config, replicas, primary_cache)
+        self.transport = None
+        self.loop = None
+
+    async def __aenter__(self):
+        if self.transport is None:
+            await self.bind()
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+    def _now(self):
+        return self.loop.time()
+
+    def _new_event(self):
+        return _AsyncioEvent(self.loop)
+
+    async def _wait_until(self, event, deadline):
+        timeout = deadline - self._now()
+        if timeout > 0 and not event.is_set():
+            await asyncio.wait((event.future,), timeout=timeout)
+
+    async def _sleep_until(self, deadline):
+        await asyncio.sleep(max(0, deadline - self._now()))
+
+    async def bind(self):
+        self.loop = asyncio.get_running_loop()
+        self.transport = await AsyncioUdpTransport.open(
+            self._datagram_received, self._local_address())
+
+    async def sendSync(self, msg, read_only, seq_num=None, cid=None, pre_process=False):
+        """
+        Send a client request and wait for a quorum (2F+C+1) of replies.
+
+        Any number of calls may overlap, as scheduled by
+        BaseClient._send_pending. If `config.req_timeout_milli` elapses then
+        an asyncio.TimeoutError is raised.
+        """
+        if self.transport is None:
+            await self.bind()
+        return await self._send_pending(msg, read_only, seq_num, cid, pre_process)
+
+    async def send_to_primary(self, request):
+        self._sendto(request, (self.primary.ip, self.primary.port))
+
+    async def send_all(self, request):
+        for replica in self.replicas:
+            self._sendto(request, (replica.ip, replica.port))
+
+    def _sendto(self, request, ip_port):
+        # Sends never block: the event loop queues them if needed
+        self.transport.sendto(request, ip_port)
+        self.msgs_sent += 1
+
+    def _datagram_received(self, data, sender):
+        """Add a reply to the quorum of its outstanding request"""
+        header, reply = bft_msgs.unpack_reply(data)
+        self._dispatch_reply(sender, header, reply)
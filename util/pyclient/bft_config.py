@@ -13,7 +13,12 @@
 # This code requires python 3.5 or later
 from collections import namedtuple
 
+# When adaptive_retry is set, retry timeouts are derived from round trip time
+# estimates, and retry_timeout_milli is only used until estimates exist.
+# When hedge_percentile is set (e.g. 95), writes sent to the primary are also
+# sent to all replicas once they exceed that percentile of recent latencies.
 Config = namedtuple('Config', ['id', 'f', 'c', 'max_msg_size', 'req_timeout_milli',
-    'retry_timeout_milli'])
+    'retry_timeout_milli', 'adaptive_retry', 'hedge_percentile'],
+    defaults=[False, None])
 
 Replica = namedtuple('Replica', ['id', 'ip', 'port', 'metrics_port'])
@@ -11,54 +11,526 @@
 # file.
 
 # This code requires python 3.5 or later
+import asyncio
 import trio
 import json
+import math
+import socket
 import struct
 
 from bft_config import Replica
+from bft_transport import TrioUdpTransport, AsyncioUdpTransport
 
 REQUEST_TYPE = 0
 REPLY_TYPE = 1
 ERROR_TYPE = 2
+SUBSCRIBE_TYPE = 3
+UNSUBSCRIBE_TYPE = 4
+UPDATE_TYPE = 5
+BINARY_REQUEST_TYPE = 6
+BINARY_REPLY_TYPE = 7
 
 HEADER_FMT = "<BQ"
 HEADER_SIZE = struct.calcsize(HEADER_FMT)
+HEADER_STRUCT = struct.Struct(HEADER_FMT)
+
+# The names version the client knows, 0 for none
+BINARY_REQUEST_STRUCT = struct.Struct("<Q")
+
+# The index of the fragment of a binary reply, and the number of fragments
+FRAGMENT_HEADER_STRUCT = struct.Struct("<HH")
+
+# The names version of a binary reply, and whether names are included
+BINARY_REPLY_STRUCT = struct.Struct("<QB")
+COUNT_STRUCT = struct.Struct("<I")
+STRING_LEN_STRUCT = struct.Struct("<H")
+
+# The count, sum, min and max of a histogram, then its number of non-empty
+# buckets, each an index and a count
+HISTOGRAM_STRUCT = struct.Struct("<QQQQI")
+BUCKET_STRUCT = struct.Struct("<HQ")
+
+# Update interval and lease in milliseconds, and whether to send a full update
+SUBSCRIBE_FMT = "<IIB"
+
+# How often to resend a subscription until the first update arrives
+RESUBSCRIBE_INTERVAL = 0.1
 
 MAX_MSG_SIZE = 64*1024; # 64k
 
-class MetricsClient:
+# Fragments of a binary reply arrive back to back, so make room for several
+# of them. The kernel caps this at net.core.rmem_max.
+RECV_BUF_SIZE = 1024*1024
+
+# Histogram buckets split each power of two into 2**HISTOGRAM_SUB_BUCKET_BITS
+# buckets, as concordMetrics::Histogram::kSubBucketBits does
+HISTOGRAM_SUB_BUCKET_BITS = 4
+
+class MetricsError(Exception):
+    pass
+
+def histogram_bucket(value):
+    """Return the index of the histogram bucket that counts a value"""
+    shift = max(0, value.bit_length() - 1 - HISTOGRAM_SUB_BUCKET_BITS)
+    return (shift << HISTOGRAM_SUB_BUCKET_BITS) + (value >> shift)
+
+def histogram_bucket_bounds(bucket):
+    """Return the smallest and largest value counted in a histogram bucket"""
+    sub_buckets = 1 << HISTOGRAM_SUB_BUCKET_BITS
+    shift = 0 if bucket < 2 * sub_buckets else bucket // sub_buckets - 1
+    low = (bucket - shift * sub_buckets) << shift
+    return low, low + (1 << shift) - 1
+
+def histogram_percentile(buckets, p, min_, max_):
+    """
+    Return an estimate of the value below which p percent of the values
+    counted in `buckets`, a mapping of bucket index to count, fall, or None
+    if nothing was counted.
+
+    The estimate is the largest value of the bucket of the value at rank
+    ceil(p/100 * count), clamped to [min_, max_].
+    """
+    if not 0 <= p <= 100:
+        raise ValueError("percentile must be between 0 and 100")
+    count = sum(buckets.values())
+    if count == 0:
+        return None
+    rank = max(1, math.ceil(p / 100 * count))
+    seen = 0
+    for index in sorted(buckets):
+        seen += buckets[index]
+        if seen >= rank:
+            _, high = histogram_bucket_bounds(index)
+            return max(min_, min(high, max_))
+    return max_
+
+def _pack_query(query):
+    """Return the query of a binary request"""
+    if not query:
+        return b''
+    return '\n'.join(item if isinstance(item, str) else '\t'.join(item)
+                     for item in query).encode()
+
+def _unpack_string(data, offset):
+    """Return a string of a binary reply and the offset after it"""
+    size, = STRING_LEN_STRUCT.unpack_from(data, offset)
+    offset += STRING_LEN_STRUCT.size
+    return bytes(data[offset:offset + size]).decode(), offset + size
+
+def _unpack_names(data, offset):
+    """
+    Return the names of a binary reply, as a list of (component, gauge names,
+    status names, counter names, histogram names), and the offset after them.
+    """
+    def unpack_list(offset):
+        count, = COUNT_STRUCT.unpack_from(data, offset)
+        offset += COUNT_STRUCT.size
+        names = []
+        for _ in range(count):
+            name, offset = _unpack_string(data, offset)
+            names.append(name)
+        return names, offset
+
+    num_components, = COUNT_STRUCT.unpack_from(data, offset)
+    offset += COUNT_STRUCT.size
+    names = []
+    for _ in range(num_components):
+        component, offset = _unpack_string(data, offset)
+        gauges, offset = unpack_list(offset)
+        statuses, offset = unpack_list(offset)
+        counters, offset = unpack_list(offset)
+        histograms, offset = unpack_list(offset)
+        names.append((component, gauges, statuses, counters, histograms))
+    return names, offset
+
+def _unpack_values(data, offset, names):
+    """
+    Return the metrics of a binary reply in the format of the JSON replies,
+    given the names of its values.
+    """
+    components = []
+    for (component, gauge_names, status_names, counter_names,
+         histogram_names) in names:
+        gauges = struct.unpack_from(f"<{len(gauge_names)}Q", data, offset)
+        offset += 8 * len(gauge_names)
+        statuses = []
+        for _ in status_names:
+            status, offset = _unpack_string(data, offset)
+            statuses.append(status)
+        counters = struct.unpack_from(f"<{len(counter_names)}Q", data, offset)
+        offset += 8 * len(counter_names)
+        histograms = []
+        for _ in histogram_names:
+            count, sum_, min_, max_, num_buckets = \
+                HISTOGRAM_STRUCT.unpack_from(data, offset)
+            offset += HISTOGRAM_STRUCT.size
+            buckets = []
+            for _ in range(num_buckets):
+                buckets.append(list(BUCKET_STRUCT.unpack_from(data, offset)))
+                offset += BUCKET_STRUCT.size
+            histograms.append({'count': count, 'sum': sum_, 'min': min_,
+                               'max': max_, 'buckets': buckets})
+        components.append({'Name': component,
+                           'Gauges': dict(zip(gauge_names, gauges)),
+                           'Statuses': dict(zip(status_names, statuses)),
+                           'Counters': dict(zip(counter_names, counters)),
+                           'Histograms': dict(zip(histogram_names,
+                                                  histograms))})
+    if offset != len(data):
+        raise MetricsError("Binary metrics don't match their names")
+    return {'Components': components}
+
+class _Reply:
+    """
+    The datagrams received for one request: a JSON reply, the fragments of a
+    binary reply, or an error
+    """
+
+    def __init__(self, seq_num, binary):
+        self.seq_num = seq_num
+        self.binary = binary
+        self.fragments = dict()
+        self.num_fragments = None
+        self.data = None
+        self.error = None
+
+    def add(self, datagram):
+        """
+        Add a datagram and return true once the reply is complete. Datagrams
+        of other requests are ignored. Raise MetricsError if the datagram is
+        malformed.
+        """
+        if len(datagram) < HEADER_SIZE:
+            raise MetricsError("Metrics reply shorter than its header")
+        msg_type, seq_num = HEADER_STRUCT.unpack_from(datagram)
+        if seq_num != self.seq_num:
+            return False
+        if msg_type == ERROR_TYPE:
+            self.error = bytes(datagram[HEADER_SIZE:]).decode(errors='replace')
+            return True
+        if not self.binary:
+            if msg_type != REPLY_TYPE:
+                raise MetricsError(f"Unexpected metrics reply type {msg_type}")
+            self.data = datagram[HEADER_SIZE:]
+            return True
+        if msg_type != BINARY_REPLY_TYPE or \
+                len(datagram) < HEADER_SIZE + FRAGMENT_HEADER_STRUCT.size:
+            raise MetricsError(f"Unexpected metrics reply type {msg_type}")
+        fragment, self.num_fragments = \
+            FRAGMENT_HEADER_STRUCT.unpack_from(datagram, HEADER_SIZE)
+        self.fragments[fragment] = \
+            datagram[HEADER_SIZE + FRAGMENT_HEADER_STRUCT.size:]
+        if len(self.fragments) < self.num_fragments:
+            return False
+        if self.num_fragments == 1:
+            self.data = self.fragments[0]
+        else:
+            self.data = b''.join(self.fragments[i]
+                                 for i in range(self.num_fragments))
+        return True
+
+
+class BaseMetricsClient:
+    """
+    The requests and reply decoding of a metrics client, that don't depend on
+    how datagrams are sent and received.
+
+    Metrics are requested in the binary encoding, whose replies can span
+    several datagrams, falling back to JSON if the server doesn't support
+    it. Names are only sent by the server when they change.
+    """
+
+    def __init__(self, replica, binary=True):
+        self.seq_num = 0
+        self.replica = replica
+        # Whether to get metrics with binary requests. Set to False when the
+        # server doesn't support them.
+        self.binary = binary
+        # The names version and names of the binary replies of each query
+        self.names = dict()
+
+    def _request(self, query):
+        """
+        Return the _Reply to collect and the datagram of a new request for
+        the metrics selected by a packed query
+        """
+        self.seq_num += 1
+        if not self.binary:
+            return (_Reply(self.seq_num, False),
+                    HEADER_STRUCT.pack(REQUEST_TYPE, self.seq_num))
+        known_version, _ = self.names.get(query, (0, None))
+        request = b''.join([
+            HEADER_STRUCT.pack(BINARY_REQUEST_TYPE, self.seq_num),
+            BINARY_REQUEST_STRUCT.pack(known_version), query])
+        return _Reply(self.seq_num, True), request
+
+    def _decode(self, query, reply):
+        """
+        Return the metrics of a complete reply. Return None if the server
+        replied to a binary request with an error, after which requests fall
+        back to JSON.
+        """
+        if reply.error is not None:
+            if reply.binary:
+                self.binary = False
+                return None
+            raise MetricsError(reply.error)
+        if not reply.binary:
+            return json.loads(reply.data)
+        data = reply.data
+        names_version, with_names = BINARY_REPLY_STRUCT.unpack_from(data)
+        offset = BINARY_REPLY_STRUCT.size
+        if with_names:
+            names, offset = _unpack_names(data, offset)
+            self.names[query] = (names_version, names)
+        else:
+            known_version, names = self.names.get(query, (0, None))
+            if names_version != known_version:
+                raise MetricsError("Binary metrics without known names")
+        return _unpack_values(data, offset, names)
+
+
+class MetricsClient(BaseMetricsClient):
     def __enter__(self):
         """context manager method for 'with' statements"""
         return self
 
     def __exit__(self, *args):
         """context manager method for 'with' statements"""
-        self.sock.close()
+        self.transport.close()
 
-    def __init__(self, replica):
-        self.seq_num = 0
-        self.replica = replica
-        self.sock = trio.socket.socket(trio.socket.AF_INET,
-                                       trio.socket.SOCK_DGRAM)
-    def _req(self):
-        """Return a get request to the metrics server"""
-        self.seq_num += 1
-        req = struct.pack(HEADER_FMT, REQUEST_TYPE, self.seq_num)
-        return req
+    def __init__(self, replica, binary=True):
+        super().__init__(replica, binary)
+        self.transport = TrioUdpTransport()
+        self.transport.sock.setsockopt(trio.socket.SOL_SOCKET,
+                                       trio.socket.SO_RCVBUF, RECV_BUF_SIZE)
 
-    async def get(self):
+    async def get(self, query=None):
         """
-        Send a get metrics request, retrieve the JSON response, decode it and
+        Send a get metrics request, retrieve the response, decode it and
         return a map of metrics.
 
+        A query is a list of component names and (component, type, key)
+        sequences, of which the server only encodes the values. Metrics that
+        don't exist are left out. The JSON fallback returns all metrics.
+
         There is no explicit timeout here. Users should call `with
         trio.fail_after as necessary`.
         """
+        query = _pack_query(query)
+        while True:
+            reply, request = self._request(query)
+            destination = (self.replica.ip, self.replica.metrics_port)
+            await self.transport.sendto(request, destination)
+            while True:
+                datagram, _ = await self.transport.recvfrom(MAX_MSG_SIZE)
+                if reply.add(datagram):
+                    break
+            metrics = self._decode(query, reply)
+            if metrics is not None:
+                return metrics
+
+
+class AsyncioMetricsClient(BaseMetricsClient):
+    """
+    A MetricsClient for asyncio event loops. Replies are matched to requests
+    by sequence number from the datagram callback of the transport, so
+    concurrent `get` calls don't need a receive task.
+    """
+
+    def __init__(self, replica, binary=True):
+        super().__init__(replica, binary)
+        self.transport = None
+        # The _Reply and the future of each outstanding request, keyed by
+        # sequence number
+        self.pending = dict()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+    async def get(self, query=None):
+        """
+        Send a get metrics request, retrieve the response, decode it and
+        return a map of metrics. Queries are the same as MetricsClient.get.
+
+        There is no explicit timeout here. Users should call
+        `asyncio.wait_for` as necessary.
+        """
+        if self.transport is None:
+            self.transport = await AsyncioUdpTransport.open(self._datagram_received)
+            sock = self.transport.datagram_transport.get_extra_info('socket')
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUF_SIZE)
+        query = _pack_query(query)
+        while True:
+            reply, request = self._request(query)
+            done = asyncio.get_running_loop().create_future()
+            self.pending[reply.seq_num] = (reply, done)
+            try:
+                self.transport.sendto(request, (self.replica.ip,
+                                                self.replica.metrics_port))
+                await done
+            finally:
+                del self.pending[reply.seq_num]
+            metrics = self._decode(query, reply)
+            if metrics is not None:
+                return metrics
+
+    def _datagram_received(self, data, sender):
+        if len(data) < HEADER_SIZE:
+            # It can't be matched to a request
+            return
+        _, seq_num = HEADER_STRUCT.unpack_from(data)
+        reply, done = self.pending.get(seq_num, (None, None))
+        if reply is None or done.done():
+            return
+        try:
+            if reply.add(data):
+                done.set_result(None)
+        except MetricsError as e:
+            done.set_exception(e)
+
+
+class MetricsSubscriptionError(Exception):
+    pass
+
+
+class MetricsSubscriber:
+    """
+    Subscribe to the metrics of a replica, and keep a live local mirror of
+    them that the MetricsServer pushes updates to. Updates are pushed every
+    `interval` seconds if any value changed, and within milliseconds of a
+    change to any of the `watch` metrics, given as (component, type, key)
+    sequences. An interval of 0 only pushes changes to watched metrics.
+
+    The subscription is renewed every third of `lease` seconds, so that it
+    expires on the server shortly after the subscriber goes away, and is
+    restored after a replica restart. If an update is lost, a full update is
+    requested.
+
+    Use it as an async context manager:
+
+        async with MetricsSubscriber(replica, watch=[key]) as subscriber:
+            await subscriber.wait_for(lambda s: s.get(*key) >= 5)
+    """
+
+    def __init__(self, replica, interval=0.1, watch=(), lease=3.0):
+        self.replica = replica
+        self.interval = interval
+        self.watch = [tuple(metric) for metric in watch]
+        self.lease = lease
+        self.transport = None
+        # The values of the metrics keyed by (component, type, key)
+        self.values = dict()
+        # The seq_num of the last update, None before the first one
+        self.seq_num = None
+        self.updates = 0
+        self._changed = trio.Event()
+        self._nursery_manager = None
+
+    async def __aenter__(self):
+        self.transport = TrioUdpTransport()
+        self._nursery_manager = trio.open_nursery()
+        nursery = await self._nursery_manager.__aenter__()
+        nursery.start_soon(self._receive)
+        nursery.start_soon(self._renew)
+        self._nursery = nursery
+        return self
+
+    async def __aexit__(self, *args):
+        self._nursery.cancel_scope.cancel()
+        try:
+            return await self._nursery_manager.__aexit__(*args)
+        finally:
+            # Let the server drop the subscription before its lease expires
+            with trio.move_on_after(.1) as scope:
+                scope.shield = True
+                await self._send(UNSUBSCRIBE_TYPE)
+            self.transport.close()
+
+    def get(self, component_name, type_, key):
+        """
+        Return the current value of a metric. Raise KeyError if it isn't
+        known yet.
+        """
+        return self.values[(component_name, type_, key)]
+
+    def to_dict(self):
+        """Return the metrics in the format of MetricsClient.get"""
+        components = dict()
+        for (name, type_, key), value in self.values.items():
+            component = components.setdefault(name, {'Name': name})
+            component.setdefault(type_, dict())[key] = value
+        return {'Components': list(components.values())}
+
+    async def wait_for(self, predicate):
+        """
+        Wait until the predicate, called with this subscriber, returns true
+        after an update. A KeyError from it means the metrics it reads aren't
+        known yet.
+
+        There is no explicit timeout here. Users should call `with
+        trio.fail_after as necessary`.
+        """
+        while True:
+            changed = self._changed
+            if self.seq_num is not None:
+                try:
+                    if predicate(self):
+                        return
+                except KeyError:
+                    pass
+            await changed.wait()
+
+    async def _send(self, msg_type, data=b''):
         destination = (self.replica.ip, self.replica.metrics_port)
-        await self.sock.sendto(self._req(), destination)
+        await self.transport.sendto(struct.pack(HEADER_FMT, msg_type, 0) + data,
+                                    destination)
+
+    async def _subscribe(self, full=False):
+        watch = '\n'.join('\t'.join(metric) for metric in self.watch)
+        request = struct.pack(SUBSCRIBE_FMT, int(self.interval * 1000),
+                              int(self.lease * 1000), full)
+        await self._send(SUBSCRIBE_TYPE, request + watch.encode())
+
+    async def _renew(self):
+        while True:
+            await self._subscribe()
+            if self.seq_num is None:
+                await trio.sleep(RESUBSCRIBE_INTERVAL)
+            else:
+                await trio.sleep(self.lease / 3)
+
+    async def _receive(self):
         while True:
-            reply, _ = await self.sock.recvfrom(MAX_MSG_SIZE)
-            assert 1 == reply[0]
-            _, seq_num = struct.unpack(HEADER_FMT, reply[0:HEADER_SIZE])
-            if seq_num == self.seq_num:
-                return json.loads(reply[HEADER_SIZE:])
+            data, _ = await self.transport.recvfrom(MAX_MSG_SIZE)
+            msg_type, seq_num = struct.unpack(HEADER_FMT, data[0:HEADER_SIZE])
+            if msg_type == ERROR_TYPE:
+                raise MetricsSubscriptionError(
+                    data[HEADER_SIZE:].decode(errors='replace'))
+            if msg_type != UPDATE_TYPE:
+                continue
+            update = json.loads(data[HEADER_SIZE:])
+            if update['Full']:
+                self.values = dict()
+            elif self.seq_num is None or seq_num != self.seq_num + 1:
+                # An update was lost, so some values may be stale
+                await self._subscribe(full=True)
+            for component in update['Components']:
+                name = component['Name']
+                for type_, values in component.items():
+                    if type_ == 'Name':
+                        continue
+                    for key, value in values.items():
+                        self.values[(name, type_, key)] = value
+            self.seq_num = seq_num
+            self.updates += 1
+            self._changed.set()
+            self._changed = trio.Event()
@@ -10,6 +10,7 @@
 # terms and conditions of the subcomponent's license, as noted in the LICENSE
 # file.
 
+from array import array
 from collections import namedtuple
 import struct
 
@@ -42,6 +43,18 @@ REQUEST_HEADER_SIZE = struct.calcsize(REQUEST_HEADER_FMT)
 REPLY_HEADER_FMT = "<LHQL"
 REPLY_HEADER_SIZE = struct.calcsize(REPLY_HEADER_FMT)
 
+# Precompiled structs, so that formats are only parsed once. The msg type and
+# header are packed together, and unpacked separately so that the msg type can
+# be checked first.
+MSG_TYPE_STRUCT = struct.Struct(MSG_TYPE_FMT)
+REQUEST_HEADER_STRUCT = struct.Struct(REQUEST_HEADER_FMT)
+REPLY_HEADER_STRUCT = struct.Struct(REPLY_HEADER_FMT)
+REQUEST_STRUCT = struct.Struct(MSG_TYPE_FMT + REQUEST_HEADER_FMT[1:])
+REPLY_STRUCT = struct.Struct(MSG_TYPE_FMT + REPLY_HEADER_FMT[1:])
+
+# The array typecodes of the fields of a ReplyHeader, for bulk decoding
+REPLY_HEADER_TYPECODES = ('I', 'H', 'Q', 'I')
+
 RequestHeader = namedtuple('RequestHeader', ['span_context_size', 'client_id', 'flags',
     'req_seq_num', 'length', 'timeout_milli', 'cid'])
 
@@ -51,27 +64,63 @@ RequestHeader = namedtuple('RequestHeader', ['span_context_size', 'client_id', '
 ReplyHeader = namedtuple('ReplyHeader', ['span_context_size', 'primary_id',
     'req_seq_num', 'length'])
 
-def pack_request(client_id, req_seq_num, read_only, timeout_milli, cid, msg, pre_process=False, span_context=b''):
-    """Create and return a buffer with a header and message"""
-    flags = 0x0
+def request_flags(read_only, pre_process=False):
+    """Return the flags of a request header"""
     if read_only:
-        flags = 0x1
+        return 0x1
     elif pre_process:
-        flags = 0x2
-    header = RequestHeader(len(span_context), client_id, flags, req_seq_num, len(msg), timeout_milli, len(cid))
-    data = b''.join([pack_request_header(header, pre_process), span_context, msg, cid.encode()])
-    return data
+        return 0x2
+    return 0x0
+
+def request_size(msg, cid=b'', span_context=b''):
+    """Return the size of a packed request with an encoded cid"""
+    return REQUEST_STRUCT.size + len(span_context) + len(msg) + len(cid)
+
+def pack_request(client_id, req_seq_num, read_only, timeout_milli, cid, msg, pre_process=False, span_context=b''):
+    """Create and return a buffer with a header and message"""
+    msg_type = PRE_PROCESS_TYPE if pre_process else REQUEST_MSG_TYPE
+    cid = cid.encode()
+    # A single join copies each part once, which is cheaper than zero filling
+    # a preallocated buffer before copying into it
+    return b''.join([REQUEST_STRUCT.pack(msg_type, len(span_context), client_id,
+                                         request_flags(read_only, pre_process),
+                                         req_seq_num, len(msg), timeout_milli,
+                                         len(cid)),
+                     span_context, msg, cid])
+
+def pack_request_into(buf, offset, client_id, req_seq_num, read_only,
+                      timeout_milli, cid, msg, pre_process=False,
+                      span_context=b''):
+    """
+    Pack a request with an encoded cid into the writable buffer buf at offset,
+    and return the offset of its end. The buffer must have room for
+    request_size(msg, cid, span_context) bytes.
+    """
+    msg_type = PRE_PROCESS_TYPE if pre_process else REQUEST_MSG_TYPE
+    REQUEST_STRUCT.pack_into(buf, offset, msg_type, len(span_context),
+                             client_id, request_flags(read_only, pre_process),
+                             req_seq_num, len(msg), timeout_milli, len(cid))
+    offset += REQUEST_STRUCT.size
+    # Assigning to a memoryview copies directly, without a temporary
+    with memoryview(buf) as view:
+        for part in (span_context, msg, cid):
+            end = offset + len(part)
+            view[offset:end] = part
+            offset = end
+    return offset
 
 def pack_request_header(header, pre_process=False):
     """Take a RequestHeader and return a buffer"""
     msg_type = PRE_PROCESS_TYPE if pre_process else REQUEST_MSG_TYPE
-    return b''.join([struct.pack(MSG_TYPE_FMT, msg_type),
-                     struct.pack(REQUEST_HEADER_FMT, *header)])
+    return REQUEST_STRUCT.pack(msg_type, *header)
 
 def unpack_request(data):
-    """Take a buffer and return a pair of the RequestHeader and app data"""
+    """
+    Take a buffer and return the RequestHeader, span context, app data and cid.
+    The span context and app data are lazy slices if the buffer is a
+    memoryview.
+    """
     header = unpack_request_header(data)
-
     start = MSG_TYPE_SIZE + REQUEST_HEADER_SIZE
     end = start + header.span_context_size
     span_context = data[start:end]
@@ -80,53 +129,160 @@ def unpack_request(data):
     end = start + header.length
     msg = data[start:end]
 
-    start = end
-    cid = data[start:].decode()
+    cid = str(data[end:end + header.cid], 'utf-8')
     return header, span_context, msg, cid
 
-def unpack_request_header(data):
+def unpack_request_from(data, offset=0):
+    """
+    Take a buffer and return the RequestHeader of the request at offset, a
+    memoryview of its span context and app data, and its cid. The views are
+    only valid as long as the buffer isn't modified.
+    """
+    return unpack_request(memoryview(data)[offset:])
+
+def unpack_request_header(data, offset=0):
     """
     Take a buffer and return a request header.
     Throws MsgError if type is not a request or struct.error if structure can't
     be unpacked.
     """
-    msg_type = unpack_msg_type(data)
+    msg_type, = MSG_TYPE_STRUCT.unpack_from(data, offset)
     if msg_type != REQUEST_MSG_TYPE:
         raise MsgError("Expected a request message")
-    end = REQUEST_HEADER_SIZE + MSG_TYPE_SIZE
-    return RequestHeader._make(struct.unpack(REQUEST_HEADER_FMT,
-                                             data[MSG_TYPE_SIZE:end]))
+    return RequestHeader._make(REQUEST_HEADER_STRUCT.unpack_from(
+        data, offset + MSG_TYPE_SIZE))
 
 def pack_reply(primary_id, req_seq_num, msg):
     """
     Take message information and a message and return a construct a buffer
     containing a serialized reply header and message.
     """
-    header = ReplyHeader(0, primary_id, req_seq_num, len(msg))
-    return b''.join([pack_reply_header(header), msg])
+    return b''.join([REPLY_STRUCT.pack(REPLY_MSG_TYPE, 0, primary_id,
+                                       req_seq_num, len(msg)),
+                     msg])
 
 def pack_reply_header(header):
     """Take a ReplyHeader and return a buffer"""
-    return b''.join([struct.pack(MSG_TYPE_FMT, REPLY_MSG_TYPE),
-                     struct.pack(REPLY_HEADER_FMT, *header)])
+    return REPLY_STRUCT.pack(REPLY_MSG_TYPE, *header)
 
-def unpack_msg_type(data):
-    return struct.unpack(MSG_TYPE_FMT, data[0:MSG_TYPE_SIZE])[0]
+def unpack_msg_type(data, offset=0):
+    return MSG_TYPE_STRUCT.unpack_from(data, offset)[0]
 
 def unpack_reply(data):
-    """Take a buffer and return a pair of the ReplyHeader and app data"""
-    start = MSG_TYPE_SIZE + REPLY_HEADER_SIZE
-    return (unpack_reply_header(data), data[start:])
+    """
+    Take a buffer and return a pair of the ReplyHeader and app data. The app
+    data is a lazy slice if the buffer is a memoryview.
+    """
+    return unpack_reply_header(data), data[MSG_TYPE_SIZE + REPLY_HEADER_SIZE:]
+
+def unpack_reply_from(data, offset=0):
+    """
+    Take a buffer and return a pair of the ReplyHeader of the reply at offset
+    and a memoryview of its app data, which extends to the end of the buffer.
+    The view is only valid as long as the buffer isn't modified.
+    """
+    return unpack_reply(memoryview(data)[offset:])
 
-def unpack_reply_header(data):
+def unpack_reply_header(data, offset=0):
     """
     Take a buffer and return a reply header.
     Throws MsgError if type is not a reply or struct.error if structure can't be
     unpacked.
     """
-    msg_type = unpack_msg_type(data)
+    msg_type, = MSG_TYPE_STRUCT.unpack_from(data, offset)
     if msg_type != REPLY_MSG_TYPE:
         raise MsgError("Expected a reply message")
-    end = REPLY_HEADER_SIZE + MSG_TYPE_SIZE
-    return ReplyHeader._make(struct.unpack(REPLY_HEADER_FMT,
-                                           data[MSG_TYPE_SIZE:end]))
+    return ReplyHeader._make(REPLY_HEADER_STRUCT.unpack_from(
+        data, offset + MSG_TYPE_SIZE))
+
+def unpack_reply_headers(replies):
+    """
+    Take an iterable of reply buffers and decode all of their headers at once
+    into a ReplyHeaderArray.
+    Throws MsgError if any of them is not a reply or struct.error if any of
+    them is too short for a header.
+    """
+    replies = list(replies)
+    size = REPLY_STRUCT.size
+    if any(len(reply) < size for reply in replies):
+        raise struct.error(f"unpack requires a buffer of {size} bytes")
+    # The headers are decoded from a single buffer with a single call
+    raw = b''.join([reply[:size] for reply in replies])
+    columns = list(zip(*REPLY_STRUCT.iter_unpack(raw))) or [()] * 5
+    msg_types = columns[0]
+    if msg_types.count(REPLY_MSG_TYPE) != len(msg_types):
+        raise MsgError("Expected a reply message")
+    return ReplyHeaderArray(replies, [array(typecode, column) for typecode, column
+                                      in zip(REPLY_HEADER_TYPECODES, columns[1:])])
+
+class ReplyHeaderArray:
+    """
+    The headers of a batch of replies, with one array per ReplyHeader field,
+    such as `headers.req_seq_num`. Indexing returns the ReplyHeader of a
+    reply, and `payload` its app data.
+    """
+
+    def __init__(self, replies, columns):
+        self.replies = replies
+        for field, column in zip(ReplyHeader._fields, columns):
+            setattr(self, field, column)
+
+    def __len__(self):
+        return len(self.replies)
+
+    def __getitem__(self, i):
+        return ReplyHeader(self.span_context_size[i], self.primary_id[i],
+                           self.req_seq_num[i], self.length[i])
+
+    def __iter__(self):
+        return map(ReplyHeader._make, zip(self.span_context_size,
+                                          self.primary_id, self.req_seq_num,
+                                          self.length))
+
+    def payload(self, i):
+        """Return a memoryview of the app data of reply i"""
+        return memoryview(self.replies[i])[REPLY_STRUCT.size:]
+
+    def indices(self, req_seq_num=None, primary_id=None):
+        """
+        Return the indices of the replies that match a req_seq_num and a
+        primary_id. Each can be a single value or a collection of values, and
+        None matches all replies.
+        """
+        indices = range(len(self))
+        for column, wanted in ((self.req_seq_num, req_seq_num),
+                               (self.primary_id, primary_id)):
+            if wanted is None:
+                continue
+            if isinstance(wanted, int):
+                indices = [i for i in indices if column[i] == wanted]
+            else:
+                wanted = frozenset(wanted)
+                indices = [i for i in indices if column[i] in wanted]
+        return list(indices)
+
+    def filter(self, req_seq_num=None, primary_id=None):
+        """
+        Return a ReplyHeaderArray of the replies that match a req_seq_num and
+        a primary_id, as in `indices`.
+        """
+        indices = self.indices(req_seq_num, primary_id)
+        columns = [array(column.typecode, [column[i] for i in indices])
+                   for column in (getattr(self, field)
+                                  for field in ReplyHeader._fields)]
+        return ReplyHeaderArray([self.replies[i] for i in indices], columns)
+
+    def to_numpy(self):
+        """
+        Return the headers as a NumPy structured array, with a field per
+        ReplyHeader field and the msg type. Requires numpy.
+        """
+        import numpy
+        dtype = numpy.dtype([('msg_type', '<u2'),
+                             ('span_context_size', '<u4'),
+                             ('primary_id', '<u2'),
+                             ('req_seq_num', '<u8'),
+                             ('length', '<u4')])
+        assert dtype.itemsize == REPLY_STRUCT.size
+        raw = b''.join([reply[:REPLY_STRUCT.size] for reply in self.replies])
+        return numpy.frombuffer(raw, dtype=dtype)
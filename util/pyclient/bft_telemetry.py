@@ -0,0 +1,158 @@
+# Concord
+#
+# Copyright (c) 2020 VMware, Inc. All Rights Reserved.
+#
+# This product is licensed to you under the Apache 2.0 license (the "License").
+# You may not use this product except in compliance with the Apache 2.0 License.
+#
+# This product may include a number of subcomponents with separate copyright
+# notices and license terms. Your use of these subcomponents is subject to the
+# terms and conditions of the subcomponent's license, as noted in the LICENSE
+# file.
+
+# This code requires python 3.5 or later
+import copy
+import json
+from collections import Counter
+
+from bft_metrics_client import histogram_bucket, histogram_percentile
+
+# The percentiles reported for every latency histogram
+PERCENTILES = [50, 90, 99, 99.9]
+
+
+class LatencyHistogram:
+    """
+    A sparse histogram of latencies.
+
+    Latencies are recorded in microseconds into the same log-linear buckets
+    as replica histogram metrics (see bft_metrics_client.histogram_bucket), so
+    reported percentiles are within 1/2**HISTOGRAM_SUB_BUCKET_BITS of the
+    exact value and compare directly with those of the replicas.
+    """
+
+    def __init__(self):
+        # Bucket index to count
+        self.counts = Counter()
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def record(self, seconds):
+        """Record a latency given in seconds"""
+        micros = max(0, int(seconds * 1e6))
+        self.counts[histogram_bucket(micros)] += 1
+        self.total += 1
+        self.min = micros if self.min is None else min(self.min, micros)
+        self.max = micros if self.max is None else max(self.max, micros)
+
+    def percentile(self, p):
+        """
+        Return the latency in seconds at percentile p (0-100), or None if
+        nothing was recorded.
+        """
+        if self.total == 0:
+            return None
+        return histogram_percentile(self.counts, p, self.min, self.max) / 1e6
+
+    def merge(self, other):
+        """Add all values recorded in another histogram to this one"""
+        self.counts.update(other.counts)
+        self.total += other.total
+        for attr, fn in (('min', min), ('max', max)):
+            theirs = getattr(other, attr)
+            if theirs is not None:
+                ours = getattr(self, attr)
+                setattr(self, attr, theirs if ours is None else fn(ours, theirs))
+
+    def to_dict(self):
+        """Return a summary of the histogram that can be serialized as JSON"""
+        summary = {'count': self.total,
+                   'min': None if self.min is None else self.min / 1e6,
+                   'max': None if self.max is None else self.max / 1e6}
+        for p in PERCENTILES:
+            summary[f'p{p:g}'.replace('.', '')] = self.percentile(p)
+        return summary
+
+
+class ClientTelemetry:
+    """
+    Client observed statistics of requests and replies.
+
+     * Latency histograms by request type (read, write, pre_process)
+     * The distribution of the number of retries per request
+     * Timeouts by request type
+     * For each replica, the distribution of the order in which its replies
+       arrive and a histogram of their lag behind the first reply
+
+    Only replies received before a quorum is reached are ranked.
+
+    Telemetry from many clients can be merged into a single object.
+    """
+
+    def __init__(self):
+        self.latencies = dict()
+        self.retries = Counter()
+        self.timeouts = Counter()
+        # replica_id to Counter of arrival order (0 is first)
+        self.reply_order = dict()
+        # replica_id to LatencyHistogram of lag behind the first reply
+        self.reply_lag = dict()
+
+    def record_request(self, req_type, latency, retries):
+        """Record a request that completed after `latency` seconds"""
+        if req_type not in self.latencies:
+            self.latencies[req_type] = LatencyHistogram()
+        self.latencies[req_type].record(latency)
+        self.retries[retries] += 1
+
+    def record_timeout(self, req_type):
+        self.timeouts[req_type] += 1
+
+    def record_replies(self, arrivals):
+        """
+        Record the arrival of the replies to a single request, given as a list
+        of (replica_id, arrival time in seconds) in order of arrival.
+        """
+        if not arrivals:
+            return
+        first = arrivals[0][1]
+        for order, (replica_id, arrived_at) in enumerate(arrivals):
+            self.reply_order.setdefault(replica_id, Counter())[order] += 1
+            if replica_id not in self.reply_lag:
+                self.reply_lag[replica_id] = LatencyHistogram()
+            self.reply_lag[replica_id].record(arrived_at - first)
+
+    def snapshot(self):
+        """Return a copy of the current telemetry"""
+        return copy.deepcopy(self)
+
+    def merge(self, other):
+        """Add the telemetry of another client to this one and return self"""
+        for req_type, histogram in other.latencies.items():
+            self.latencies.setdefault(req_type, LatencyHistogram()).merge(histogram)
+        self.retries.update(other.retries)
+        self.timeouts.update(other.timeouts)
+        for replica_id, order in other.reply_order.items():
+            self.reply_order.setdefault(replica_id, Counter()).update(order)
+        for replica_id, histogram in other.reply_lag.items():
+            self.reply_lag.setdefault(replica_id, LatencyHistogram()).merge(histogram)
+        return self
+
+    def to_dict(self):
+        """Return the telemetry in a form that can be serialized as JSON"""
+        return {
+            'latencies': {req_type: histogram.to_dict()
+                          for req_type, histogram in self.latencies.items()},
+            'retries': {str(n): count for n, count in sorted(self.retries.items())},
+            'timeouts': dict(self.timeouts),
+            'replicas': {
+                str(replica_id): {
+                    'reply_order': {str(order): count for order, count
+                                    in sorted(self.reply_order[replica_id].items())},
+                    'reply_lag': self.reply_lag[replica_id].to_dict()}
+                for replica_id in sorted(self.reply_order)}
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2)
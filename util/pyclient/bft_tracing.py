@@ -0,0 +1,152 @@
+# Concord
+#
+# Copyright (c) 2020 VMware, Inc. All Rights Reserved.
+#
+# This product is licensed to you under the Apache 2.0 license (the "License").
+# You may not use this product except in compliance with the Apache 2.0 License.
+#
+# This product may include a number of subcomponents with separate copyright
+# notices and license terms. Your use of these subcomponents is subject to the
+# terms and conditions of the subcomponent's license, as noted in the LICENSE
+# file.
+
+# This code requires python 3.5 or later
+"""
+Client side tracing of BFT requests.
+
+A Tracer starts a span for each sampled request. The context of the span is
+sent in the span context of the request, so that replicas can trace their
+handling of the request as its children. Unsampled requests are sent without
+a span context, as before.
+
+Span contexts are serialized in the binary format of the Jaeger propagator,
+which is what the replicas' tracer extracts in `startChildSpanFromContext`.
+Finished spans are recorded by a collector; FileCollector stands in for a
+tracing agent by writing them to a local file.
+"""
+import json
+import random
+import struct
+import time
+from collections import namedtuple
+
+# Trace id (high and low 64 bits), span id, parent span id, flags and the
+# number of baggage items, all big endian
+SPAN_CONTEXT_FMT = ">QQQQBI"
+SPAN_CONTEXT_SIZE = struct.calcsize(SPAN_CONTEXT_FMT)
+SPAN_CONTEXT_STRUCT = struct.Struct(SPAN_CONTEXT_FMT)
+
+SAMPLED_FLAG = 0x1
+
+SpanContext = namedtuple('SpanContext', ['trace_id', 'span_id', 'parent_id',
+    'flags'])
+
+def pack_span_context(context):
+    """Take a SpanContext and return a buffer, without baggage"""
+    return SPAN_CONTEXT_STRUCT.pack(context.trace_id >> 64,
+                                    context.trace_id & (2**64 - 1),
+                                    context.span_id, context.parent_id,
+                                    context.flags, 0)
+
+def unpack_span_context(data):
+    """
+    Take a buffer and return a SpanContext, ignoring any baggage.
+    Throws struct.error if the buffer is too short.
+    """
+    high, low, span_id, parent_id, flags, _ = \
+        SPAN_CONTEXT_STRUCT.unpack_from(data)
+    return SpanContext((high << 64) | low, span_id, parent_id, flags)
+
+
+class Span:
+    """A timed operation of a trace, recorded by a collector when finished"""
+
+    def __init__(self, name, context, collector, tags=None, start=None):
+        self.name = name
+        self.context = context
+        self.collector = collector
+        self.tags = dict(tags) if tags else dict()
+        self.start = time.time() if start is None else start
+        self.end = None
+
+    def set_tag(self, key, value):
+        self.tags[key] = value
+
+    def finish(self, end=None):
+        """Record the span, unless it's already finished"""
+        if self.end is not None:
+            return
+        self.end = time.time() if end is None else end
+        if self.collector is not None:
+            self.collector.record(self)
+
+    def to_dict(self):
+        return {'name': self.name,
+                'trace_id': f'{self.context.trace_id:032x}',
+                'span_id': f'{self.context.span_id:016x}',
+                'parent_id': f'{self.context.parent_id:016x}',
+                'start': self.start,
+                'end': self.end,
+                'tags': self.tags}
+
+
+class Tracer:
+    """
+    Start spans, of which a `sample_rate` fraction of traces are sampled.
+
+    Sampling is decided once per trace: `start_span` returns None for a new
+    trace that isn't sampled, and children of a sampled span are always
+    sampled. Wall clock times are used, so that spans can be compared with
+    the timestamps of replica logs.
+    """
+
+    def __init__(self, collector=None, sample_rate=1.0, rng=None):
+        self.collector = collector
+        self.sample_rate = sample_rate
+        self.rng = rng if rng is not None else random.Random()
+
+    def start_span(self, name, child_of=None, tags=None):
+        """
+        Start a span, either a child of the SpanContext `child_of` or the root
+        of a new trace. Return None if the new trace isn't sampled.
+        """
+        if child_of is None:
+            if self.rng.random() >= self.sample_rate:
+                return None
+            context = SpanContext(self.rng.getrandbits(128),
+                                  self._new_span_id(), 0, SAMPLED_FLAG)
+        else:
+            context = SpanContext(child_of.trace_id, self._new_span_id(),
+                                  child_of.span_id, child_of.flags)
+        return Span(name, context, self.collector, tags)
+
+    def _new_span_id(self):
+        # Zero means no span
+        return self.rng.getrandbits(64) or 1
+
+
+class FileCollector:
+    """Append finished spans as JSON lines to a file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'a')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def record(self, span):
+        self.file.write(json.dumps(span.to_dict()) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read_spans(path):
+    """Return the spans written by a FileCollector, as dicts"""
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
@@ -0,0 +1,302 @@
+# Concord
+#
+# Copyright (c) 2020 VMware, Inc. All Rights Reserved.
+#
+# This product is licensed to you under the Apache 2.0 license (the "License").
+# You may not use this product except in compliance with the Apache 2.0 License.
+#
+# This product may include a number of subcomponents with separate copyright
+# notices and license terms. Your use of these subcomponents is subject to the
+# terms and conditions of the subcomponent's license, as noted in the LICENSE
+# file.
+
+# This code requires python 3.5 or later
+import asyncio
+import math
+import os.path
+import ssl
+import struct
+import trio
+
+# The framing of PlainTcpCommunication: a length, that includes the message
+# type, followed by the message type and the message. TlsTCPCommunication
+# only prefixes each message with its length.
+TCP_LENGTH_FMT = "<L"
+TCP_LENGTH_SIZE = struct.calcsize(TCP_LENGTH_FMT)
+TCP_MSG_TYPE_FMT = "<H"
+TCP_MSG_TYPE_SIZE = struct.calcsize(TCP_MSG_TYPE_FMT)
+TCP_HELLO_MSG_TYPE = 1
+TCP_REGULAR_MSG_TYPE = 2
+# The payload of a hello message is the NodeNum of the sender
+TCP_HELLO_FMT = "<Q"
+
+# The cipher suite the test replicas are configured with
+TLS_CIPHER_SUITE = "ECDHE-ECDSA-AES256-GCM-SHA384"
+
+
+class TrioUdpTransport:
+    """
+    A UDP socket driven by trio. Datagrams are pulled by the caller with
+    `recvfrom` or `recvfrom_into`.
+    """
+
+    def __init__(self):
+        self.sock = trio.socket.socket(trio.socket.AF_INET,
+                                       trio.socket.SOCK_DGRAM)
+
+    async def bind(self, address):
+        await self.sock.bind(address)
+
+    async def sendto(self, data, address):
+        await self.sock.sendto(data, address)
+
+    async def recvfrom(self, size):
+        """Return a pair of a new bytes object and the sender address"""
+        return await self.sock.recvfrom(size)
+
+    async def recvfrom_into(self, buf):
+        """Receive into buf and return the number of bytes and the sender"""
+        return await self.sock.recvfrom_into(buf)
+
+    def close(self):
+        self.sock.close()
+
+
+class AsyncioUdpTransport(asyncio.DatagramProtocol):
+    """
+    A UDP endpoint driven by an asyncio event loop, including uvloop.
+
+    Datagrams are pushed to the `on_datagram(data, sender)` callback directly
+    from the event loop as they arrive, so receiving doesn't require a task.
+    Sends never block: they are queued by the event loop if the socket isn't
+    writable.
+    """
+
+    def __init__(self, on_datagram):
+        self.on_datagram = on_datagram
+        self.datagram_transport = None
+
+    @classmethod
+    async def open(cls, on_datagram, local_address=None):
+        """
+        Create an endpoint bound to local_address, or to an ephemeral port if
+        local_address is None.
+        """
+        loop = asyncio.get_running_loop()
+        if local_address is None:
+            local_address = ("0.0.0.0", 0)
+        _, protocol = await loop.create_datagram_endpoint(
+            lambda: cls(on_datagram), local_addr=local_address)
+        return protocol
+
+    def connection_made(self, transport):
+        self.datagram_transport = transport
+
+    def datagram_received(self, data, sender):
+        self.on_datagram(data, sender)
+
+    def error_received(self, exc):
+        # ICMP errors, such as a replica that isn't up yet, are treated like
+        # lost datagrams and handled by retries.
+        pass
+
+    def sendto(self, data, address):
+        self.datagram_transport.sendto(data, address)
+
+    def close(self):
+        if self.datagram_transport is not None:
+            self.datagram_transport.close()
+
+
+def pack_tcp_msg(msg, tls=False, msg_type=TCP_REGULAR_MSG_TYPE):
+    """Return a message framed for a TCP or TLS connection to a replica"""
+    if tls:
+        return b''.join([struct.pack(TCP_LENGTH_FMT, len(msg)), msg])
+    return b''.join([struct.pack(TCP_LENGTH_FMT, TCP_MSG_TYPE_SIZE + len(msg)),
+                     struct.pack(TCP_MSG_TYPE_FMT, msg_type),
+                     msg])
+
+def pack_tcp_hello(node_id):
+    """Return the hello message that identifies a plain TCP client"""
+    return pack_tcp_msg(struct.pack(TCP_HELLO_FMT, node_id),
+                        msg_type=TCP_HELLO_MSG_TYPE)
+
+def tls_client_context(certs_dir, client_id, replica_id,
+                       cipher_suite=TLS_CIPHER_SUITE):
+    """
+    Return an SSLContext for a client connection to a replica, given a folder
+    created by scripts/linux/create_tls_certs.sh.
+
+    As in TlsTCPCommunication, the client presents
+    `certs_dir/<client_id>/client/client.cert`, and the replica's certificate
+    is pinned to `certs_dir/<replica_id>/server/server.cert`.
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.maximum_version = ssl.TLSVersion.TLSv1_2
+    context.set_ciphers(cipher_suite)
+    # Certificates identify nodes by their OU rather than by host name
+    context.check_hostname = False
+    context.load_verify_locations(
+        os.path.join(certs_dir, str(replica_id), "server", "server.cert"))
+    client_dir = os.path.join(certs_dir, str(client_id), "client")
+    context.load_cert_chain(os.path.join(client_dir, "client.cert"),
+                            os.path.join(client_dir, "pk.pem"))
+    return context
+
+
+class _TcpConnection:
+    """A connection to a single replica and its receive buffer"""
+
+    def __init__(self):
+        self.stream = None
+        self.lock = trio.Lock()
+        self.buf = bytearray()
+
+    async def receive_exactly(self, size):
+        """Return the next size bytes of the stream, or None at EOF"""
+        while len(self.buf) < size:
+            data = await self.stream.receive_some()
+            if not data:
+                return None
+            self.buf += data
+        data = bytes(self.buf[:size])
+        del self.buf[:size]
+        return data
+
+
+class TrioTcpTransport:
+    """
+    Persistent TCP connections to replicas, driven by trio, with the framing
+    of PlainTcpCommunication. If `certs_dir` is given, the connections use TLS
+    and the framing of TlsTCPCommunication instead.
+
+    The transport keeps the datagram interface of TrioUdpTransport, so it can
+    be used under the UDP clients. A message sent to a replica's address is
+    sent on the connection to that replica, which is established on demand.
+    If the replica can't be reached the message is dropped, like a lost
+    datagram, and the next send reconnects. Messages received on any
+    connection are returned by `recvfrom_into` along with the replica address.
+    Any number of tasks may send concurrently.
+
+    Each connection has a reader task that runs as long as the async context,
+    and all connections are closed when it exits:
+
+        async with TrioTcpTransport(client_id, replicas) as transport:
+            ...
+    """
+
+    def __init__(self, client_id, replicas, certs_dir=None,
+                 cipher_suite=TLS_CIPHER_SUITE):
+        self.client_id = client_id
+        self.replica_ids = {(r.ip, r.port): r.id for r in replicas}
+        self.certs_dir = certs_dir
+        self.cipher_suite = cipher_suite
+        self.tls = certs_dir is not None
+        self.connections = {address: _TcpConnection()
+                            for address in self.replica_ids}
+        self._send_channel = None
+        self._recv_channel = None
+        self._nursery_manager = None
+        self._nursery = None
+
+    async def __aenter__(self):
+        self._send_channel, self._recv_channel = \
+            trio.open_memory_channel(math.inf)
+        self._nursery_manager = trio.open_nursery()
+        self._nursery = await self._nursery_manager.__aenter__()
+        return self
+
+    async def __aexit__(self, *args):
+        """Stop the reader tasks and close all connections"""
+        self.close()
+        try:
+            return await self._nursery_manager.__aexit__(*args)
+        finally:
+            self._nursery_manager = None
+            self._nursery = None
+            for connection in self.connections.values():
+                if connection.stream is not None:
+                    await trio.aclose_forcefully(connection.stream)
+                    connection.stream = None
+
+    async def bind(self, address):
+        # All connections are outgoing
+        pass
+
+    async def sendto(self, data, address):
+        connection = self.connections[address]
+        async with connection.lock:
+            if connection.stream is None:
+                try:
+                    await self._connect(address, connection)
+                except (OSError, trio.BrokenResourceError):
+                    return
+            try:
+                await connection.stream.send_all(pack_tcp_msg(data, self.tls))
+            except (trio.BrokenResourceError, trio.ClosedResourceError):
+                self._disconnect(connection)
+
+    async def recvfrom_into(self, buf):
+        """
+        Receive the next message from any replica into buf and return the
+        number of bytes and the replica address. Like a datagram, a message
+        that doesn't fit in buf is truncated.
+        """
+        address, msg = await self._recv_channel.receive()
+        nbytes = min(len(msg), len(buf))
+        buf[:nbytes] = msg[:nbytes]
+        return nbytes, address
+
+    def close(self):
+        if self._recv_channel is not None:
+            self._recv_channel.close()
+        if self._nursery is not None:
+            self._nursery.cancel_scope.cancel()
+
+    async def _connect(self, address, connection):
+        stream = await trio.open_tcp_stream(*address)
+        try:
+            if self.tls:
+                context = tls_client_context(self.certs_dir, self.client_id,
+                                             self.replica_ids[address],
+                                             self.cipher_suite)
+                stream = trio.SSLStream(stream, context,
+                                        server_hostname=address[0])
+                await stream.do_handshake()
+            else:
+                await stream.send_all(pack_tcp_hello(self.client_id))
+        except BaseException:
+            await trio.aclose_forcefully(stream)
+            raise
+        connection.stream = stream
+        connection.buf = bytearray()
+        self._nursery.start_soon(self._read, address, connection, stream)
+
+    def _disconnect(self, connection):
+        # The reader task closes the stream once it fails
+        connection.stream = None
+
+    async def _read(self, address, connection, stream):
+        """Receive messages from a connection until it fails"""
+        try:
+            while True:
+                header = await connection.receive_exactly(TCP_LENGTH_SIZE)
+                if header is None:
+                    break
+                length, = struct.unpack(TCP_LENGTH_FMT, header)
+                msg = await connection.receive_exactly(length)
+                if msg is None:
+                    break
+                if not self.tls:
+                    msg_type, = struct.unpack_from(TCP_MSG_TYPE_FMT, msg)
+                    if msg_type != TCP_REGULAR_MSG_TYPE:
+                        continue
+                    msg = msg[TCP_MSG_TYPE_SIZE:]
+                await self._send_channel.send((address, msg))
+        except (trio.BrokenResourceError, trio.ClosedResourceError):
+            pass
+        finally:
+            if connection.stream is stream:
+                connection.stream = None
+            await trio.aclose_forcefully(stream)
@@ -0,0 +1,297 @@
+# Concord
+#
+# Copyright (c) 2020 VMware, Inc. All Rights Reserved.
+#
+# This product is licensed to you under the Apache 2.0 license (the "License").
+# You may not use this product except in compliance with the Apache 2.0 License.
+#
+# This product may include a number of subcomponents with separate copyright
+# notices and license terms. Your use of these subcomponents is subject to the
+# terms and conditions of the subcomponent's license, as noted in the LICENSE
+# file.
+
+# This code requires python 3.5 or later
+"""
+Export the metrics of replicas in the OpenMetrics text format over HTTP.
+
+The exporter polls the MetricsServer of every replica concurrently and keeps
+the last snapshot of each. Scrapes are answered from the snapshots, so a slow
+or dead replica never delays them; its metrics just get older, as
+concord_exporter_snapshot_age_seconds shows.
+
+    python3 metrics_exporter.py --replicas 127.0.0.1:4710,127.0.0.1:4712
+
+Replica metrics are exported as one family per value type, labeled with the
+replica id, component and name:
+
+    concord_gauge{replica="0",component="replica",name="view"} 2
+    concord_counter_total{replica="0",component="replica",name="..."} 7
+    concord_status_info{replica="0",component="replica",name="...",value="..."} 1
+    concord_histogram_bucket{replica="0",component="replica",name="...",le="..."} 3
+"""
+import argparse
+import time
+
+import trio
+
+import bft_metrics_client
+from bft_config import Replica
+
+DEFAULT_PORT = 9161
+POLL_INTERVAL = 1.0
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+MAX_REQUEST_HEAD_SIZE = 8 * 1024
+# How long a scraper has to send its request
+REQUEST_TIMEOUT = 5.0
+
+# Upper bounds in seconds of the buckets of the exporter's poll latency
+POLL_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                        0.5, 1.0, 2.5)
+
+# The families of replica metrics, in the order they are exported, with the
+# OpenMetrics type of each
+FAMILIES = (('concord_gauge', 'gauge'),
+            ('concord_counter', 'counter'),
+            ('concord_status', 'info'),
+            ('concord_histogram', 'histogram'))
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"') \
+        .replace('\n', r'\n')
+
+
+def _labels(**labels):
+    return '{' + ','.join(f'{name}="{_escape(value)}"'
+                          for name, value in labels.items()) + '}'
+
+
+def render_replica(replica_id, metrics):
+    """
+    Return the samples of a replica's metrics, as returned by
+    MetricsClient.get, as a dict of lines by family name
+    """
+    lines = {family: [] for family, _ in FAMILIES}
+    for component in metrics['Components']:
+        name = component['Name']
+        for key, value in component.get('Gauges', {}).items():
+            lines['concord_gauge'].append(
+                'concord_gauge' + _labels(replica=replica_id, component=name,
+                                          name=key) + f' {value}')
+        for key, value in component.get('Counters', {}).items():
+            lines['concord_counter'].append(
+                'concord_counter_total' + _labels(replica=replica_id,
+                                                  component=name, name=key)
+                + f' {value}')
+        for key, value in component.get('Statuses', {}).items():
+            lines['concord_status'].append(
+                'concord_status_info' + _labels(replica=replica_id,
+                                                component=name, name=key,
+                                                value=value) + ' 1')
+        for key, value in component.get('Histograms', {}).items():
+            labels = dict(replica=replica_id, component=name, name=key)
+            cumulative = 0
+            for index, count in sorted(value['buckets']):
+                cumulative += count
+                _, high = bft_metrics_client.histogram_bucket_bounds(index)
+                lines['concord_histogram'].append(
+                    'concord_histogram_bucket'
+                    + _labels(**labels, le=float(high)) + f' {cumulative}')
+            lines['concord_histogram'].extend([
+                'concord_histogram_bucket' + _labels(**labels, le='+Inf')
+                + f' {value["count"]}',
+                'concord_histogram_count' + _labels(**labels)
+                + f' {value["count"]}',
+                'concord_histogram_sum' + _labels(**labels)
+                + f' {value["sum"]}'])
+    return lines
+
+
+class _ReplicaPoller:
+    """The last snapshot of a replica and the statistics of polling it"""
+
+    def __init__(self, replica):
+        self.replica = replica
+        # Lines by family of the last snapshot, rendered when it arrives
+        self.lines = None
+        # The wall clock time of the last snapshot
+        self.snapshot_time = None
+        self.up = False
+        self.polls = 0
+        self.failures = 0
+        # Cumulative counts of the poll latency buckets, +Inf last
+        self.latency_buckets = [0] * (len(POLL_LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+
+    def record_latency(self, seconds):
+        for i, bound in enumerate(POLL_LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.latency_buckets[i] += 1
+        self.latency_buckets[-1] += 1
+        self.latency_sum += seconds
+
+
+class MetricsExporter:
+    """
+    Poll the metrics of replicas and render them in the OpenMetrics text
+    format.
+
+    Each replica is polled every `interval` seconds by its own task, and a
+    poll that takes longer than `timeout` seconds fails, so a slow replica
+    only delays its own snapshot. Rendering only reads the snapshots.
+    """
+
+    def __init__(self, replicas, interval=POLL_INTERVAL, timeout=None):
+        self.interval = interval
+        self.timeout = interval if timeout is None else timeout
+        self.pollers = [_ReplicaPoller(replica) for replica in replicas]
+
+    async def run(self):
+        """Poll every replica until cancelled"""
+        async with trio.open_nursery() as nursery:
+            for poller in self.pollers:
+                nursery.start_soon(self._poll, poller)
+
+    async def _poll(self, poller):
+        with bft_metrics_client.MetricsClient(poller.replica) as client:
+            while True:
+                deadline = trio.current_time() + self.interval
+                start = trio.current_time()
+                metrics = None
+                with trio.move_on_after(self.timeout):
+                    try:
+                        metrics = await client.get()
+                    except bft_metrics_client.MetricsError:
+                        pass
+                poller.polls += 1
+                if metrics is None:
+                    poller.failures += 1
+                    poller.up = False
+                else:
+                    poller.record_latency(trio.current_time() - start)
+                    poller.lines = render_replica(poller.replica.id, metrics)
+                    poller.snapshot_time = time.time()
+                    poller.up = True
+                await trio.sleep_until(deadline)
+
+    def render(self):
+        """Return the OpenMetrics text of the last snapshots"""
+        out = []
+        for family, type_ in FAMILIES:
+            out.append(f'# TYPE {family} {type_}')
+            for poller in self.pollers:
+                if poller.lines is not None:
+                    out.extend(poller.lines[family])
+        out.extend(self._render_self())
+        out.append('# EOF\n')
+        return '\n'.join(out)
+
+    def _render_self(self):
+        now = time.time()
+        # Whether the last poll of each replica succeeded
+        up = ['# TYPE concord_exporter_up gauge']
+        age = ['# TYPE concord_exporter_snapshot_age_seconds gauge',
+               '# UNIT concord_exporter_snapshot_age_seconds seconds']
+        polls = ['# TYPE concord_exporter_polls counter']
+        failures = ['# TYPE concord_exporter_poll_failures counter']
+        latency = ['# TYPE concord_exporter_poll_latency_seconds histogram',
+                   '# UNIT concord_exporter_poll_latency_seconds seconds']
+        for poller in self.pollers:
+            labels = _labels(replica=poller.replica.id)
+            up.append(f'concord_exporter_up{labels} {int(poller.up)}')
+            if poller.snapshot_time is not None:
+                age.append(f'concord_exporter_snapshot_age_seconds{labels} '
+                           f'{now - poller.snapshot_time:.3f}')
+            polls.append(f'concord_exporter_polls_total{labels} {poller.polls}')
+            failures.append(f'concord_exporter_poll_failures_total{labels} '
+                            f'{poller.failures}')
+            bounds = [str(bound) for bound in POLL_LATENCY_BUCKETS] + ['+Inf']
+            for bound, count in zip(bounds, poller.latency_buckets):
+                latency.append('concord_exporter_poll_latency_seconds_bucket'
+                               + _labels(replica=poller.replica.id, le=bound)
+                               + f' {count}')
+            latency.append(f'concord_exporter_poll_latency_seconds_count'
+                           f'{labels} {poller.latency_buckets[-1]}')
+            latency.append(f'concord_exporter_poll_latency_seconds_sum'
+                           f'{labels} {poller.latency_sum:.6f}')
+        return up + age + polls + failures + latency
+
+    async def serve(self, port, host='127.0.0.1', task_status=trio.TASK_STATUS_IGNORED):
+        """
+        Answer HTTP GET requests for /metrics on a local port until
+        cancelled
+        """
+        await trio.serve_tcp(self._handle, port, host=host,
+                             task_status=task_status)
+
+    async def _handle(self, stream):
+        try:
+            with trio.move_on_after(REQUEST_TIMEOUT):
+                head = b''
+                while b'\r\n\r\n' not in head:
+                    data = await stream.receive_some(MAX_REQUEST_HEAD_SIZE)
+                    if not data or len(head) > MAX_REQUEST_HEAD_SIZE:
+                        return
+                    head += data
+                request_line = head.split(b'\r\n', 1)[0].split()
+                if len(request_line) < 2 or request_line[0] != b'GET':
+                    await self._respond(stream, '405 Method Not Allowed',
+                                        'text/plain', b'')
+                elif request_line[1].split(b'?')[0] != b'/metrics':
+                    await self._respond(stream, '404 Not Found',
+                                        'text/plain', b'')
+                else:
+                    await self._respond(stream, '200 OK', CONTENT_TYPE,
+                                        self.render().encode())
+        except trio.BrokenResourceError:
+            pass
+        finally:
+            await stream.aclose()
+
+    @staticmethod
+    async def _respond(stream, status, content_type, body):
+        head = (f'HTTP/1.1 {status}\r\n'
+                f'Content-Type: {content_type}\r\n'
+                f'Content-Length: {len(body)}\r\n'
+                f'Connection: close\r\n\r\n')
+        await stream.send_all(head.encode() + body)
+
+
+def parse_replicas(arg):
+    """
+    Return the Replicas of a comma separated list of host:metrics_port,
+    numbered in order
+    """
+    replicas = []
+    for i, address in enumerate(arg.split(',')):
+        host, port = address.rsplit(':', 1)
+        replicas.append(Replica(i, host, None, int(port)))
+    return replicas
+
+
+async def main(args):
+    exporter = MetricsExporter(parse_replicas(args.replicas), args.interval,
+                               args.timeout)
+    async with trio.open_nursery() as nursery:
+        nursery.start_soon(exporter.run)
+        await nursery.start(exporter.serve, args.port, args.host)
+        print(f'Serving metrics on http://{args.host}:{args.port}/metrics')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--replicas', required=True,
+                        help='comma separated host:metrics_port of each '
+                             'replica, in replica id order')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT,
+                        help='the HTTP port to serve metrics on')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='the address to serve metrics on')
+    parser.add_argument('--interval', type=float, default=POLL_INTERVAL,
+                        help='seconds between polls of each replica')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='seconds after which a poll fails, the '
+                             'interval by default')
+    trio.run(main, parser.parse_args())
@@ -17,10 +17,16 @@ import shutil
 import os
 import os.path
 import subprocess
+import asyncio
+import ssl
 import trio
 
 import bft_client
 import bft_config
+import bft_msgs
+import bft_tracing
+import bft_transport
+from bft_transport import AsyncioUdpTransport
 
 # This requires python 3.5 for subprocess.run
 class SimpleTest(unittest.TestCase):
@@ -181,6 +187,585 @@ class SimpleTest(unittest.TestCase):
            self.assertEqual(2, self.read_val(read))
            self.assertNotEqual(None, udp_client.primary)
 
+    def testMultiplexedWrites(self):
+        """Test that many concurrent requests complete on a single client"""
+        self.startServers()
+        try:
+            trio.run(self._testMultiplexedWrites)
+        except:
+            raise
+        finally:
+            self.stopServers()
+
+    async def _testMultiplexedWrites(self):
+       num_writes = 10
+       async with bft_client.MultiplexedUdpClient(self.config, self.replicas) as udp_client:
+           async with trio.open_nursery() as nursery:
+               for val in range(1, num_writes + 1):
+                   nursery.start_soon(udp_client.sendSync,
+                                      self.writeRequest(val), False)
+           self.assertEqual(0, len(udp_client.pending))
+           read = await udp_client.sendSync(self.readRequest(), True)
+           self.assertIn(self.read_val(read), range(1, num_writes + 1))
+
+    def testWriteMany(self):
+        """Test that a batch of writes completes and yields every reply"""
+        self.startServers()
+        try:
+            trio.run(self._testWriteMany)
+        except:
+            raise
+        finally:
+            self.stopServers()
+
+    async def _testWriteMany(self):
+       vals = range(1, 11)
+       with bft_client.UdpClient(self.config, self.replicas) as udp_client:
+           seq_nums = []
+           async for batch_reply in udp_client.write_many(
+                   [self.writeRequest(val) for val in vals]):
+               self.assertTrue(batch_reply.latency > 0)
+               seq_nums.append(batch_reply.seq_num)
+           self.assertEqual(len(vals), len(set(seq_nums)))
+           read = await udp_client.sendSync(self.readRequest(), True)
+           self.assertEqual(vals[-1], self.read_val(read))
+
+
+class QuorumAccumulatorTest(unittest.TestCase):
+    """Test quorum detection of replies without running any servers"""
+
+    def setUp(self):
+        # n=4, f=1, c=0
+        self.accumulator = bft_client.QuorumAccumulator(quorum=3, num_replicas=4)
+        self.header = bft_msgs.ReplyHeader(0, 0, 1, 5)
+
+    def testQuorum(self):
+        self.assertFalse(self.accumulator.add("r0", self.header, b'hello'))
+        self.assertFalse(self.accumulator.add("r1", self.header, b'hello'))
+        self.assertFalse(self.accumulator.add("r2", self.header, b'world'))
+        self.assertTrue(self.accumulator.add("r3", self.header, b'hello'))
+        self.assertEqual(b'hello', self.accumulator.reply)
+        self.assertEqual(self.header, self.accumulator.header)
+        self.assertEqual(["r2"], self.accumulator.divergent_senders())
+
+    def testDuplicateReplyIsCountedOnce(self):
+        self.assertFalse(self.accumulator.add("r0", self.header, b'hello'))
+        self.assertFalse(self.accumulator.add("r0", self.header, b'hello'))
+        self.assertFalse(self.accumulator.add("r1", self.header, b'hello'))
+        self.assertTrue(self.accumulator.add("r2", self.header, b'hello'))
+
+    def testReplacedReply(self):
+        self.accumulator.add("r0", self.header, b'hello')
+        self.accumulator.add("r1", self.header, b'hello')
+        self.accumulator.add("r1", self.header, b'world')
+        self.assertFalse(self.accumulator.add("r2", self.header, b'hello'))
+
+    def testReusedBuffer(self):
+        buf = bytearray(b'hello')
+        for sender in ["r0", "r1", "r2"]:
+            self.accumulator.add(sender, self.header, memoryview(buf))
+        buf[:] = b'world'
+        self.assertEqual(b'hello', self.accumulator.reply)
+
+    def testQuorumImpossible(self):
+        self.accumulator.add("r0", self.header, b'a')
+        self.assertFalse(self.accumulator.is_quorum_impossible())
+        self.accumulator.add("r1", self.header, b'b')
+        self.assertFalse(self.accumulator.is_quorum_impossible())
+        self.accumulator.add("r2", self.header, b'c')
+        self.assertTrue(self.accumulator.is_quorum_impossible())
+        self.assertEqual([], self.accumulator.divergent_senders())
+
+
+class RttEstimatorTest(unittest.TestCase):
+    """Test adaptive retry timeouts without running any servers"""
+
+    def setUp(self):
+        self.config = bft_config.Config(4, 1, 0, 4096, 1000, 50,
+                                        adaptive_retry=True)
+        self.replicas = [bft_config.Replica(i, "127.0.0.1",
+                                            bft_client.BASE_PORT + 2*i, 0)
+                         for i in range(0, 4)]
+
+    def testEstimates(self):
+        estimator = bft_client.RttEstimator()
+        self.assertEqual(None, estimator.rto())
+        estimator.add_sample(.010)
+        self.assertAlmostEqual(.010, estimator.srtt)
+        self.assertAlmostEqual(.030, estimator.rto())
+        for _ in range(100):
+            estimator.add_sample(.010)
+        self.assertAlmostEqual(.010, estimator.rto(), places=4)
+        self.assertEqual(101, estimator.state()['samples'])
+
+    def testRetryTimeout(self):
+        trio.run(self._testRetryTimeout)
+
+    async def _testRetryTimeout(self):
+        with bft_client.UdpClient(self.config, self.replicas) as udp_client:
+            # Without estimates the configured retry timeout is used
+            self.assertEqual(.050, udp_client.retry_timeout(bft_client.READ, 0))
+            for replica in self.replicas[0:3]:
+                sender = (replica.ip, replica.port)
+                udp_client._record_rtt(sender, bft_client.READ,
+                                       trio.current_time() - .020)
+            # The third fastest replica completes the quorum. Its timeout is
+            # srtt + 4*rttvar after a single sample.
+            timeout = udp_client.retry_timeout(bft_client.READ, 0)
+            self.assertAlmostEqual(.060, timeout, places=3)
+            # Exponential backoff
+            self.assertAlmostEqual(2*timeout,
+                                   udp_client.retry_timeout(bft_client.READ, 1),
+                                   places=3)
+            self.assertEqual(1.0, udp_client.retry_timeout(bft_client.READ, 10))
+            self.assertEqual({bft_client.READ}, set(udp_client.rtt_state()[0]))
+
+    def testFixedRetryTimeout(self):
+        trio.run(self._testFixedRetryTimeout)
+
+    async def _testFixedRetryTimeout(self):
+        config = self.config._replace(adaptive_retry=False)
+        with bft_client.UdpClient(config, self.replicas) as udp_client:
+            self.assertEqual(.050, udp_client.retry_timeout(bft_client.WRITE, 3))
+
+
+class HedgeDelayTest(unittest.TestCase):
+    """Test the hedging delay of writes without running any servers"""
+
+    def testHedgeDelay(self):
+        trio.run(self._testHedgeDelay)
+
+    async def _testHedgeDelay(self):
+        config = bft_config.Config(4, 1, 0, 4096, 1000, 50, hedge_percentile=90)
+        with bft_client.UdpClient(config, []) as udp_client:
+            self.assertEqual(None, udp_client.hedge_delay())
+            udp_client.write_latencies.extend(i/1000 for i in range(1, 101))
+            self.assertAlmostEqual(.090, udp_client.hedge_delay())
+
+    def testHedge(self):
+        trio.run(self._testHedge)
+
+    async def _testHedge(self):
+        # The primary drops every request, so a write sent to it only
+        # completes once it's hedged to the other replicas
+        replicas = [bft_config.Replica(i, "127.0.0.1",
+                                       bft_client.BASE_PORT + 2*i, 0)
+                    for i in range(0, 4)]
+        config = bft_config.Config(4, 1, 0, 4096, 2000, 1000, hedge_percentile=90)
+        async with trio.open_nursery() as nursery:
+            for r in replicas[1:]:
+                await nursery.start(self._fake_replica, r)
+            with bft_client.UdpClient(config, replicas) as udp_client:
+                udp_client.primary = replicas[0]
+                udp_client.write_latencies.extend([.05] * 100)
+                start = trio.current_time()
+                self.assertEqual(b'hello', await udp_client.write(b'hello'))
+                # The write didn't wait out the retry timeout
+                self.assertTrue(trio.current_time() - start < .5)
+                self.assertEqual(0, udp_client.retries)
+                self.assertEqual(1, udp_client.hedges)
+                self.assertEqual(1 + len(replicas), udp_client.msgs_sent)
+                # The replies may answer either send, so they aren't sampled
+                self.assertEqual({}, udp_client.rtt_estimators)
+            nursery.cancel_scope.cancel()
+
+    def testNoHedgeAfterImpossibleQuorum(self):
+        trio.run(self._testNoHedgeAfterImpossibleQuorum)
+
+    async def _testNoHedgeAfterImpossibleQuorum(self):
+        # Every replica sends a different reply, so the quorum is known to be
+        # impossible before the write would be hedged
+        replicas = [bft_config.Replica(i, "127.0.0.1",
+                                       bft_client.BASE_PORT + 2*i, 0)
+                    for i in range(0, 4)]
+        config = bft_config.Config(4, 1, 0, 4096, 300, 200, hedge_percentile=90)
+
+        async def divergent_primary(task_status=trio.TASK_STATUS_IGNORED):
+            socks = []
+            for r in replicas:
+                sock = trio.socket.socket(trio.socket.AF_INET, trio.socket.SOCK_DGRAM)
+                await sock.bind((r.ip, r.port))
+                socks.append(sock)
+            task_status.started()
+            try:
+                while True:
+                    data, sender = await socks[0].recvfrom(4096)
+                    header, _, msg, _ = bft_msgs.unpack_request(data)
+                    for i, sock in enumerate(socks):
+                        await sock.sendto(bft_msgs.pack_reply(
+                            0, header.req_seq_num, msg + str(i).encode()), sender)
+            finally:
+                for sock in socks:
+                    sock.close()
+
+        async with trio.open_nursery() as nursery:
+            await nursery.start(divergent_primary)
+            with bft_client.UdpClient(config, replicas) as udp_client:
+                udp_client.primary = replicas[0]
+                udp_client.write_latencies.extend([.05] * 100)
+                with self.assertRaises(trio.TooSlowError):
+                    await udp_client.write(b'hello')
+                self.assertEqual(0, udp_client.hedges)
+            nursery.cancel_scope.cancel()
+
+    async def _fake_replica(self, replica, task_status=trio.TASK_STATUS_IGNORED):
+        """Answer every request with its own payload"""
+        with trio.socket.socket(trio.socket.AF_INET, trio.socket.SOCK_DGRAM) as sock:
+            await sock.bind((replica.ip, replica.port))
+            task_status.started()
+            while True:
+                data, sender = await sock.recvfrom(4096)
+                header, _, msg, _ = bft_msgs.unpack_request(data)
+                await sock.sendto(bft_msgs.pack_reply(0, header.req_seq_num, msg),
+                                  sender)
+
+    def testHedgingDisabled(self):
+        trio.run(self._testHedgingDisabled)
+
+    async def _testHedgingDisabled(self):
+        config = bft_config.Config(4, 1, 0, 4096, 1000, 50)
+        with bft_client.UdpClient(config, []) as udp_client:
+            udp_client.write_latencies.extend(i/1000 for i in range(1, 101))
+            self.assertEqual(None, udp_client.hedge_delay())
+
+
+class MultiplexedUdpClientTest(unittest.TestCase):
+    """
+    Test the scheduling of overlapping and batched requests against fake
+    replicas. Replica 0 is the primary and answers on behalf of all replicas
+    after `delay` seconds, one request at a time. Requests with a b'drop'
+    payload are never answered.
+
+    Use n=4, f=1, c=0
+    """
+
+    def setUp(self):
+        self.replicas = [bft_config.Replica(i, "127.0.0.1",
+                                            bft_client.BASE_PORT + 2*i, 0)
+                         for i in range(0, 4)]
+        self.config = bft_config.Config(4, 1, 0, 4096, 5000, 1000)
+        self.delay = 0
+        self.socks = dict()
+
+    async def _fake_replica(self, replica, task_status=trio.TASK_STATUS_IGNORED):
+        with trio.socket.socket(trio.socket.AF_INET, trio.socket.SOCK_DGRAM) as sock:
+            await sock.bind((replica.ip, replica.port))
+            self.socks[replica.id] = sock
+            task_status.started()
+            while True:
+                data, sender = await sock.recvfrom(4096)
+                header, _, msg, _ = bft_msgs.unpack_request(data)
+                if msg == b'drop' or replica.id != 0:
+                    continue
+                await trio.sleep(self.delay)
+                reply = bft_msgs.pack_reply(0, header.req_seq_num, msg)
+                for replica_sock in self.socks.values():
+                    await replica_sock.sendto(reply, sender)
+
+    async def _start_replicas(self, nursery):
+        for r in self.replicas:
+            await nursery.start(self._fake_replica, r)
+
+    def testCancelledWriteWakesNext(self):
+        trio.run(self._testCancelledWriteWakesNext)
+
+    async def _testCancelledWriteWakesNext(self):
+        async with trio.open_nursery() as nursery:
+            await self._start_replicas(nursery)
+            async with bft_client.MultiplexedUdpClient(self.config, self.replicas) as client:
+                async def dropped_write():
+                    with trio.move_on_after(.05):
+                        await client.write(b'drop')
+
+                nursery.start_soon(dropped_write)
+                while not client.pending:
+                    await trio.sleep(0)
+                start = trio.current_time()
+                self.assertEqual(b'hello', await client.write(b'hello'))
+                # The queued write didn't wait out its retry timeout
+                self.assertTrue(trio.current_time() - start < .5)
+            nursery.cancel_scope.cancel()
+
+    def testWriteMany(self):
+        trio.run(self._testWriteMany)
+
+    async def _testWriteMany(self):
+        # The whole batch takes longer than the request timeout, but none of
+        # its writes does
+        self.delay = .03
+        config = self.config._replace(req_timeout_milli=200)
+        async with trio.open_nursery() as nursery:
+            await self._start_replicas(nursery)
+            with bft_client.UdpClient(config, self.replicas) as client:
+                await self._writeMany(client)
+            async with bft_client.MultiplexedUdpClient(config, self.replicas) as client:
+                await self._writeMany(client)
+            nursery.cancel_scope.cancel()
+
+    async def _writeMany(self, client):
+        msgs = [str(i).encode() for i in range(10)]
+        replies = [batch_reply.reply
+                   async for batch_reply in client.write_many(msgs)]
+        self.assertEqual(msgs, replies)
+        self.assertEqual(0, client.retries)
+        # Every write was sent once: the first one to all replicas and the
+        # others to the primary that the first one revealed
+        self.assertEqual(len(self.replicas) + len(msgs) - 1, client.msgs_sent)
+        self.assertEqual(len(msgs),
+                         client.rtt_estimators[(0, bft_client.WRITE)].samples)
+
+
+class PrimaryCacheTest(unittest.TestCase):
+    """Test sharing the primary between clients without running any servers"""
+
+    def testSharedPrimary(self):
+        trio.run(self._testSharedPrimary)
+
+    async def _testSharedPrimary(self):
+        config = bft_config.Config(4, 1, 0, 4096, 1000, 50)
+        replicas = [bft_config.Replica(i, "127.0.0.1",
+                                       bft_client.BASE_PORT + 2*i, 0)
+                    for i in range(0, 4)]
+        cache = bft_client.PrimaryCache()
+        with bft_client.UdpClient(config, replicas, cache) as client1, \
+             bft_client.UdpClient(config._replace(id=5), replicas, cache) as client2:
+            self.assertEqual(None, client2.primary)
+            client1.primary = replicas[1]
+            self.assertEqual(replicas[1], client2.primary)
+            client2.reset_on_retry()
+            self.assertEqual(None, client1.primary)
+            self.assertEqual(1, cache.updates)
+            self.assertEqual(1, cache.invalidations)
+
+
+class AsyncioUdpClientTest(unittest.TestCase):
+    """
+    Test the asyncio client against fake replicas that answer every request
+
+    Use n=4, f=1, c=0
+    """
+
+    def setUp(self):
+        self.replicas = [bft_config.Replica(i, "127.0.0.1",
+                                            bft_client.BASE_PORT + 2*i, 0)
+                         for i in range(0, 4)]
+        # The span context of each request received by the first replica
+        self.span_contexts = []
+
+    async def _start_replicas(self, count):
+        """
+        Start `count` fake replicas. The first one answers on behalf of all of
+        them, so that writes sent to the primary reach a quorum.
+        """
+        endpoints = []
+        def on_request(replica_id):
+            def answer(data, sender):
+                header, span_context, msg, _ = bft_msgs.unpack_request(data)
+                if replica_id == 0:
+                    self.span_contexts.append(span_context)
+                reply = bft_msgs.pack_reply(0, header.req_seq_num, msg)
+                for endpoint in (endpoints if replica_id == 0
+                                 else [endpoints[replica_id]]):
+                    endpoint.sendto(reply, sender)
+            return answer
+        for r in self.replicas[:count]:
+            endpoints.append(await AsyncioUdpTransport.open(
+                on_request(r.id), (r.ip, r.port)))
+        return endpoints
+
+    def testWriteAndRead(self):
+        asyncio.run(self._testWriteAndRead())
+
+    async def _testWriteAndRead(self):
+        endpoints = await self._start_replicas(4)
+        config = bft_config.Config(4, 1, 0, 4096, 1000, 50)
+        try:
+            async with bft_client.AsyncioUdpClient(config, self.replicas) as client:
+                self.assertEqual(b'hello', await client.write(b'hello'))
+                self.assertEqual(self.replicas[0], client.primary)
+                replies = await asyncio.gather(
+                    *(client.read(str(i).encode()) for i in range(10)))
+                self.assertEqual([str(i).encode() for i in range(10)], replies)
+                self.assertEqual(0, client.retries)
+                self.assertEqual(11, client.telemetry.retries[0])
+                self.assertEqual({}, client.pending)
+        finally:
+            for endpoint in endpoints:
+                endpoint.close()
+
+    def testTimeout(self):
+        asyncio.run(self._testTimeout())
+
+    async def _testTimeout(self):
+        # Two replies are never enough for a quorum of three
+        endpoints = await self._start_replicas(2)
+        config = bft_config.Config(4, 1, 0, 4096, 200, 50)
+        try:
+            async with bft_client.AsyncioUdpClient(config, self.replicas) as client:
+                with self.assertRaises(asyncio.TimeoutError):
+                    await client.read(b'hello')
+                self.assertTrue(client.retries > 0)
+                self.assertEqual(1, client.telemetry.timeouts[bft_client.READ])
+        finally:
+            for endpoint in endpoints:
+                endpoint.close()
+
+
+    def testTracing(self):
+        asyncio.run(self._testTracing())
+
+    async def _testTracing(self):
+        endpoints = await self._start_replicas(4)
+        config = bft_config.Config(4, 1, 0, 4096, 1000, 50)
+        spans_file = tempfile.NamedTemporaryFile(suffix='.jsonl')
+        try:
+            async with bft_client.AsyncioUdpClient(config, self.replicas) as client:
+                await client.write(b'untraced')
+                with bft_tracing.FileCollector(spans_file.name) as collector:
+                    client.tracer = bft_tracing.Tracer(collector)
+                    await client.write(b'traced')
+                    # No trace is sampled
+                    client.tracer.sample_rate = 0
+                    await client.write(b'unsampled')
+        finally:
+            for endpoint in endpoints:
+                endpoint.close()
+
+        untraced, traced, unsampled = self.span_contexts
+        self.assertEqual(b'', untraced)
+        self.assertEqual(b'', unsampled)
+        spans = bft_tracing.read_spans(spans_file.name)
+        self.assertEqual(1, len(spans))
+        context = bft_tracing.unpack_span_context(traced)
+        self.assertEqual(f'{context.trace_id:032x}', spans[0]['trace_id'])
+        self.assertEqual(f'{context.span_id:016x}', spans[0]['span_id'])
+        self.assertEqual(bft_tracing.SAMPLED_FLAG, context.flags)
+        self.assertEqual(str(spans[0]['tags']['req_seq_num']),
+                         spans[0]['tags']['cid'])
+        self.assertEqual(bft_client.WRITE, spans[0]['tags']['type'])
+        self.assertEqual(0, spans[0]['tags']['retries'])
+        self.assertTrue(spans[0]['start'] <= spans[0]['end'])
+
+
+class TcpClientTest(unittest.TestCase):
+    """
+    Test the TCP client against fake replicas that speak the framing of
+    PlainTcpCommunication and TlsTCPCommunication
+
+    Use n=4, f=1, c=0
+    """
+
+    def setUp(self):
+        self.replicas = [bft_config.Replica(i, "127.0.0.1",
+                                            bft_client.BASE_PORT + 2*i, 0)
+                         for i in range(0, 4)]
+        self.config = bft_config.Config(4, 1, 0, 256*1024, 5000, 250)
+        self.hellos = []
+
+    async def _serve(self, nursery, certs_dir=None):
+        """
+        Start fake replicas. The first one answers on behalf of all of them,
+        on the connection of the client to each replica.
+        """
+        streams = dict()
+        locks = {r.id: trio.Lock() for r in self.replicas}
+        tls = certs_dir is not None
+
+        async def serve(replica_id, stream):
+            try:
+                await answer(replica_id, stream)
+            except trio.BrokenResourceError:
+                # The client closed the connection
+                pass
+
+        async def answer(replica_id, stream):
+            connection = bft_transport._TcpConnection()
+            connection.stream = stream
+            while True:
+                header = await connection.receive_exactly(bft_transport.TCP_LENGTH_SIZE)
+                if header is None:
+                    return
+                length, = struct.unpack(bft_transport.TCP_LENGTH_FMT, header)
+                msg = await connection.receive_exactly(length)
+                if not tls:
+                    msg_type, = struct.unpack_from(bft_transport.TCP_MSG_TYPE_FMT, msg)
+                    msg = msg[bft_transport.TCP_MSG_TYPE_SIZE:]
+                    if msg_type == bft_transport.TCP_HELLO_MSG_TYPE:
+                        self.hellos.append(struct.unpack(bft_transport.TCP_HELLO_FMT, msg)[0])
+                        streams[replica_id] = stream
+                        continue
+                streams[replica_id] = stream
+                header, _, request, _ = bft_msgs.unpack_request(msg)
+                reply = bft_transport.pack_tcp_msg(
+                    bft_msgs.pack_reply(0, header.req_seq_num, request), tls)
+                for i in (list(streams) if replica_id == 0 else [replica_id]):
+                    async with locks[i]:
+                        try:
+                            await streams[i].send_all(reply)
+                        except (trio.BrokenResourceError, trio.ClosedResourceError):
+                            # A connection that the client already closed
+                            pass
+
+        for r in self.replicas:
+            handler = lambda stream, replica_id=r.id: serve(replica_id, stream)
+            if tls:
+                context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+                server_dir = os.path.join(certs_dir, str(r.id), "server")
+                context.load_cert_chain(os.path.join(server_dir, "server.cert"),
+                                        os.path.join(server_dir, "pk.pem"))
+                context.verify_mode = ssl.CERT_REQUIRED
+                context.load_verify_locations(os.path.join(
+                    certs_dir, str(self.config.id), "client", "client.cert"))
+                await nursery.start(trio.serve_ssl_over_tcp, handler, r.port,
+                                    context)
+            else:
+                await nursery.start(trio.serve_tcp, handler, r.port)
+
+    async def _writeAndRead(self, certs_dir=None):
+        async with trio.open_nursery() as nursery:
+            await self._serve(nursery, certs_dir)
+            async with bft_client.TcpClient(self.config, self.replicas,
+                                            certs_dir=certs_dir) as client:
+                # Larger than a UDP datagram
+                msg = b'x' * (128*1024)
+                self.assertEqual(msg, await client.write(msg))
+                self.assertEqual(self.replicas[0], client.primary)
+                async with trio.open_nursery() as requests:
+                    for i in range(10):
+                        requests.start_soon(client.read, str(i).encode())
+                self.assertEqual(0, client.retries)
+                self.assertEqual(11, client.telemetry.retries[0])
+            nursery.cancel_scope.cancel()
+
+    def testWriteAndRead(self):
+        trio.run(self._writeAndRead)
+        self.assertEqual([self.config.id] * 4, self.hellos)
+
+    def testTls(self):
+        certs_dir = tempfile.mkdtemp()
+        try:
+            script = os.path.abspath("../../scripts/linux/create_tls_certs.sh")
+            try:
+                subprocess.run([script, str(self.config.id + 1), certs_dir],
+                               check=True, stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+            except (OSError, subprocess.CalledProcessError):
+                self.skipTest("cannot create TLS certificates")
+            trio.run(self._writeAndRead, certs_dir)
+        finally:
+            shutil.rmtree(certs_dir)
+
+    def testOutsideOfContext(self):
+        trio.run(self._testOutsideOfContext)
+
+    async def _testOutsideOfContext(self):
+        with bft_client.TcpClient(self.config, self.replicas) as client:
+            with self.assertRaises(RuntimeError):
+                await client.read(b'hello')
+            with self.assertRaises(RuntimeError):
+                async for _ in client.write_many([b'hello']):
+                    pass
+        self.assertEqual([], self.hellos)
 
 if __name__ == '__main__':
     unittest.main()
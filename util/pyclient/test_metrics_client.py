@@ -15,10 +15,14 @@
 import unittest
 import subprocess
 import os.path
+import asyncio
+import struct
 import trio
 
 from bft_config import Replica
-from bft_metrics_client import MetricsClient
+import bft_metrics_client
+from bft_metrics_client import MetricsClient, AsyncioMetricsClient, \
+    MetricsSubscriber
 
 TIMEOUT_MILLI = 5000
 CHECK_MILLI = 100
@@ -52,5 +56,132 @@ class MetricsClientTest(unittest.TestCase):
                         self.assertEqual([], metrics['Components'])
                         return
 
+    def testGetQuery(self):
+        trio.run(self._testGetQuery)
+
+    async def _testGetQuery(self):
+        with MetricsClient(self.replica) as client:
+            with trio.fail_after(TIMEOUT_MILLI/1000):
+                while True:
+                    with trio.move_on_after(CHECK_MILLI/1000):
+                        metrics = await client.get(
+                            ['replica', ('replica', 'Gauges', 'view')])
+                        # There are no components to select
+                        self.assertEqual([], metrics['Components'])
+                        return
+
+    def testGetJson(self):
+        trio.run(self._testGetJson)
+
+    async def _testGetJson(self):
+        with MetricsClient(self.replica, binary=False) as client:
+            with trio.fail_after(TIMEOUT_MILLI/1000):
+                while True:
+                    with trio.move_on_after(CHECK_MILLI/1000):
+                        metrics = await client.get()
+                        self.assertEqual([], metrics['Components'])
+                        return
+
+    def testGetAsyncio(self):
+        asyncio.run(self._testGetAsyncio())
+
+    async def _testGetAsyncio(self):
+        async with AsyncioMetricsClient(self.replica) as client:
+            deadline = asyncio.get_running_loop().time() + TIMEOUT_MILLI/1000
+            # Retry every CHECK_MILLI until the server comes up. Give up
+            # after TIMEOUT_MILLI.
+            while True:
+                try:
+                    metrics = await asyncio.wait_for(client.get(), CHECK_MILLI/1000)
+                    self.assertEqual([], metrics['Components'])
+                    metrics = await asyncio.wait_for(
+                        client.get(['replica', ('replica', 'Gauges', 'view')]),
+                        CHECK_MILLI/1000)
+                    self.assertEqual([], metrics['Components'])
+                    self.assertTrue(client.binary)
+                    return
+                except asyncio.TimeoutError:
+                    if asyncio.get_running_loop().time() >= deadline:
+                        raise
+
+    def testSubscribe(self):
+        trio.run(self._testSubscribe)
+
+    async def _testSubscribe(self):
+        async with MetricsSubscriber(self.replica) as subscriber:
+            # The subscription is resent until the server comes up
+            with trio.fail_after(TIMEOUT_MILLI/1000):
+                await subscriber.wait_for(lambda s: True)
+            self.assertEqual(0, subscriber.seq_num)
+            self.assertEqual([], subscriber.to_dict()['Components'])
+            self.assertRaises(KeyError, subscriber.get,
+                              'replica', 'Gauges', 'view')
+
+class BinaryMetricsTest(unittest.TestCase):
+    """Test decoding the binary encoding of Aggregator::ToBinary"""
+
+    @staticmethod
+    def string(s):
+        return struct.pack("<H", len(s)) + s.encode()
+
+    @classmethod
+    def names(cls, names):
+        return struct.pack("<I", len(names)) + \
+            b''.join(cls.string(name) for name in names)
+
+    def testDecode(self):
+        names = b''.join([struct.pack("<I", 1), self.string('replica'),
+                          self.names(['view', 'peers']), self.names(['state']),
+                          self.names(['sent']), self.names(['latency'])])
+        values = b''.join([struct.pack("<QQ", 2, 3), self.string('primary'),
+                           struct.pack("<Q", 7),
+                           struct.pack("<QQQQI", 3, 46, 3, 40, 2),
+                           struct.pack("<HQHQ", 3, 2, 36, 1)])
+        data = struct.pack("<QB", 5, 1) + names + values
+
+        names, offset = bft_metrics_client._unpack_names(data, 9)
+        self.assertEqual([('replica', ['view', 'peers'], ['state'], ['sent'],
+                           ['latency'])],
+                         names)
+        metrics = bft_metrics_client._unpack_values(data, offset, names)
+        self.assertEqual({'Components': [{'Name': 'replica',
+                                          'Gauges': {'view': 2, 'peers': 3},
+                                          'Statuses': {'state': 'primary'},
+                                          'Counters': {'sent': 7},
+                                          'Histograms': {'latency': {
+                                              'count': 3, 'sum': 46,
+                                              'min': 3, 'max': 40,
+                                              'buckets': [[3, 2], [36, 1]]}}}]},
+                         metrics)
+
+        # Values that don't match the names
+        self.assertRaises(bft_metrics_client.MetricsError,
+                          bft_metrics_client._unpack_values,
+                          values + b'x', 0, names)
+
+    def testReply(self):
+        reply = bft_metrics_client._Reply(4, True)
+        header = lambda msg_type, seq_num: struct.pack("<BQ", msg_type, seq_num)
+        # Fragments of another request are ignored
+        self.assertFalse(reply.add(header(7, 3) + struct.pack("<HH", 0, 1)))
+        self.assertFalse(reply.add(header(7, 4) + struct.pack("<HH", 1, 2) + b'cd'))
+        self.assertTrue(reply.add(header(7, 4) + struct.pack("<HH", 0, 2) + b'ab'))
+        self.assertEqual(b'abcd', reply.data)
+
+        self.assertRaises(bft_metrics_client.MetricsError, reply.add, b'\x07')
+        # A JSON reply to a binary request
+        self.assertRaises(bft_metrics_client.MetricsError, reply.add,
+                          header(1, 4) + b'{}')
+
+        reply = bft_metrics_client._Reply(5, False)
+        self.assertTrue(reply.add(header(2, 5) + b'unknown request'))
+        self.assertEqual('unknown request', reply.error)
+
+    def testPackQuery(self):
+        self.assertEqual(b'', bft_metrics_client._pack_query(None))
+        self.assertEqual(b'replica\nstate\tGauges\tblocks',
+                         bft_metrics_client._pack_query(
+                             ['replica', ('state', 'Gauges', 'blocks')]))
+
 if __name__ == '__main__':
     unittest.main()
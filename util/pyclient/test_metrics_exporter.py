@@ -0,0 +1,98 @@
+# Concord
+#
+# Copyright (c) 2020 VMware, Inc. All Rights Reserved.
+#
+# This product is licensed to you under the Apache 2.0 license (the "License").
+# You may not use this product except in compliance with the Apache 2.0 License.
+#
+# This product may include a number of subcomponents with separate copyright
+# notices and license terms. Your use of these subcomponents is subject to the
+# terms and conditions of the subcomponent's license, as noted in the LICENSE
+# file.
+
+import unittest
+
+import trio
+
+from bft_config import Replica
+from metrics_exporter import MetricsExporter, render_replica, parse_replicas
+
+METRICS = {'Components': [{'Name': 'replica',
+                           'Gauges': {'view': 2},
+                           'Statuses': {'state': 'pri"mary'},
+                           'Counters': {'sent': 7},
+                           'Histograms': {'latency': {
+                               'count': 3, 'sum': 46, 'min': 3, 'max': 40,
+                               'buckets': [[36, 1], [3, 2]]}}}]}
+
+class MetricsExporterTest(unittest.TestCase):
+
+    def test_render_replica(self):
+        lines = render_replica(0, METRICS)
+        labels = 'replica="0",component="replica"'
+        self.assertEqual([f'concord_gauge{{{labels},name="view"}} 2'],
+                         lines['concord_gauge'])
+        self.assertEqual([f'concord_counter_total{{{labels},name="sent"}} 7'],
+                         lines['concord_counter'])
+        self.assertEqual(
+            [f'concord_status_info{{{labels},name="state",value="pri\\"mary"}} 1'],
+            lines['concord_status'])
+        # Buckets are cumulative, by the upper bound of each
+        self.assertEqual(
+            [f'concord_histogram_bucket{{{labels},name="latency",le="3.0"}} 2',
+             f'concord_histogram_bucket{{{labels},name="latency",le="41.0"}} 3',
+             f'concord_histogram_bucket{{{labels},name="latency",le="+Inf"}} 3',
+             f'concord_histogram_count{{{labels},name="latency"}} 3',
+             f'concord_histogram_sum{{{labels},name="latency"}} 46'],
+            lines['concord_histogram'])
+
+    def test_render(self):
+        replicas = parse_replicas('127.0.0.1:4710,127.0.0.1:4712')
+        self.assertEqual([0, 1], [replica.id for replica in replicas])
+        self.assertEqual(4712, replicas[1].metrics_port)
+        exporter = MetricsExporter(replicas)
+        exporter.pollers[0].lines = render_replica(0, METRICS)
+        exporter.pollers[0].up = True
+        exporter.pollers[0].record_latency(0.003)
+
+        text = exporter.render()
+        self.assertTrue(text.endswith('# EOF\n'))
+        self.assertIn('# TYPE concord_gauge gauge\nconcord_gauge{', text)
+        self.assertIn('concord_exporter_up{replica="0"} 1', text)
+        self.assertIn('concord_exporter_up{replica="1"} 0', text)
+        self.assertIn('concord_exporter_poll_latency_seconds_bucket'
+                      '{replica="0",le="0.0025"} 0', text)
+        self.assertIn('concord_exporter_poll_latency_seconds_bucket'
+                      '{replica="0",le="0.005"} 1', text)
+
+    def test_scrape_without_replicas(self):
+        trio.run(self._test_scrape_without_replicas)
+
+    async def _test_scrape_without_replicas(self):
+        # Nothing listens on the metrics port of the replica, so polls time
+        # out, but scrapes are still answered right away
+        replica = Replica(id=0, ip="127.0.0.1", port=5161, metrics_port=6171)
+        exporter = MetricsExporter([replica], interval=0.1, timeout=10)
+        async with trio.open_nursery() as nursery:
+            nursery.start_soon(exporter.run)
+            listeners = await nursery.start(exporter.serve, 0)
+            port = listeners[0].socket.getsockname()[1]
+            with trio.fail_after(1):
+                stream = await trio.open_tcp_stream('127.0.0.1', port)
+                await stream.send_all(b'GET /metrics HTTP/1.1\r\n'
+                                      b'Host: localhost\r\n\r\n')
+                response = b''
+                while True:
+                    data = await stream.receive_some()
+                    if not data:
+                        break
+                    response += data
+            nursery.cancel_scope.cancel()
+        head, body = response.split(b'\r\n\r\n', 1)
+        self.assertTrue(head.startswith(b'HTTP/1.1 200 OK'))
+        self.assertIn(b'application/openmetrics-text', head)
+        self.assertIn(b'concord_exporter_up{replica="0"} 0', body)
+        self.assertTrue(body.endswith(b'# EOF\n'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -52,6 +52,60 @@ class TestPackUnpack(unittest.TestCase):
         self.assertEqual(msg, unpacked_msg)
         self.assertEqual(cid, unpacked_cid)
 
+    def test_pack_request_into(self):
+        msg = b'hello'
+        cid = b'1'
+        offset = 3
+        buf = bytearray(offset + bft_msgs.request_size(msg, cid))
+        end = bft_msgs.pack_request_into(buf, offset, 4, 1, False, 5000, cid,
+                                         msg)
+        self.assertEqual(len(buf), end)
+        self.assertEqual(bft_msgs.pack_request(4, 1, False, 5000, '1', msg),
+                         buf[offset:])
+        header, _, unpacked_msg, unpacked_cid = \
+            bft_msgs.unpack_request_from(buf, offset)
+        self.assertEqual(1, header.req_seq_num)
+        self.assertEqual(msg, unpacked_msg)
+        self.assertEqual('1', unpacked_cid)
+
+    def test_unpack_reply_from(self):
+        msg = b'hello'
+        buf = bytearray(bft_msgs.pack_reply(0, 1, msg))
+        header, view = bft_msgs.unpack_reply_from(buf)
+        self.assertEqual(1, header.req_seq_num)
+        self.assertIsInstance(view, memoryview)
+        self.assertEqual(msg, view)
+        # The view is a lazy slice of the buffer
+        buf[-1] = ord('!')
+        self.assertEqual(b'hell!', view)
+        view.release()
+
+    def test_unpack_reply_headers(self):
+        replies = [bft_msgs.pack_reply(i % 4, i // 4, b'reply %d' % i)
+                   for i in range(12)]
+        headers = bft_msgs.unpack_reply_headers(replies)
+        self.assertEqual(12, len(headers))
+        self.assertEqual([bft_msgs.unpack_reply_header(r) for r in replies],
+                         list(headers))
+        self.assertEqual(bft_msgs.unpack_reply_header(replies[5]), headers[5])
+        self.assertEqual(b'reply 5', headers.payload(5))
+
+        self.assertEqual([8, 9, 10, 11], headers.indices(req_seq_num=2))
+        self.assertEqual([1, 9], headers.indices(req_seq_num={0, 2},
+                                                 primary_id=1))
+        matching = headers.filter(primary_id=3)
+        self.assertEqual([0, 1, 2], list(matching.req_seq_num))
+        self.assertEqual(b'reply 7', matching.payload(1))
+
+        self.assertEqual(0, len(bft_msgs.unpack_reply_headers([])))
+
+    def test_unpack_reply_headers_errors(self):
+        reply = bft_msgs.pack_reply(0, 1, b'hello')
+        self.assertRaises(bft_msgs.MsgError, bft_msgs.unpack_reply_headers,
+                          [reply, b'someinvalidmsg' * 2])
+        self.assertRaises(struct.error, bft_msgs.unpack_reply_headers,
+                          [reply, reply[:-6]])
+
     def test_expect_msg_error(self):
         data = b'someinvalidmsg'
         self.assertRaises(bft_msgs.MsgError, bft_msgs.unpack_request, data)
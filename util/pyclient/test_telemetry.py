@@ -0,0 +1,85 @@
+# Concord
+#
+# Copyright (c) 2020 VMware, Inc. All Rights Reserved.
+#
+# This product is licensed to you under the Apache 2.0 license (the "License").
+# You may not use this product except in compliance with the Apache 2.0 License.
+#
+# This product may include a number of subcomponents with separate copyright
+# notices and license terms. Your use of these subcomponents is subject to the
+# terms and conditions of the subcomponent's license, as noted in the LICENSE
+# file.
+
+import unittest
+import json
+
+from bft_metrics_client import (HISTOGRAM_SUB_BUCKET_BITS, histogram_bucket,
+                                histogram_bucket_bounds)
+from bft_telemetry import LatencyHistogram, ClientTelemetry
+
+class TestLatencyHistogram(unittest.TestCase):
+
+    def test_empty(self):
+        histogram = LatencyHistogram()
+        self.assertEqual(None, histogram.percentile(50))
+        self.assertEqual(0, histogram.to_dict()['count'])
+
+    def test_percentiles(self):
+        histogram = LatencyHistogram()
+        for micros in range(1, 10001):
+            histogram.record(micros / 1e6)
+        self.assertEqual(10000, histogram.total)
+        # Values are accurate within 1/2**HISTOGRAM_SUB_BUCKET_BITS
+        error = 2 ** -HISTOGRAM_SUB_BUCKET_BITS
+        for p in [50, 90, 99, 99.9]:
+            expected = p / 100 * 10000 / 1e6
+            self.assertAlmostEqual(expected, histogram.percentile(p),
+                                   delta=expected * error)
+        self.assertEqual(.01, histogram.percentile(100))
+
+    def test_buckets(self):
+        # Every value falls within the bounds of its bucket, and buckets are
+        # contiguous, as in concordMetrics::Histogram
+        previous_high = -1
+        for bucket in range(histogram_bucket(1 << 20) + 1):
+            low, high = histogram_bucket_bounds(bucket)
+            self.assertEqual(previous_high + 1, low)
+            self.assertEqual(bucket, histogram_bucket(low))
+            self.assertEqual(bucket, histogram_bucket(high))
+            previous_high = high
+
+    def test_merge(self):
+        a = LatencyHistogram()
+        b = LatencyHistogram()
+        a.record(.001)
+        b.record(.003)
+        a.merge(b)
+        self.assertEqual(2, a.total)
+        self.assertEqual(1000, a.min)
+        self.assertEqual(3000, a.max)
+
+class TestClientTelemetry(unittest.TestCase):
+
+    def test_merge_and_serialize(self):
+        a = ClientTelemetry()
+        a.record_request('write', .002, 0)
+        a.record_replies([(0, 1.0), (2, 1.001), (1, 1.003)])
+        b = ClientTelemetry()
+        b.record_request('write', .004, 1)
+        b.record_timeout('read')
+        b.record_replies([(2, 5.0), (0, 5.002)])
+
+        merged = a.snapshot().merge(b)
+        self.assertEqual(1, a.latencies['write'].total)
+        self.assertEqual(2, merged.latencies['write'].total)
+        self.assertEqual({0: 1, 1: 1}, dict(merged.retries))
+        self.assertEqual({'read': 1}, dict(merged.timeouts))
+        self.assertEqual({0: 1, 1: 1}, dict(merged.reply_order[0]))
+        self.assertEqual({0: 1, 1: 1}, dict(merged.reply_order[2]))
+
+        summary = json.loads(merged.to_json())
+        self.assertEqual(2, summary['latencies']['write']['count'])
+        self.assertEqual(2, summary['replicas']['0']['reply_lag']['count'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+# Concord
+#
+# Copyright (c) 2020 VMware, Inc. All Rights Reserved.
+#
+# This product is licensed to you under the Apache 2.0 license (the "License").
+# You may not use this product except in compliance with the Apache 2.0 License.
+#
+# This product may include a number of subcomponents with separate copyright
+# notices and license terms. Your use of these subcomponents is subject to the
+# terms and conditions of the subcomponent's license, as noted in the LICENSE
+# file.
+
+import unittest
+import random
+import struct
+import tempfile
+
+import bft_tracing
+from bft_tracing import SpanContext, Tracer, FileCollector
+
+class TestSpanContext(unittest.TestCase):
+
+    def test_pack_unpack(self):
+        context = SpanContext(2**100 + 5, 7, 3, bft_tracing.SAMPLED_FLAG)
+        packed = bft_tracing.pack_span_context(context)
+        self.assertEqual(bft_tracing.SPAN_CONTEXT_SIZE, len(packed))
+        self.assertEqual(context, bft_tracing.unpack_span_context(packed))
+
+    def test_wire_format(self):
+        packed = bft_tracing.pack_span_context(SpanContext(1, 2, 0, 1))
+        # Big endian ids, as written by the Jaeger binary propagator
+        self.assertEqual(b'\x00' * 15 + b'\x01', packed[:16])
+        self.assertEqual(b'\x00' * 7 + b'\x02', packed[16:24])
+        self.assertEqual(b'\x01' + b'\x00' * 4, packed[32:])
+
+    def test_unpack_error(self):
+        self.assertRaises(struct.error, bft_tracing.unpack_span_context,
+                          b'short')
+
+class TestTracer(unittest.TestCase):
+
+    def test_sampling(self):
+        tracer = Tracer(sample_rate=0.25, rng=random.Random(1))
+        spans = [tracer.start_span('request') for _ in range(1000)]
+        sampled = [span for span in spans if span is not None]
+        self.assertTrue(150 < len(sampled) < 350)
+        self.assertIsNone(Tracer(sample_rate=0).start_span('request'))
+
+    def test_child_spans(self):
+        tracer = Tracer(rng=random.Random(1))
+        parent = tracer.start_span('request')
+        child = tracer.start_span('execute', child_of=parent.context)
+        self.assertEqual(parent.context.trace_id, child.context.trace_id)
+        self.assertEqual(parent.context.span_id, child.context.parent_id)
+        self.assertNotEqual(parent.context.span_id, child.context.span_id)
+
+    def test_file_collector(self):
+        with tempfile.NamedTemporaryFile(suffix='.jsonl') as f:
+            with FileCollector(f.name) as collector:
+                tracer = Tracer(collector)
+                span = tracer.start_span('request', tags={'cid': '1'})
+                span.set_tag('retries', 0)
+                span.finish(end=span.start + 1)
+                # Finishing again doesn't record the span twice
+                span.finish()
+            spans = bft_tracing.read_spans(f.name)
+        self.assertEqual(1, len(spans))
+        self.assertEqual('request', spans[0]['name'])
+        self.assertEqual({'cid': '1', 'retries': 0}, spans[0]['tags'])
+        self.assertEqual(1, spans[0]['end'] - spans[0]['start'])
+        self.assertEqual(f'{span.context.trace_id:032x}', spans[0]['trace_id'])
+
+if __name__ == '__main__':
+    unittest.main()
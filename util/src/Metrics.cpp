@@ -22,6 +22,13 @@ namespace concordMetrics {
 const char* const kGaugeName = "gauge";
 const char* const kStatusName = "status";
 const char* const kCounterName = "counter";
+const char* const kHistogramName = "histogram";
+
+// The names of the value types in JSON
+const char* const kGaugesName = "Gauges";
+const char* const kStatusesName = "Statuses";
+const char* const kCountersName = "Counters";
+const char* const kHistogramsName = "Histograms";
 
 template <typename T>
 T FindValue(const char* const val_type, const string& val_name, const vector<string>& names, const vector<T>& values) {
@@ -53,6 +60,34 @@ Component::Handle<Counter> Component::RegisterCounter(const string& name, const
   return Component::Handle<Counter>(values_.counters_, values_.counters_.size() - 1);
 }
 
+Component::Handle<Histogram> Component::RegisterHistogram(const string& name) {
+  names_.histogram_names_.emplace_back(name);
+  values_.histograms_.emplace_back();
+  return Component::Handle<Histogram>(values_.histograms_, values_.histograms_.size() - 1);
+}
+
+// Encode a histogram as a JSON object with its non-empty buckets as
+// [index, count] pairs.
+static string HistogramJson(const Histogram& histogram) {
+  ostringstream oss;
+  oss << "{\"count\":" << histogram.Count() << ",\"sum\":" << histogram.Sum() << ",\"min\":" << histogram.Min()
+      << ",\"max\":" << histogram.Max() << ",\"buckets\":[";
+  const auto& buckets = histogram.Buckets();
+  bool first = true;
+  for (size_t i = 0; i < buckets.size(); i++) {
+    if (buckets[i] == 0) {
+      continue;
+    }
+    if (!first) {
+      oss << ",";
+    }
+    first = false;
+    oss << "[" << i << "," << buckets[i] << "]";
+  }
+  oss << "]}";
+  return oss.str();
+}
+
 std::list<Metric> Component::CollectGauges() {
   std::list<Metric> ret;
   for (size_t i = 0; i < names_.gauge_names_.size(); i++) {
@@ -80,6 +115,7 @@ std::list<Metric> Component::CollectStatuses() {
 void Aggregator::RegisterComponent(Component& component) {
   std::lock_guard<std::mutex> lock(lock_);
   components_.insert(make_pair(component.Name(), component));
+  names_version_++;
 }
 
 // Throws if the component doesn't exist.
@@ -108,6 +144,12 @@ Counter Aggregator::GetCounter(const string& component_name, const string& val_n
   return FindValue(kCounterName, val_name, component.names_.counter_names_, component.values_.counters_);
 }
 
+Histogram Aggregator::GetHistogram(const string& component_name, const string& val_name) {
+  std::lock_guard<std::mutex> lock(lock_);
+  auto& component = components_.at(component_name);
+  return FindValue(kHistogramName, val_name, component.names_.histogram_names_, component.values_.histograms_);
+}
+
 // Generate a JSON string of all aggregated components. To save space we don't
 // add any newline characters.
 std::string Aggregator::ToJson() {
@@ -131,6 +173,203 @@ std::string Aggregator::ToJson() {
 
   return oss.str();
 }
+
+Aggregator::JsonValues Aggregator::ToJsonValues() {
+  std::lock_guard<std::mutex> lock(lock_);
+  JsonValues ret;
+  for (auto& [name, component] : components_) {
+    const auto& names = component.names_;
+    auto& values = component.values_;
+    for (size_t i = 0; i < names.gauge_names_.size(); i++) {
+      ret.emplace(ValueKey{name, kGaugesName, names.gauge_names_[i]}, to_string(values.gauges_[i].Get()));
+    }
+    for (size_t i = 0; i < names.status_names_.size(); i++) {
+      ret.emplace(ValueKey{name, kStatusesName, names.status_names_[i]}, "\"" + values.statuses_[i].Get() + "\"");
+    }
+    for (size_t i = 0; i < names.counter_names_.size(); i++) {
+      ret.emplace(ValueKey{name, kCountersName, names.counter_names_[i]}, to_string(values.counters_[i].Get()));
+    }
+    for (size_t i = 0; i < names.histogram_names_.size(); i++) {
+      ret.emplace(ValueKey{name, kHistogramsName, names.histogram_names_[i]}, HistogramJson(values.histograms_[i]));
+    }
+  }
+  return ret;
+}
+
+template <typename T>
+static void AppendInt(string& out, T val) {
+  // Little endian on all supported platforms
+  out.append(reinterpret_cast<const char*>(&val), sizeof(val));
+}
+
+static void AppendString(string& out, const string& str) {
+  auto len = static_cast<uint16_t>(min(str.size(), size_t(UINT16_MAX)));
+  AppendInt(out, len);
+  out.append(str, 0, len);
+}
+
+static void AppendNames(string& out, const vector<string>& names) {
+  AppendInt(out, static_cast<uint32_t>(names.size()));
+  for (const auto& name : names) {
+    AppendString(out, name);
+  }
+}
+
+static void AppendHistogram(string& out, const Histogram& histogram) {
+  AppendInt(out, histogram.Count());
+  AppendInt(out, histogram.Sum());
+  AppendInt(out, histogram.Min());
+  AppendInt(out, histogram.Max());
+  const auto& buckets = histogram.Buckets();
+  auto num_buckets = count_if(buckets.begin(), buckets.end(), [](uint64_t count) { return count != 0; });
+  AppendInt(out, static_cast<uint32_t>(num_buckets));
+  for (size_t i = 0; i < buckets.size(); i++) {
+    if (buckets[i] != 0) {
+      AppendInt(out, static_cast<uint16_t>(i));
+      AppendInt(out, buckets[i]);
+    }
+  }
+}
+
+static optional<size_t> FindIndex(const string& val_name, const vector<string>& names) {
+  for (size_t i = 0; i < names.size(); i++) {
+    if (names[i] == val_name) {
+      return i;
+    }
+  }
+  return nullopt;
+}
+
+string Aggregator::ToBinary(uint64_t known_names_version, const vector<ValueKey>& keys) {
+  // The values of a component to encode, by index in the order of kTypeNames
+  struct Selection {
+    const string& name;
+    Component& component;
+    bool all;
+    vector<size_t> indices[4];
+  };
+  const char* const kTypeNames[] = {kGaugesName, kStatusesName, kCountersName, kHistogramsName};
+
+  string out;
+  std::lock_guard<std::mutex> lock(lock_);
+  vector<Selection> selections;
+  for (auto& [name, component] : components_) {
+    const vector<string>* names[] = {&component.names_.gauge_names_,
+                                     &component.names_.status_names_,
+                                     &component.names_.counter_names_,
+                                     &component.names_.histogram_names_};
+    Selection selection{name, component, keys.empty(), {}};
+    bool selected = keys.empty();
+    for (const auto& [component_name, type, val_name] : keys) {
+      if (component_name != name) {
+        continue;
+      }
+      if (type.empty()) {
+        selection.all = true;
+        selected = true;
+        break;
+      }
+      for (size_t t = 0; t < 4; t++) {
+        if (type == kTypeNames[t]) {
+          if (auto i = FindIndex(val_name, *names[t])) {
+            selection.indices[t].push_back(*i);
+            selected = true;
+          }
+        }
+      }
+    }
+    if (selected) {
+      selections.push_back(std::move(selection));
+    }
+  }
+
+  AppendInt(out, names_version_);
+  bool with_names = known_names_version != names_version_;
+  AppendInt(out, static_cast<uint8_t>(with_names));
+  if (with_names) {
+    AppendInt(out, static_cast<uint32_t>(selections.size()));
+    for (auto& selection : selections) {
+      const auto& names = selection.component.names_;
+      AppendString(out, selection.name);
+      if (selection.all) {
+        AppendNames(out, names.gauge_names_);
+        AppendNames(out, names.status_names_);
+        AppendNames(out, names.counter_names_);
+        AppendNames(out, names.histogram_names_);
+        continue;
+      }
+      const vector<string>* type_names[] = {
+          &names.gauge_names_, &names.status_names_, &names.counter_names_, &names.histogram_names_};
+      for (size_t t = 0; t < 4; t++) {
+        AppendInt(out, static_cast<uint32_t>(selection.indices[t].size()));
+        for (auto i : selection.indices[t]) {
+          AppendString(out, (*type_names[t])[i]);
+        }
+      }
+    }
+  }
+  for (auto& selection : selections) {
+    auto& values = selection.component.values_;
+    if (selection.all) {
+      for (auto& gauge : values.gauges_) {
+        AppendInt(out, gauge.Get());
+      }
+      for (auto& status : values.statuses_) {
+        AppendString(out, status.Get());
+      }
+      for (auto& counter : values.counters_) {
+        AppendInt(out, counter.Get());
+      }
+      for (const auto& histogram : values.histograms_) {
+        AppendHistogram(out, histogram);
+      }
+      continue;
+    }
+    for (auto i : selection.indices[0]) {
+      AppendInt(out, values.gauges_[i].Get());
+    }
+    for (auto i : selection.indices[1]) {
+      AppendString(out, values.statuses_[i].Get());
+    }
+    for (auto i : selection.indices[2]) {
+      AppendInt(out, values.counters_[i].Get());
+    }
+    for (auto i : selection.indices[3]) {
+      AppendHistogram(out, values.histograms_[i]);
+    }
+  }
+  return out;
+}
+
+optional<string> Aggregator::GetJsonValue(const ValueKey& key) {
+  const auto& [component_name, type, val_name] = key;
+  std::lock_guard<std::mutex> lock(lock_);
+  auto it = components_.find(component_name);
+  if (it == components_.end()) {
+    return nullopt;
+  }
+  const auto& names = it->second.names_;
+  auto& values = it->second.values_;
+  if (type == kGaugesName) {
+    if (auto i = FindIndex(val_name, names.gauge_names_)) {
+      return to_string(values.gauges_[*i].Get());
+    }
+  } else if (type == kStatusesName) {
+    if (auto i = FindIndex(val_name, names.status_names_)) {
+      return "\"" + values.statuses_[*i].Get() + "\"";
+    }
+  } else if (type == kCountersName) {
+    if (auto i = FindIndex(val_name, names.counter_names_)) {
+      return to_string(values.counters_[*i].Get());
+    }
+  } else if (type == kHistogramsName) {
+    if (auto i = FindIndex(val_name, names.histogram_names_)) {
+      return HistogramJson(values.histograms_[*i]);
+    }
+  }
+  return nullopt;
+}
+
 std::list<Metric> Aggregator::CollectGauges() {
   std::lock_guard<std::mutex> lock(lock_);
   std::list<Metric> ret;
@@ -206,6 +445,19 @@ std::string Component::ToJson() {
   }
 
   // End counters
+  oss << "},";
+
+  // Add any histograms
+  oss << "\"Histograms\":{";
+
+  for (size_t i = 0; i < names_.histogram_names_.size(); i++) {
+    if (i != 0) {
+      oss << ",";
+    }
+    oss << "\"" << names_.histogram_names_[i] << "\":" << HistogramJson(values_.histograms_[i]);
+  }
+
+  // End histograms
   oss << "}";
 
   // End component
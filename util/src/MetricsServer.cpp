@@ -12,8 +12,11 @@
 // LICENSE file.
 
 #include <string.h>
+#include <poll.h>
 #include <unistd.h>
+#include <algorithm>
 #include <iostream>
+#include <sstream>
 #include <arpa/inet.h>
 
 #include "MetricsServer.hpp"
@@ -21,6 +24,49 @@
 
 namespace concordMetrics {
 
+using namespace std::chrono;
+
+// Limits on subscriptions, so that clients can't make the server busy
+const size_t kMaxSubscribers = 16;
+const milliseconds kMaxLease = seconds(60);
+
+// How often watched values are checked for changes
+const milliseconds kWatchCheckInterval{5};
+
+// How long to wait for requests when no update is due. This also bounds the
+// time Stop() waits for RecvLoop to notice.
+const milliseconds kIdlePollInterval{100};
+
+// Generate the JSON of an update, in the format of Aggregator::ToJson
+static std::string UpdateToJson(const Aggregator::JsonValues& values, bool full) {
+  std::ostringstream oss;
+  oss << "{\"Full\":" << (full ? "true" : "false") << ",\"Components\":[";
+  const std::string* component = nullptr;
+  const std::string* type = nullptr;
+  for (const auto& [key, value] : values) {
+    const auto& [component_name, type_name, name] = key;
+    if (component == nullptr || *component != component_name) {
+      if (component != nullptr) {
+        oss << "}},";
+      }
+      oss << "{\"Name\":\"" << component_name << "\",\"" << type_name << "\":{";
+      component = &component_name;
+      type = &type_name;
+    } else if (*type != type_name) {
+      oss << "},\"" << type_name << "\":{";
+      type = &type_name;
+    } else {
+      oss << ",";
+    }
+    oss << "\"" << name << "\":" << value;
+  }
+  if (component != nullptr) {
+    oss << "}}";
+  }
+  oss << "]}";
+  return oss.str();
+}
+
 void Server::Start() {
   if ((sock_ = socket(AF_INET, SOCK_DGRAM, 0)) < 0) {
     LOG_FATAL(logger_, "Error creating UDP socket");
@@ -82,6 +128,14 @@ void Server::RecvLoop() {
     }
     running_lock_.unlock();
 
+    // Wait for a request until the next update is due
+    struct pollfd pfd;
+    pfd.fd = sock_;
+    pfd.events = POLLIN;
+    if (poll(&pfd, 1, pushUpdates().count()) <= 0 || !(pfd.revents & POLLIN)) {
+      continue;
+    }
+
     socklen_t addrlen = sizeof(cliaddr);
     len = recvfrom(sock_, buf_, MAX_MSG_SIZE, 0, (sockaddr*)&cliaddr, &addrlen);
 
@@ -90,6 +144,21 @@ void Server::RecvLoop() {
       continue;
     }
 
+    if (buf_[0] == kSubscribe && len >= (int)(sizeof(Header) + sizeof(SubscribeRequest))) {
+      subscribe(len, &cliaddr, addrlen);
+      continue;
+    }
+
+    if (buf_[0] == kUnsubscribe && len == sizeof(Header)) {
+      unsubscribe(&cliaddr);
+      continue;
+    }
+
+    if (buf_[0] == kBinaryRequest && len >= (int)(sizeof(Header) + sizeof(BinaryRequest))) {
+      sendBinaryReply(len, &cliaddr, addrlen);
+      continue;
+    }
+
     if (buf_[0] != kRequest || len != sizeof(Header)) {
       LOG_WARN(logger_, "Received invalid request");
       sendError(&cliaddr, addrlen);
@@ -99,8 +168,10 @@ void Server::RecvLoop() {
     std::string json = aggregator_->ToJson();
 
     if (json.size() > MAX_MSG_SIZE - sizeof(Header)) {
-      LOG_FATAL(logger_, "Aggregator data too large to be transmitted!");
-      exit(1);
+      // Clients can get the metrics with a binary request instead
+      LOG_ERROR(logger_, "Aggregator data too large to be transmitted as JSON!");
+      sendError(&cliaddr, addrlen, "Metrics too large for JSON");
+      continue;
     }
 
     sendReply(json, &cliaddr, addrlen);
@@ -116,8 +187,7 @@ void Server::sendReply(std::string data, sockaddr_in* cliaddr, socklen_t addrlen
   }
 }
 
-void Server::sendError(sockaddr_in* cliaddr, socklen_t addrlen) {
-  const char* msg = "Invalid Request";
+void Server::sendError(sockaddr_in* cliaddr, socklen_t addrlen, const char* msg) {
   auto msglen = strlen(msg);
 
   buf_[0] = kError;
@@ -128,4 +198,196 @@ void Server::sendError(sockaddr_in* cliaddr, socklen_t addrlen) {
   }
 }
 
+bool Server::parseKeys(size_t offset, size_t len, bool components, std::vector<Aggregator::ValueKey>& keys) {
+  std::istringstream lines(std::string((const char*)buf_ + offset, len - offset));
+  std::string line;
+  while (std::getline(lines, line)) {
+    if (line.empty()) {
+      continue;
+    }
+    auto first = line.find('\t');
+    if (first == std::string::npos && components) {
+      keys.emplace_back(line, "", "");
+      continue;
+    }
+    auto second = first == std::string::npos ? first : line.find('\t', first + 1);
+    if (second == std::string::npos) {
+      return false;
+    }
+    keys.emplace_back(line.substr(0, first), line.substr(first + 1, second - first - 1), line.substr(second + 1));
+  }
+  return true;
+}
+
+void Server::sendBinaryReply(size_t len, sockaddr_in* cliaddr, socklen_t addrlen) {
+  Header header;
+  BinaryRequest req;
+  memcpy(&header, buf_, sizeof(header));
+  memcpy(&req, buf_ + sizeof(Header), sizeof(req));
+  std::vector<Aggregator::ValueKey> keys;
+  if (!parseKeys(sizeof(Header) + sizeof(req), len, true, keys)) {
+    LOG_WARN(logger_, "Received invalid binary request");
+    sendError(cliaddr, addrlen);
+    return;
+  }
+  std::string data = aggregator_->ToBinary(req.names_version_, keys);
+
+  auto num_fragments = (data.size() + kMaxFragmentSize - 1) / kMaxFragmentSize;
+  if (num_fragments > UINT16_MAX) {
+    LOG_ERROR(logger_, "Aggregator data too large to be transmitted!");
+    sendError(cliaddr, addrlen, "Metrics too large");
+    return;
+  }
+
+  header.msg_type_ = kBinaryReply;
+  memcpy(buf_, &header, sizeof(header));
+  FragmentHeader fragment{0, static_cast<uint16_t>(num_fragments)};
+  for (size_t offset = 0; offset < data.size(); offset += kMaxFragmentSize, fragment.fragment_++) {
+    auto size = std::min(kMaxFragmentSize, data.size() - offset);
+    memcpy(buf_ + sizeof(Header), &fragment, sizeof(fragment));
+    memcpy(buf_ + sizeof(Header) + sizeof(fragment), data.data() + offset, size);
+    auto len = sendto(
+        sock_, buf_, sizeof(Header) + sizeof(fragment) + size, 0, (const struct sockaddr*)cliaddr, addrlen);
+    if (len < 0) {
+      LOG_ERROR(logger_, "Failed to send binary reply msg: " << concordUtils::errnoString(errno));
+      return;
+    }
+  }
+}
+
+void Server::subscribe(size_t len, sockaddr_in* cliaddr, socklen_t addrlen) {
+  SubscribeRequest req;
+  memcpy(&req, buf_ + sizeof(Header), sizeof(req));
+
+  std::vector<Aggregator::ValueKey> watched;
+  if (!parseKeys(sizeof(Header) + sizeof(req), len, false, watched)) {
+    LOG_WARN(logger_, "Received invalid subscribe request");
+    sendError(cliaddr, addrlen);
+    return;
+  }
+
+  auto now = steady_clock::now();
+  auto it = std::find_if(subscribers_.begin(), subscribers_.end(), [cliaddr](const Subscriber& s) {
+    return s.addr_.sin_addr.s_addr == cliaddr->sin_addr.s_addr && s.addr_.sin_port == cliaddr->sin_port;
+  });
+  if (it == subscribers_.end()) {
+    if (subscribers_.size() >= kMaxSubscribers) {
+      LOG_WARN(logger_, "Too many metrics subscribers");
+      sendError(cliaddr, addrlen);
+      return;
+    }
+    it = subscribers_.emplace(subscribers_.end());
+    it->addr_ = *cliaddr;
+    it->addrlen_ = addrlen;
+    it->seq_num_ = 0;
+    it->full_ = true;
+  }
+  if (req.full_) {
+    it->full_ = true;
+  }
+  it->interval_ = milliseconds(req.interval_ms_);
+  it->next_update_ = now;
+  it->expires_ = now + std::min(milliseconds(req.lease_ms_), kMaxLease);
+  if (it->watched_ != watched) {
+    it->watched_ = std::move(watched);
+    it->watched_values_.assign(it->watched_.size(), std::nullopt);
+  }
+}
+
+void Server::unsubscribe(sockaddr_in* cliaddr) {
+  subscribers_.erase(std::remove_if(subscribers_.begin(),
+                                    subscribers_.end(),
+                                    [cliaddr](const Subscriber& s) {
+                                      return s.addr_.sin_addr.s_addr == cliaddr->sin_addr.s_addr &&
+                                             s.addr_.sin_port == cliaddr->sin_port;
+                                    }),
+                     subscribers_.end());
+}
+
+// Push the updates that are due, and return the time until the next one may be.
+milliseconds Server::pushUpdates() {
+  auto now = steady_clock::now();
+  subscribers_.erase(std::remove_if(subscribers_.begin(),
+                                    subscribers_.end(),
+                                    [now](const Subscriber& s) { return s.expires_ <= now; }),
+                     subscribers_.end());
+
+  auto next = now + kIdlePollInterval;
+  // All subscribers that are due share the values collected at once
+  std::optional<Aggregator::JsonValues> values;
+  for (auto& subscriber : subscribers_) {
+    bool due = subscriber.full_ || (subscriber.interval_.count() > 0 && subscriber.next_update_ <= now);
+    for (size_t i = 0; i < subscriber.watched_.size(); i++) {
+      auto value = aggregator_->GetJsonValue(subscriber.watched_[i]);
+      if (value != subscriber.watched_values_[i]) {
+        subscriber.watched_values_[i] = std::move(value);
+        due = true;
+      }
+    }
+    if (due) {
+      if (!values) {
+        values = aggregator_->ToJsonValues();
+      }
+      sendUpdate(subscriber, *values);
+      subscriber.next_update_ = now + subscriber.interval_;
+    }
+    if (subscriber.interval_.count() > 0) {
+      next = std::min(next, subscriber.next_update_);
+    }
+    if (!subscriber.watched_.empty()) {
+      next = std::min(next, now + kWatchCheckInterval);
+    }
+  }
+  return std::max(milliseconds(0), ceil<milliseconds>(next - now));
+}
+
+void Server::sendUpdate(Subscriber& subscriber, const Aggregator::JsonValues& values) {
+  Aggregator::JsonValues changed;
+  if (!subscriber.full_) {
+    for (const auto& [key, value] : values) {
+      auto it = subscriber.sent_.find(key);
+      if (it == subscriber.sent_.end() || it->second != value) {
+        changed.emplace(key, value);
+      }
+    }
+    if (changed.empty()) {
+      return;
+    }
+  }
+
+  std::string json = UpdateToJson(subscriber.full_ ? values : changed, subscriber.full_);
+  if (json.size() > MAX_MSG_SIZE - sizeof(Header)) {
+    // It would be as large on every retry, so end the subscription. It's
+    // removed by the next pushUpdates.
+    LOG_ERROR(logger_, "Metrics update too large to be transmitted, ending the subscription");
+    sendError(&subscriber.addr_, subscriber.addrlen_, "Metrics update too large");
+    subscriber.expires_ = steady_clock::time_point::min();
+    return;
+  }
+
+  Header header{kUpdate, subscriber.seq_num_};
+  memcpy(buf_, &header, sizeof(header));
+  memcpy(buf_ + sizeof(Header), json.data(), json.size());
+  auto len = sendto(sock_,
+                    buf_,
+                    json.size() + sizeof(Header),
+                    0,
+                    (const struct sockaddr*)&subscriber.addr_,
+                    subscriber.addrlen_);
+  if (len < 0) {
+    LOG_ERROR(logger_, "Failed to send update msg: " << concordUtils::errnoString(errno));
+    return;
+  }
+
+  if (subscriber.full_) {
+    subscriber.sent_ = values;
+    subscriber.full_ = false;
+  } else {
+    for (auto& [key, value] : changed) {
+      subscriber.sent_[key] = std::move(value);
+    }
+  }
+  subscriber.seq_num_++;
+}
+
 }  // namespace concordMetrics
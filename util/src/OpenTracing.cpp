@@ -20,6 +20,8 @@
 namespace concordUtils {
 void SpanWrapper::setTag(const std::string& name, const std::string& value) {
 #ifdef USE_OPENTRACING
+  // Span is not initialized
+  if (!span_ptr_) return;
   span_ptr_->SetTag(name, value);
 #else
   (void)name;
@@ -29,6 +31,8 @@ void SpanWrapper::setTag(const std::string& name, const std::string& value) {
 
 void SpanWrapper::finish() {
 #ifdef USE_OPENTRACING
+  // Span is not initialized
+  if (!span_ptr_) return;
   span_ptr_->Finish();
 #endif
 }
@@ -21,9 +21,17 @@ import struct
 REQUEST_TYPE = 0
 REPLY_TYPE = 1
 ERROR_TYPE = 2
+SUBSCRIBE_TYPE = 3
+UNSUBSCRIBE_TYPE = 4
+UPDATE_TYPE = 5
+BINARY_REQUEST_TYPE = 6
+BINARY_REPLY_TYPE = 7
 
 HEADER_FMT = "<BQ"
 HEADER_SIZE = struct.calcsize(HEADER_FMT)
+SUBSCRIBE_FMT = "<IIB"
+FRAGMENT_HEADER_FMT = "<HH"
+FRAGMENT_HEADER_SIZE = struct.calcsize(FRAGMENT_HEADER_FMT)
 
 class MetricsSeverTest(unittest.TestCase):
     """
@@ -74,3 +82,44 @@ class MetricsSeverTest(unittest.TestCase):
        request = b'hello'
        reply = self.sendAndReceive(request)
        self.assertEqual(2, reply[0])
+
+    def testSubscribe(self):
+       """ Subscribe and wait for a full update """
+       request = b''.join([struct.pack(HEADER_FMT, SUBSCRIBE_TYPE, 0),
+                           struct.pack(SUBSCRIBE_FMT, 100, 1000, 0)])
+       update = self.sendAndReceive(request)
+       update_type, seq_num = struct.unpack(HEADER_FMT, update[0:HEADER_SIZE])
+       self.assertEqual(UPDATE_TYPE, update_type)
+       self.assertEqual(0, seq_num)
+       metrics = json.loads(update[HEADER_SIZE:])
+       self.assertTrue(metrics['Full'])
+       self.assertEqual([], metrics['Components'])
+       self.sock.sendto(struct.pack(HEADER_FMT, UNSUBSCRIBE_TYPE, 0),
+                        self.server_addr)
+
+    def testInvalidSubscribe(self):
+       """ Subscribe with a malformed watched value """
+       request = b''.join([struct.pack(HEADER_FMT, SUBSCRIBE_TYPE, 0),
+                           struct.pack(SUBSCRIBE_FMT, 100, 1000, 0),
+                           b'replica\tGauges'])
+       reply = self.sendAndReceive(request)
+       self.assertEqual(ERROR_TYPE, reply[0])
+
+    def testBinary(self):
+       """ Send a binary request and wait for a single fragment reply """
+       seq_num = 9
+       request = b''.join([struct.pack(HEADER_FMT, BINARY_REQUEST_TYPE, seq_num),
+                           struct.pack("<Q", 0)])
+       reply = self.sendAndReceive(request)
+       reply_type, replied_seq_num = struct.unpack(HEADER_FMT,
+                                                   reply[0:HEADER_SIZE])
+       self.assertEqual(BINARY_REPLY_TYPE, reply_type)
+       self.assertEqual(seq_num, replied_seq_num)
+       fragment, num_fragments = struct.unpack_from(FRAGMENT_HEADER_FMT,
+                                                    reply, HEADER_SIZE)
+       self.assertEqual((0, 1), (fragment, num_fragments))
+       # The names version, the names and zero components
+       _, with_names, num_components = struct.unpack(
+           "<QBI", reply[HEADER_SIZE + FRAGMENT_HEADER_SIZE:])
+       self.assertEqual(1, with_names)
+       self.assertEqual(0, num_components)
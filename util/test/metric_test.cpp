@@ -13,6 +13,7 @@
 //
 
 #include <cstdlib>
+#include <cstring>
 #include "gtest/gtest.h"
 #include "Metrics.hpp"
 
@@ -83,13 +84,19 @@ TEST(MetricTest, ToJson) {
   c.RegisterStatus("commit_path", "SLOW");
   c.RegisterCounter("messages_sent", 0);
   c.RegisterCounter("messages_received", 1);
+  auto h_histogram = c.RegisterHistogram("commit_latency");
   c.Register();
 
   Component c2("state-transfer", aggregator);
   c2.RegisterGauge("blocks-remaining", 4);
   c2.RegisterStatus("state", "sending-blocks");
+  c2.RegisterHistogram("fetch_duration");
   c2.Register();
 
+  h_histogram.Get().Record(10);
+  h_histogram.Get().Record(1000);
+  c.UpdateAggregator();
+
   // JSON is valid python. We evaluate the JSON string and see if we get a 0
   // return value. If so it parsed correctly.
   ostringstream oss;
@@ -98,6 +105,40 @@ TEST(MetricTest, ToJson) {
   ASSERT_EQ(0, system(oss.str().c_str()));
 }
 
+TEST(MetricTest, Histogram) {
+  Histogram h;
+  ASSERT_EQ(0, h.Count());
+  ASSERT_EQ(0, h.Min());
+  ASSERT_EQ(0, h.Max());
+
+  h.Record(7);
+  h.Record(1000);
+  h.Record(1010);
+  ASSERT_EQ(3, h.Count());
+  ASSERT_EQ(2017, h.Sum());
+  ASSERT_EQ(7, h.Min());
+  ASSERT_EQ(1010, h.Max());
+  ASSERT_EQ(1, h.Buckets()[7]);
+  ASSERT_EQ(2, h.Buckets()[Histogram::BucketIndex(1000)]);
+
+  // Small values have a bucket each, and every bucket of larger values is
+  // within 1/kSubBuckets of its values
+  ASSERT_EQ(std::make_pair(uint64_t(7), uint64_t(7)), Histogram::BucketBounds(7));
+  for (uint64_t val : {uint64_t(0), uint64_t(31), uint64_t(32), uint64_t(1000), uint64_t(123456789)}) {
+    auto [low, high] = Histogram::BucketBounds(Histogram::BucketIndex(val));
+    ASSERT_LE(low, val);
+    ASSERT_GE(high, val);
+    ASSERT_LE(high - low, val / Histogram::kSubBuckets);
+  }
+  // Buckets are contiguous
+  for (size_t bucket = 0; bucket < 200; bucket++) {
+    ASSERT_EQ(Histogram::BucketBounds(bucket).second + 1, Histogram::BucketBounds(bucket + 1).first);
+  }
+
+  h.Record(UINT64_MAX);
+  ASSERT_EQ(Histogram::kMaxValue, h.Max());
+}
+
 TEST(MetricTest, CollectGauges) {
   auto aggregator = std::make_shared<Aggregator>();
   Component c("replica", aggregator);
@@ -200,4 +241,107 @@ TEST(MetricTest, CollectStatuses) {
   ASSERT_EQ(numOfGaugesInStateTransfer, 1);
 }
 
+TEST(MetricTest, JsonValues) {
+  auto aggregator = std::make_shared<Aggregator>();
+  Component c("replica", aggregator);
+  auto h_gauge = c.RegisterGauge("connected_peers", 3);
+  c.RegisterStatus("state", "primary");
+  c.RegisterCounter("messages_sent", 1);
+  auto h_histogram = c.RegisterHistogram("commit_latency");
+  c.Register();
+
+  auto values = aggregator->ToJsonValues();
+  ASSERT_EQ(4, values.size());
+  ASSERT_EQ("3", (values[{"replica", "Gauges", "connected_peers"}]));
+  ASSERT_EQ("\"primary\"", (values[{"replica", "Statuses", "state"}]));
+  ASSERT_EQ("1", (values[{"replica", "Counters", "messages_sent"}]));
+  ASSERT_EQ("{\"count\":0,\"sum\":0,\"min\":0,\"max\":0,\"buckets\":[]}",
+            (values[{"replica", "Histograms", "commit_latency"}]));
+
+  ASSERT_EQ("3", aggregator->GetJsonValue({"replica", "Gauges", "connected_peers"}));
+  ASSERT_EQ(std::nullopt, aggregator->GetJsonValue({"replica", "Gauges", "state"}));
+  ASSERT_EQ(std::nullopt, aggregator->GetJsonValue({"no-such-component", "Gauges", "connected_peers"}));
+
+  h_gauge.Get().Set(5);
+  c.UpdateAggregator();
+  auto changed = aggregator->ToJsonValues();
+  ASSERT_EQ("5", (changed[{"replica", "Gauges", "connected_peers"}]));
+  ASSERT_NE(values, changed);
+
+  h_histogram.Get().Record(3);
+  h_histogram.Get().Record(3);
+  h_histogram.Get().Record(40);
+  c.UpdateAggregator();
+  ASSERT_EQ("{\"count\":3,\"sum\":46,\"min\":3,\"max\":40,\"buckets\":[[3,2],[36,1]]}",
+            aggregator->GetJsonValue({"replica", "Histograms", "commit_latency"}));
+}
+
+TEST(MetricTest, ToBinary) {
+  auto aggregator = std::make_shared<Aggregator>();
+  Component c("replica", aggregator);
+  c.RegisterGauge("connected_peers", 3);
+  c.RegisterStatus("state", "primary");
+  c.RegisterCounter("messages_sent", 1);
+  c.Register();
+
+  auto with_names = aggregator->ToBinary(0);
+  uint64_t version;
+  memcpy(&version, with_names.data(), sizeof(version));
+  ASSERT_EQ(1, with_names[sizeof(version)]);
+
+  // Only the values follow when the client knows the names: a gauge, a
+  // status with its length and a counter
+  auto without_names = aggregator->ToBinary(version);
+  auto values_size = 8 + 2 + strlen("primary") + 8;
+  ASSERT_EQ(0, without_names[sizeof(version)]);
+  ASSERT_EQ(sizeof(version) + 1 + values_size, without_names.size());
+  ASSERT_EQ(with_names.substr(with_names.size() - values_size), without_names.substr(sizeof(version) + 1));
+
+  // Registering a component changes the names
+  Component c2("state-transfer", aggregator);
+  c2.RegisterGauge("blocks-remaining", 4);
+  c2.Register();
+  ASSERT_EQ(1, aggregator->ToBinary(version)[sizeof(version)]);
+}
+
+TEST(MetricTest, ToBinaryQuery) {
+  auto aggregator = std::make_shared<Aggregator>();
+  Component c("replica", aggregator);
+  c.RegisterGauge("connected_peers", 3);
+  c.RegisterStatus("state", "primary");
+  c.RegisterCounter("messages_sent", 1);
+  c.RegisterHistogram("commit_latency").Get().Record(3);
+  c.Register();
+  Component c2("state-transfer", aggregator);
+  c2.RegisterGauge("blocks-remaining", 4);
+  c2.Register();
+
+  auto all = aggregator->ToBinary(0);
+  uint64_t version;
+  memcpy(&version, all.data(), sizeof(version));
+
+  // A single value: the version, no names, and a gauge
+  auto gauge = aggregator->ToBinary(version, {{"replica", "Gauges", "connected_peers"}});
+  ASSERT_EQ(sizeof(version) + 1 + 8, gauge.size());
+  uint64_t value;
+  memcpy(&value, gauge.data() + sizeof(version) + 1, sizeof(value));
+  ASSERT_EQ(3, value);
+
+  // A histogram: count, sum, min, max, the number of buckets and the
+  // index and count of each
+  auto histogram = aggregator->ToBinary(version, {{"replica", "Histograms", "commit_latency"}});
+  ASSERT_EQ(sizeof(version) + 1 + 4 * 8 + 4 + 2 + 8, histogram.size());
+
+  // A whole component
+  auto component = aggregator->ToBinary(version, {{"state-transfer", "", ""}});
+  ASSERT_EQ(sizeof(version) + 1 + 8, component.size());
+  memcpy(&value, component.data() + sizeof(version) + 1, sizeof(value));
+  ASSERT_EQ(4, value);
+
+  // Values that don't exist are left out
+  auto none = aggregator->ToBinary(version, {{"replica", "Gauges", "state"}, {"no-such-component", "", ""}});
+  ASSERT_EQ(sizeof(version) + 1, none.size());
+  ASSERT_LT(aggregator->ToBinary(0, {{"replica", "Counters", "messages_sent"}}).size(), all.size());
+}
+
 }  // namespace concordMetrics